@@ -0,0 +1,144 @@
+"""
+Intermediate format benchmark
+
+Runs the normalize -> resize -> WebP encode chain on one image once per
+engine.INTERMEDIATE_FORMATS mode and prints the CPU time each stage spent
+per megapixel, so the cost of compressing and inflating the rasters passed
+between stages is visible.
+
+    python benchmarks/bench_intermediates.py
+    python benchmarks/bench_intermediates.py --input D:/photos/scan.jpg --runs 5
+
+Without --input a synthetic JPEG of --megapixels is rendered first. Needs
+ImageMagick and cwebp; CPU times come from os.times() and are only reported
+where the platform counts child processes (not on Windows), wall time always.
+"""
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from engine import (
+    CWEBP,
+    DEFAULT_QUALITY,
+    INTERMEDIATE_FORMATS,
+    MAGICK,
+    TOOLS,
+    ImageProcessor,
+    read_image_header,
+    robust_path,
+)
+
+
+def child_times():
+    """(child CPU seconds, wall seconds) so far."""
+    t = os.times()
+    return t.children_user + t.children_system, time.perf_counter()
+
+
+def timed(fn, *args):
+    """Run fn and return (result, CPU seconds, wall seconds)."""
+    cpu, wall = child_times()
+    result = fn(*args)
+    cpu_after, wall_after = child_times()
+    return result, cpu_after - cpu, wall_after - wall
+
+
+def render_source(path, megapixels):
+    """Write a JPEG of plasma noise, which compresses about like a photo."""
+    side = int(math.sqrt(megapixels * 1e6))
+    ImageProcessor().call(
+        [MAGICK, "-seed", "7", "-size", f"{side}x{side * 3 // 4}", "plasma:", path]
+    )
+
+
+def run_chain(mode, source, tmp_dir):
+    """One normalize -> resize -> encode pass; returns {stage: (cpu, wall)}."""
+    processor = ImageProcessor(intermediate=mode)
+    normalized, *normalize = timed(processor.normalize_to_png, source, tmp_dir, "bench")
+    raster = processor.raster_for(["WebP"])
+    resized, *resize = timed(
+        processor.resize_variant,
+        normalized,
+        tmp_dir,
+        "bench",
+        {"size": "50%", "mode": "fit"},
+        None,
+        raster,
+    )
+    _, *encode = timed(
+        processor.encode_webp, resized, tmp_dir / "bench.webp", DEFAULT_QUALITY["WebP"]
+    )
+    sizes = normalized.stat().st_size, resized.stat().st_size
+    return {"normalize": normalize, "resize": resize, "encode": encode}, sizes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--input", help="Image to run the chain on")
+    parser.add_argument("--megapixels", type=float, default=12.0)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    missing = TOOLS.missing([MAGICK, CWEBP])
+    if missing:
+        print(f"Missing tools: {', '.join(missing)}")
+        return 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        source = Path(args.input) if args.input else tmp_dir / "source.jpg"
+        if not args.input:
+            render_source(robust_path(source), args.megapixels)
+        header = read_image_header(source)
+        if not header:
+            print(f"Can't read the dimensions of {source}")
+            return 1
+        megapixels = header[0] * header[1] / 1e6
+        # Normalize and resize read the full image, the encode a quarter of it
+        stage_mp = {
+            "normalize": megapixels,
+            "resize": megapixels,
+            "encode": megapixels / 4,
+        }
+        print(f"{source.name}: {megapixels:.1f} MP, best of {args.runs} runs")
+        print(
+            f"{'mode':<6} {'normalize':>10} {'resize':>10} {'encode':>10} "
+            f"{'total':>10} {'wall':>8} {'rasters':>9}"
+        )
+        cpu_counted = True
+        for mode in INTERMEDIATE_FORMATS:
+            best = None
+            for _ in range(max(1, args.runs)):
+                run_dir = tmp_dir / f"{mode}-run"
+                run_dir.mkdir(exist_ok=True)
+                stages, sizes = run_chain(mode, source, run_dir)
+                wall = sum(w for _, w in stages.values())
+                if best is None or wall < best[2]:
+                    best = stages, sizes, wall
+            stages, sizes, wall = best
+            cpu_counted = cpu_counted and any(c for c, _ in stages.values())
+            per_mp = {
+                stage: cpu * 1000 / stage_mp[stage]
+                for stage, (cpu, _) in stages.items()
+            }
+            print(
+                f"{mode:<6} "
+                + " ".join(f"{per_mp[s]:>7.1f} ms" for s in stage_mp)
+                + f" {sum(per_mp.values()):>7.1f} ms {wall:>7.2f}s"
+                f" {sum(sizes) / 1e6:>7.1f} MB"
+            )
+        print("CPU milliseconds per megapixel of each stage's input")
+        if not cpu_counted:
+            print("(this platform doesn't count child CPU time; compare wall times)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
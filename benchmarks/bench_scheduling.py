@@ -0,0 +1,95 @@
+"""
+Scheduling policy benchmark
+
+Simulates a batch on N workers with greedy list scheduling, using pixel
+count as the cost of an image, and compares makespan and time to first
+result for every ordering policy in engine.SCHEDULING_POLICIES.
+
+    python benchmarks/bench_scheduling.py
+    python benchmarks/bench_scheduling.py --workers 16 --dir D:/photos
+
+Without --dir a synthetic skewed corpus is used: many small web images
+followed by a handful of huge scans discovered last.
+"""
+
+import argparse
+import heapq
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from engine import (
+    SCHEDULING_POLICIES,
+    estimate_pixels,
+    gather_image_files,
+    order_image_files,
+)
+
+# Rough throughput of the full pipeline, only used to print seconds
+MEGAPIXELS_PER_SECOND = 4.0
+
+
+def skewed_corpus(small=500, huge=6, seed=42):
+    """Return {name: pixels}: small images first, giant ones discovered last."""
+    rng = random.Random(seed)
+    corpus = {}
+    for i in range(small):
+        corpus[f"small_{i:04d}.jpg"] = rng.randint(300_000, 2_500_000)
+    for i in range(huge):
+        corpus[f"huge_{i}.tif"] = rng.randint(60_000_000, 120_000_000)
+    return corpus
+
+
+def simulate(costs, workers):
+    """Greedy list scheduling; returns (makespan, first completion) in pixels."""
+    free_at = [0.0] * workers
+    heapq.heapify(free_at)
+    first = None
+    makespan = 0.0
+    for cost in costs:
+        start = heapq.heappop(free_at)
+        end = start + cost
+        first = end if first is None else min(first, end)
+        makespan = max(makespan, end)
+        heapq.heappush(free_at, end)
+    return makespan, first or 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--dir", help="Use header-probed sizes of a real folder")
+    args = parser.parse_args(argv)
+
+    if args.dir:
+        files = gather_image_files([Path(args.dir)], recursive=True)
+        corpus = {f: estimate_pixels(f) for f in files}
+    else:
+        corpus = skewed_corpus()
+    if not corpus:
+        print("No images found")
+        return 1
+
+    total = sum(corpus.values())
+    bound = max(total / args.workers, max(corpus.values()))
+    print(
+        f"{len(corpus)} images, {total / 1e6:.0f} MP, {args.workers} workers, "
+        f"lower bound {bound / 1e6 / MEGAPIXELS_PER_SECOND:.1f} s"
+    )
+    print(f"{'policy':<12} {'makespan':>10} {'vs bound':>9} {'first result':>13}")
+
+    for policy in SCHEDULING_POLICIES:
+        ordered = order_image_files(list(corpus), policy, args.workers, corpus.get)
+        makespan, first = simulate([corpus[f] for f in ordered], args.workers)
+        print(
+            f"{policy:<12} {makespan / 1e6 / MEGAPIXELS_PER_SECOND:>9.1f}s "
+            f"{makespan / bound:>8.2f}x "
+            f"{first / 1e6 / MEGAPIXELS_PER_SECOND:>12.2f}s"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
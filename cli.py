@@ -0,0 +1,459 @@
+"""
+MMImageOptimizer command line interface
+
+Headless entry point for build servers and containers. Takes the same inputs
+as the GUI and prints one JSON object per line on stdout:
+
+    python -m cli photos/ -o out/ --format WebP --format AVIF --resize 256:fit
+
+author: Mohammadreza Mohseni
+version: 1.2.0
+"""
+
+import argparse
+import json
+import signal
+import sys
+import time
+from pathlib import Path
+
+from engine import (
+    CONFLICT_POLICIES,
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_LOSSLESS,
+    DEFAULT_QUALITY,
+    DEFAULT_STREAM_LIMIT,
+    FORMATS,
+    INTERMEDIATE_FORMATS,
+    MAX_PIXELS,
+    SCHEDULING_POLICIES,
+    TOOL_THREADS,
+    TOOL_TIMEOUTS,
+    BatchProcessor,
+    get_optimal_thread_count,
+    validate_resize_input,
+)
+
+RESIZE_MODES = ["fit", "crop", "width", "height"]
+
+
+def parse_format(value):
+    """Match a format name case-insensitively against FORMATS."""
+    for fmt in FORMATS:
+        if fmt.lower() == value.strip().lower() or (
+            fmt == "JPEG" and value.strip().lower() == "jpg"
+        ):
+            return fmt
+    raise argparse.ArgumentTypeError(
+        f"unknown format '{value}' (choose from {', '.join(FORMATS)})"
+    )
+
+
+def parse_resize(value):
+    """Parse 'SIZE[:MODE]', e.g. '256', '256:crop', '50%:fit' or 'original'.
+
+    SIZE is 2-10000 pixels or 1-100 percent (also as a fraction like 0.5).
+    """
+    size, _, mode = value.strip().partition(":")
+    if size == "original" and not mode:
+        return {"size": "original", "mode": "original"}
+    mode = mode or "fit"
+    if mode not in RESIZE_MODES:
+        raise argparse.ArgumentTypeError(
+            f"unknown resize mode '{mode}' (choose from {', '.join(RESIZE_MODES)})"
+        )
+    # validate_resize_input() falls back to 256 or clamps instead of failing
+    try:
+        number = float(size[:-1] if size.endswith("%") else size)
+    except ValueError:
+        number = None
+    if size.endswith("%"):
+        valid = number is not None and 1 <= number <= 100
+    else:
+        valid = number is not None and (0 < number < 1 or 2 <= number <= 10000)
+    if not valid:
+        raise argparse.ArgumentTypeError(
+            f"invalid size '{size}' (expected 2-10000 pixels or 1-100%)"
+        )
+    return {"size": validate_resize_input(size), "mode": mode}
+
+
+def parse_quality(value):
+    """Parse 'FORMAT=QUALITY', e.g. 'JPEG=85'."""
+    fmt, sep, quality = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected FORMAT=QUALITY, got '{value}'")
+    try:
+        return parse_format(fmt), max(1, min(100, int(quality)))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid quality in '{value}'")
+
+
+def parse_lane(value):
+    """Parse 'TOOL=N', e.g. 'avifenc=2'."""
+    tool, sep, size = value.partition("=")
+    if not sep or tool.strip().lower() not in TOOL_THREADS:
+        raise argparse.ArgumentTypeError(
+            f"expected TOOL=N with TOOL in {', '.join(TOOL_THREADS)}, got '{value}'"
+        )
+    try:
+        return tool.strip().lower(), max(1, int(size))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid lane size in '{value}'")
+
+
+def parse_timeout(value):
+    """Parse 'TOOL=SECONDS', e.g. 'avifenc=1200'; 0 disables the limit."""
+    tool, sep, seconds = value.partition("=")
+    if not sep or tool.strip().lower() not in TOOL_TIMEOUTS:
+        raise argparse.ArgumentTypeError(
+            f"expected TOOL=SECONDS with TOOL in {', '.join(TOOL_TIMEOUTS)}, "
+            f"got '{value}'"
+        )
+    try:
+        return tool.strip().lower(), max(0.0, float(seconds))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid timeout in '{value}'")
+
+
+def parse_bytes(value):
+    """Parse a byte count with an optional K/M/G/T suffix, e.g. '6G'."""
+    units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    number = value.strip().upper().rstrip("B")
+    unit = number[-1:] if number[-1:] in units else ""
+    try:
+        return int(float(number[: len(number) - len(unit)]) * units[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size '{value}'")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m cli",
+        description="Optimize images headlessly and stream progress as JSON lines.",
+    )
+    parser.add_argument("sources", nargs="+", help="Input image files or folders")
+    parser.add_argument(
+        "-o", "--output", required=True, help="Output folder (created if missing)"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="formats",
+        action="append",
+        type=parse_format,
+        help="Output format, repeatable (default: JPEG)",
+    )
+    parser.add_argument(
+        "-r",
+        "--resize",
+        dest="res_modes",
+        action="append",
+        type=parse_resize,
+        help="Output resolution as SIZE[:MODE], repeatable (default: no resize)",
+    )
+    parser.add_argument(
+        "-q",
+        "--quality",
+        action="append",
+        type=parse_quality,
+        default=[],
+        help="Per-format quality as FORMAT=QUALITY, repeatable",
+    )
+    parser.add_argument(
+        "--lossless",
+        action="append",
+        type=parse_format,
+        default=[],
+        help="Enable lossless mode for PNG or JPEG, repeatable",
+    )
+    parser.add_argument(
+        "--lossy",
+        action="append",
+        type=parse_format,
+        default=[],
+        help="Disable lossless mode for PNG or JPEG, repeatable",
+    )
+    parser.add_argument(
+        "--keep-metadata",
+        action="store_true",
+        help="Keep metadata instead of stripping it",
+    )
+    parser.add_argument(
+        "--recursive", action="store_true", help="Include subfolders recursively"
+    )
+    parser.add_argument(
+        "--on-conflict",
+        choices=[p for p in CONFLICT_POLICIES if p != "ask"],
+        default="overwrite",
+        help="What to do with outputs that already exist (default: overwrite)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted batch into the same output folder",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip inputs unchanged since the last run into the same output folder",
+    )
+    parser.add_argument(
+        "--hash",
+        dest="hash_inputs",
+        action="store_true",
+        help="With --incremental, compare file contents when size or mtime differ",
+    )
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="Process identical inputs once and link the outputs for the copies",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Reuse resized intermediates and encoded outputs from earlier runs",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Folder for the caches and the input catalog "
+        "(default: the per-user cache folder)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=parse_bytes,
+        default=DEFAULT_CACHE_SIZE,
+        help="Size cap of each cache, e.g. 10G (default: 2G)",
+    )
+    parser.add_argument(
+        "--no-catalog",
+        dest="catalog",
+        action="store_false",
+        help="Don't keep probed image headers in the catalog for later runs",
+    )
+    parser.add_argument(
+        "--scratch-dir",
+        default=None,
+        help="Folder for intermediates, e.g. a local SSD or tmpfs "
+        "(default: _tmp in the output folder)",
+    )
+    parser.add_argument(
+        "--scratch-quota",
+        type=parse_bytes,
+        default=None,
+        help="Scratch space admitted images may use, e.g. 20G "
+        "(default: half of its free space)",
+    )
+    parser.add_argument(
+        "--stream-limit",
+        type=parse_bytes,
+        default=DEFAULT_STREAM_LIMIT,
+        help="Pipe intermediates of images up to this raster size between "
+        "tools in memory instead of scratch files, 0 to disable (default: 32M)",
+    )
+    parser.add_argument(
+        "--intermediate",
+        choices=INTERMEDIATE_FORMATS,
+        default="auto",
+        help="Raster format between stages: PAM where the encoder reads it, "
+        "else uncompressed PNG (auto), uncompressed PNG (png0) or zlib PNG (png)",
+    )
+    parser.add_argument(
+        "-j",
+        "--threads",
+        type=int,
+        default=get_optimal_thread_count(),
+        help="CPU budget: cores shared by all running tools",
+    )
+    parser.add_argument(
+        "--gpu", action="store_true", help="Enable GPU acceleration for ImageMagick"
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Tune the CPU budget while running, starting from --threads",
+    )
+    parser.add_argument(
+        "--max-threads",
+        type=int,
+        default=None,
+        help="Upper bound for --adaptive (default: all available cores)",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=None,
+        help="Images admitted to the pool at once (default: 4x threads)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=parse_bytes,
+        default=None,
+        help="Decoded image memory admitted at once, e.g. 6G "
+        "(default: half of free memory)",
+    )
+    parser.add_argument(
+        "--max-pixels",
+        type=int,
+        default=MAX_PIXELS,
+        help=f"Reject inputs larger than this many pixels (default: {MAX_PIXELS})",
+    )
+    parser.add_argument(
+        "--order",
+        choices=SCHEDULING_POLICIES,
+        default="discovery",
+        help="Batch ordering: discovery, largest first, smallest first or interleaved",
+    )
+    parser.add_argument(
+        "--lane",
+        action="append",
+        type=parse_lane,
+        default=[],
+        help="Max concurrent instances of a tool as TOOL=N, repeatable",
+    )
+    parser.add_argument(
+        "--timeout",
+        action="append",
+        type=parse_timeout,
+        default=[],
+        help="Kill a tool after SECONDS as TOOL=SECONDS, repeatable (0 disables)",
+    )
+    parser.add_argument(
+        "--no-retry-faster",
+        dest="retry_faster",
+        action="store_false",
+        help="Don't retry a timed-out encode with a faster preset",
+    )
+    parser.add_argument(
+        "--no-speculate",
+        dest="speculate",
+        action="store_false",
+        help="Don't race slow encodes against faster duplicates at the end of a batch",
+    )
+    return parser
+
+
+def emit(event, **fields):
+    """Write one progress event as a JSON line and flush immediately."""
+    fields = {"event": event, "time": round(time.time(), 3), **fields}
+    sys.stdout.write(json.dumps(fields, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    formats = []
+    for fmt in args.formats or ["JPEG"]:
+        if fmt not in formats:
+            formats.append(fmt)
+
+    res_modes = []
+    seen = {}
+    for res in args.res_modes or []:
+        mode = seen.setdefault(res["size"], res["mode"])
+        if mode != res["mode"]:
+            # Both would write the same file names
+            parser.error(
+                f"size {res['size']} is given as both {mode} and {res['mode']}"
+            )
+        if res not in res_modes:
+            res_modes.append(res)
+    if not res_modes:
+        res_modes = [{"size": "original", "mode": "original"}]
+
+    qmap = {fmt: DEFAULT_QUALITY[fmt] for fmt in formats}
+    qmap.update({fmt: q for fmt, q in args.quality if fmt in formats})
+    qlossless_map = {fmt: DEFAULT_LOSSLESS[fmt] for fmt in formats}
+    for fmt in args.lossless:
+        if fmt in qlossless_map:
+            qlossless_map[fmt] = True
+    for fmt in args.lossy:
+        if fmt in qlossless_map:
+            qlossless_map[fmt] = False
+
+    input_sources = [Path(s) for s in args.sources if Path(s).exists()]
+    if not input_sources:
+        emit("error", message="No valid input file(s) or folder found!")
+        return 2
+
+    processor = BatchProcessor(
+        input_sources,
+        args.output,
+        res_modes,
+        formats,
+        qmap,
+        qlossless_map,
+        not args.keep_metadata,
+        args.recursive,
+        args.threads,
+        args.gpu,
+        progress_callback=lambda current, total, filename: emit(
+            "progress", current=current, total=total, file=filename
+        ),
+        status_callback=lambda message: emit("status", message=message),
+        conflict_policy=args.on_conflict,
+        max_in_flight=args.max_in_flight,
+        scheduling=args.order,
+        lane_sizes=dict(args.lane),
+        adaptive=args.adaptive,
+        max_threads=args.max_threads,
+        memory_budget=args.memory_budget,
+        max_pixels=args.max_pixels,
+        timeouts=dict(args.timeout),
+        retry_faster=args.retry_faster,
+        speculate=args.speculate,
+        incremental=args.incremental,
+        hash_inputs=args.hash_inputs,
+        dedupe=args.dedupe,
+        cache=args.cache,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        resume=args.resume,
+        catalog=args.catalog,
+        intermediate=args.intermediate,
+        scratch_dir=args.scratch_dir,
+        scratch_quota=args.scratch_quota,
+        stream_limit=args.stream_limit,
+    )
+
+    def interrupt(signum, frame):
+        # The first Ctrl+C stops cleanly and keeps the journal; a second aborts.
+        # Only a flag is set here: emitting could interleave with a write the
+        # signal interrupted, so the dispatch loop reports the cancel
+        if processor.cancel_requested:
+            raise KeyboardInterrupt
+        processor.request_cancel()
+
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+
+    started = time.monotonic()
+    try:
+        stats = processor.run()
+    except KeyboardInterrupt:
+        emit("error", message="Interrupted")
+        return 130
+    except Exception as e:
+        emit("error", message=f"Processing failed: {e}")
+        return 1
+
+    timeouts = set(stats.timeouts)
+    for message in stats.errors:
+        emit("timeout" if message in timeouts else "error", message=message)
+    if processor.cancelled:
+        emit("error", message="Interrupted; rerun with --resume to continue")
+    emit(
+        "done",
+        elapsed=round(time.monotonic() - started, 3),
+        **stats.to_dict(),
+    )
+    if processor.cancelled:
+        return 130
+    return 1 if stats.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,4913 @@
+"""
+MMImageOptimizer headless engine
+
+The image pipeline and batch runner, free of any Qt dependency so it can be
+driven from the GUI (main.py) or from the command line (cli.py).
+
+author: Mohammadreza Mohseni
+version: 1.2.0
+"""
+
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import math
+import os
+import platform
+import queue
+import shutil
+import signal
+import sqlite3
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Union
+
+from pymage_size import get_image_size
+
+
+# --- Robust Path Helper for Windows Long/Unicode Paths ---
+def robust_path(p: Union[str, Path]) -> str:
+    """Return a path string robust for long/Unicode paths on Windows."""
+    if not isinstance(p, (str, Path)):
+        return p
+    p = str(p)
+    if platform.system() == "Windows":
+        # Remove any existing prefix
+        if p.startswith("\\\\?\\"):
+            return p
+        # Accept both forward and backward slashes
+        p = p.replace("/", "\\")
+        # If path is already short, don't add prefix
+        if len(p) < 240 and not any(ord(c) > 127 for c in p):
+            return p
+        # Only add prefix for absolute paths
+        if os.path.isabs(p):
+            # UNC path
+            if p.startswith("\\\\"):  # network path
+                return "\\\\?\\UNC" + p[1:]
+            else:
+                return "\\\\?\\" + p
+    return p
+
+
+def get_resources_folder():
+    """Get the resources folder in LocalAppData"""
+    if platform.system() != "Windows":
+        # Fallback for non-Windows systems
+        return Path(__file__).parent / "resources"
+
+    local_appdata = os.getenv("LOCALAPPDATA")
+    if local_appdata is None:
+        local_appdata = str(Path.home() / "AppData" / "Local")
+
+    resources_path = Path(local_appdata) / "MMImageOptimizer" / "resources"
+
+    # If resources folder doesn't exist, fall back to local resources
+    if not resources_path.exists():
+        return Path(__file__).parent / "resources"
+
+    return resources_path
+
+
+def find_tool(name):
+    """Locate a tool binary: bundled .exe on Windows, resources or PATH elsewhere."""
+    if platform.system() == "Windows":
+        return RESOURCES_DIR / f"{name}.exe"
+    bundled = RESOURCES_DIR / name
+    if bundled.exists():
+        return bundled
+    found = shutil.which(name)
+    return Path(found) if found else Path(name)
+
+
+def tool_name(arg):
+    """Return the bare tool name (e.g. 'magick') for a command's first argument."""
+    return Path(str(arg)).stem.lower()
+
+
+# Use pathlib for robust path handling
+RESOURCES_DIR = get_resources_folder()
+MAGICK = find_tool("magick")
+CWEBP = find_tool("cwebp")
+AVIFENC = find_tool("avifenc")
+CJPEGLI = find_tool("cjpegli")
+OXIPNG = find_tool("oxipng")
+PNGQUANT = find_tool("pngquant")
+EXIFTOOL = find_tool("exiftool")
+
+FORMATS = ["PNG", "JPEG", "WebP", "AVIF"]
+OUTPUT_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WebP": ".webp", "AVIF": ".avif"}
+
+# Defaults mirror the GUI sliders and checkboxes
+DEFAULT_QUALITY = {"PNG": 82, "JPEG": 85, "WebP": 82, "AVIF": 65}
+DEFAULT_LOSSLESS = {"PNG": True, "JPEG": False, "WebP": False, "AVIF": False}
+
+IMAGE_EXTENSIONS = {
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".webp",
+    ".avif",
+    ".gif",
+    ".bmp",
+    ".tiff",
+    ".tif",
+    ".heic",
+    ".heif",
+    ".dds",
+    ".j2c",
+    ".j2k",
+    ".jp2",
+    ".jpe",
+    ".jxl",
+    ".png24",
+    ".png32",
+    ".png48",
+    ".png64",
+    ".png16",
+    ".png8",
+    ".psd",
+    ".tga",
+    ".ico",
+}
+
+
+def hidden_startupinfo():
+    """STARTUPINFO that keeps console windows from flashing up on Windows."""
+    if platform.system() != "Windows":
+        return None
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    startupinfo.wShowWindow = subprocess.SW_HIDE
+    return startupinfo
+
+
+def detect_gpu_acceleration():
+    """Detect if GPU acceleration is available for ImageMagick"""
+    return TOOLS.gpu()
+
+
+# --- Tool capability registry ---
+TOOL_PATHS = {
+    "magick": MAGICK,
+    "exiftool": EXIFTOOL,
+    "cwebp": CWEBP,
+    "avifenc": AVIFENC,
+    "cjpegli": CJPEGLI,
+    "oxipng": OXIPNG,
+    "pngquant": PNGQUANT,
+}
+# Flag that makes each tool print its version
+VERSION_FLAGS = {
+    "magick": "-version",
+    "exiftool": "-ver",
+    "cwebp": "-version",
+    "avifenc": "--version",
+    "cjpegli": "--version",
+    "oxipng": "--version",
+    "pngquant": "--version",
+}
+# Flag that makes each tool list its options
+HELP_FLAGS = {
+    "magick": "-help",
+    "cwebp": "-longhelp",
+    "avifenc": "--help",
+    "cjpegli": "--help",
+    "oxipng": "--help",
+    "pngquant": "--help",
+}
+# Option that sets a tool's thread count, used if its help lists the first word
+THREAD_FLAGS = {
+    "magick": ["-limit", "thread"],
+    "avifenc": ["--jobs"],
+    "oxipng": ["--threads"],
+}
+# Input formats besides PNG each encoder may read itself (sniff_format names);
+# the registry tries each on a tiny sample to see which the binary accepts
+NATIVE_INPUTS = {
+    "cwebp": ["JPEG", "TIFF", "WEBP", "PAM"],
+    "avifenc": ["JPEG"],
+    "cjpegli": ["JPEG"],
+}
+SAMPLE_EXTENSIONS = {"JPEG": ".jpg", "TIFF": ".tif", "WEBP": ".webp", "PAM": ".pam"}
+# Arguments in place of the input path that make an encoder read stdin;
+# avifenc only takes y4m there
+STDIN_ARGS = {"cwebp": ["--", "-"], "cjpegli": ["-"], "oxipng": ["-"]}
+TOOLS_NAME = "tools.json"
+
+
+class ToolRegistry:
+    """What each tool binary can do, probed once and cached on disk.
+
+    An entry records whether the binary exists, its version line, whether
+    it reads a PNG piped to its stdin, whether its help mentions stdout, its
+    thread-count option, the input formats an encoder reads besides PNG and,
+    for ImageMagick, OpenCL and CUDA support. Entries are keyed on the
+    binary's path and revalidated against its size and mtime, so replacing a
+    tool probes it again. Nothing is probed until a tool is first asked about.
+    """
+
+    VERSION = 4
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tools = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def stamp(path):
+        try:
+            st = os.stat(robust_path(path))
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def cache_path(self):
+        return Path(self.path or default_cache_dir() / TOOLS_NAME)
+
+    def load(self):
+        self.tools = {}
+        with contextlib.suppress(OSError, ValueError, AttributeError):
+            with open(robust_path(self.cache_path()), encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.tools = data.get("tools", {})
+
+    def save(self):
+        path = self.cache_path()
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with contextlib.suppress(OSError):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(robust_path(tmp_path), "w", encoding="utf-8") as f:
+                json.dump({"version": self.VERSION, "tools": self.tools}, f, indent=1)
+            os.replace(robust_path(tmp_path), robust_path(path))
+
+    def info(self, path):
+        """Capabilities of the binary at path, probing it if it is new or changed."""
+        key = robust_path(path)
+        stamp = self.stamp(path)
+        with self._lock:
+            if self.tools is None:
+                self.load()
+            entry = self.tools.get(key)
+            if entry is None or entry.get("stamp") != stamp:
+                entry = self.tools[key] = self.probe(path, stamp)
+                self.save()
+            return entry
+
+    @staticmethod
+    def run(path, *args):
+        """Output of one probe invocation, or None if it failed to run."""
+        try:
+            result = subprocess.run(
+                [robust_path(path), *args],
+                capture_output=True,
+                text=True,
+                errors="replace",
+                timeout=10,
+                startupinfo=hidden_startupinfo(),
+            )
+        except (OSError, subprocess.SubprocessError):
+            return None
+        return result.returncode, (result.stdout or "") + (result.stderr or "")
+
+    def probe(self, path, stamp):
+        tool = tool_name(path)
+        entry = {
+            "stamp": stamp,
+            "present": stamp is not None,
+            "version": "missing",
+            "stdin": False,
+            "stdout": False,
+            "threads": None,
+            "inputs": [],
+            "opencl": False,
+            "cuda": False,
+        }
+        if stamp is None:
+            return entry
+        # Without a version line the binary's size and mtime stand in
+        entry["version"] = f"{stamp[0]}:{stamp[1]}"
+        result = self.run(path, VERSION_FLAGS.get(tool, "--version"))
+        if result:
+            returncode, output = result
+            lines = output.strip().splitlines()
+            if returncode == 0 and lines:
+                entry["version"] = lines[0].strip()
+        if tool in HELP_FLAGS:
+            result = self.run(path, HELP_FLAGS[tool])
+            text = result[1] if result else ""
+            lower = text.lower()
+            entry["stdin"] = tool == "magick" or (
+                tool in STDIN_ARGS and self.probe_stdin(path, tool)
+            )
+            entry["stdout"] = tool == "magick" or "stdout" in lower
+            flag = THREAD_FLAGS.get(tool)
+            if flag and flag[0] in text:
+                entry["threads"] = flag
+        if tool in NATIVE_INPUTS:
+            entry["inputs"] = self.probe_inputs(path, tool)
+        if tool == "magick":
+            result = self.run(path, "-list", "configure")
+            output = result[1].lower() if result else ""
+            entry["opencl"] = "opencl" in output
+            entry["cuda"] = "cuda" in output
+        return entry
+
+    def probe_inputs(self, path, tool):
+        """Which of NATIVE_INPUTS[tool] the encoder reads, tried on 16x16 samples."""
+        if not self.info(MAGICK)["present"]:
+            return []
+        accepted = []
+        with tempfile.TemporaryDirectory() as tmp:
+            for fmt in NATIVE_INPUTS[tool]:
+                sample = Path(tmp) / f"sample{SAMPLE_EXTENSIONS[fmt]}"
+                self.run(MAGICK, "-size", "16x16", "gradient:", robust_path(sample))
+                if not sample.exists():
+                    continue
+                if tool == "cwebp":
+                    out = Path(tmp) / f"{fmt}.webp"
+                    args = ["-q", "50", robust_path(sample), "-o", robust_path(out)]
+                elif tool == "avifenc":
+                    out = Path(tmp) / f"{fmt}.avif"
+                    args = ["--speed", "10", robust_path(sample), robust_path(out)]
+                else:
+                    out = Path(tmp) / f"{fmt}.jpg"
+                    args = [robust_path(sample), robust_path(out)]
+                result = self.run(path, *args)
+                if result and result[0] == 0 and out.exists() and out.stat().st_size:
+                    accepted.append(fmt)
+        return accepted
+
+    def probe_stdin(self, path, tool):
+        """Whether the encoder reads a PNG from stdin, tried on a 16x16 sample."""
+        if not self.info(MAGICK)["present"]:
+            return False
+        with tempfile.TemporaryDirectory() as tmp:
+            sample = Path(tmp) / "sample.png"
+            self.run(MAGICK, "-size", "16x16", "gradient:", robust_path(sample))
+            if not sample.exists():
+                return False
+            out = Path(tmp) / "out"
+            if tool == "cwebp":
+                args = ["-q", "50", "-o", robust_path(out), *STDIN_ARGS[tool]]
+            elif tool == "oxipng":
+                args = ["--out", robust_path(out), *STDIN_ARGS[tool]]
+            else:
+                args = [*STDIN_ARGS[tool], robust_path(out)]
+            try:
+                result = subprocess.run(
+                    [robust_path(path), *args],
+                    input=sample.read_bytes(),
+                    capture_output=True,
+                    timeout=10,
+                    startupinfo=hidden_startupinfo(),
+                )
+            except (OSError, subprocess.SubprocessError):
+                return False
+            return result.returncode == 0 and out.exists() and out.stat().st_size > 0
+
+    def reads(self, path, fmt):
+        """Whether the encoder at path reads `fmt` inputs (sniff_format names)."""
+        return fmt == "PNG" or fmt in self.info(path)["inputs"]
+
+    def gpu(self):
+        """detect_gpu_acceleration's result, from the registry."""
+        entry = self.info(MAGICK)
+        return {
+            "available": entry["opencl"] or entry["cuda"],
+            "opencl": entry["opencl"],
+            "cuda": entry["cuda"],
+        }
+
+    def thread_args(self, tool, threads):
+        """The tool's thread-count option set to `threads`, if it has one."""
+        flag = self.info(TOOL_PATHS[tool])["threads"] if tool in TOOL_PATHS else None
+        return [*flag, str(threads)] if flag else []
+
+    def missing(self, paths):
+        """Names of the tools among paths that aren't installed."""
+        return [tool_name(p) for p in paths if not self.info(p)["present"]]
+
+
+TOOLS = ToolRegistry()
+
+
+def tool_version(path):
+    """First line of a tool's version output, else its size and mtime."""
+    return TOOLS.info(path)["version"]
+
+
+def read_cgroup_cpu_limit():
+    """CPU quota of the container we run in (cgroup v2 or v1), or None."""
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()[:2]
+        if quota != "max":
+            return float(quota) / float(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def get_available_cpus():
+    """Cores this process may really use: affinity mask and cgroup quota aware."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 4
+    quota = read_cgroup_cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota + 0.5)))
+    return max(1, cpus)
+
+
+def get_optimal_thread_count():
+    """Get optimal thread count for processing"""
+    cpu_count = get_available_cpus()
+    # Use 75% of available cores, minimum 1
+    return max(1, int(cpu_count * 0.75))
+
+
+def should_resize(input_img_path, target_size, dimensions=None):
+    width, height = (
+        dimensions or get_image_size(robust_path(input_img_path)).get_dimensions()
+    )
+
+    # Pixel value
+    if isinstance(target_size, int):
+        # Don't upscale: skip if target size is larger than original
+        if target_size >= min(width, height):
+            return False
+        else:
+            return True
+
+    # Percentage string, e.g., "50%"
+    if isinstance(target_size, str) and target_size.endswith("%"):
+        try:
+            pct = float(target_size.rstrip("%"))
+            if pct <= 0:
+                return False
+            new_w = int(width * pct / 100)
+            new_h = int(height * pct / 100)
+            # Don't upscale
+            if new_w >= width or new_h >= height:
+                return False
+            else:
+                return True
+        except Exception:
+            return False
+
+    # Float < 1, treat as percent
+    if isinstance(target_size, float) and 0 < target_size < 1:
+        new_w = int(width * target_size)
+        new_h = int(height * target_size)
+        if new_w >= width or new_h >= height:
+            return False
+        else:
+            return True
+
+    # fallback
+    return False
+
+
+def resize_geometry(r, dimensions):
+    """ImageMagick resize arguments for a res_modes entry on a (width, height) image.
+
+    Returns None when the entry would not downscale, so its output keeps the
+    original pixels. Entries with equal arguments produce identical pixels.
+
+    Raises:
+        ValueError: If invalid resize parameters.
+    """
+    if r.get("size") == "original":
+        return None
+    orig_width, orig_height = dimensions
+    mode = r.get("mode", "fit")
+
+    # Validate and normalize size early
+    validated_size = validate_resize_input(r["size"])
+
+    # Don't upscale: the original pixels stand in for larger sizes
+    if not should_resize(None, validated_size, dimensions):
+        return None
+
+    # Compute target dimensions as integers to avoid float drift
+    if isinstance(validated_size, str) and validated_size.endswith("%"):
+        pct = float(validated_size.rstrip("%")) / 100.0
+        target_width = int(orig_width * pct)  # Truncate to int
+        target_height = int(orig_height * pct)
+        if target_width < 1 or target_height < 1:
+            raise ValueError(
+                f"{validated_size} of {orig_width}x{orig_height} is under one pixel"
+            )
+        resize_str = f"{target_width}x{target_height}"
+    else:  # Pixel size
+        target_size = int(validated_size)
+        if mode in ["fit", "crop"]:
+            # Preserve aspect ratio for fit/crop
+            aspect = orig_width / orig_height
+            if orig_width > orig_height:
+                target_width = target_size
+                target_height = int(target_size / aspect)
+            else:
+                target_height = target_size
+                target_width = int(target_size * aspect)
+            resize_str = f"{target_width}x{target_height}"
+        elif mode == "width":
+            resize_str = f"{target_size}x"
+        elif mode == "height":
+            resize_str = f"x{target_size}"
+        else:
+            raise ValueError(f"Unknown mode: {mode}")
+
+    if mode == "crop":
+        return [
+            "-resize",
+            f"{resize_str}^",
+            "-gravity",
+            "center",
+            "-extent",
+            f"{target_width}x{target_height}",
+        ]
+    return ["-resize", resize_str]
+
+
+def validate_resize_input(val):
+    val = str(val).strip().replace(" ", "")
+
+    # Blank or missing input becomes default
+    if not val:
+        return 256
+
+    # Handle percentage like '0%' or '105%'
+    if val.endswith("%"):
+        pct_str = val[:-1]
+        try:
+            pct_val = float(pct_str)
+        except Exception:
+            pct_val = 100  # fallback
+        # Clamp between 1 and 100
+        pct_val = float(max(1, min(pct_val, 100)))
+        return f"{int(pct_val)}%" if pct_val.is_integer() else f"{pct_val:.2f}%"
+
+    # Accept float <1 as percent (e.g. 0.5 means 50%)
+    try:
+        float_val = float(val)
+        if 0 < float_val < 1:
+            pct_val = float_val * 100
+            pct_val = float(max(1, min(pct_val, 100)))
+            return f"{int(pct_val)}%" if pct_val.is_integer() else f"{pct_val:.2f}%"
+        # Otherwise, treat as pixel size
+        n = int(round(float_val))
+        # Clamp to safe range
+        n = max(2, min(n, 10000))
+        return n
+    except Exception:
+        return 256  # fallback default
+
+
+class FileStats:
+    """Class to track file size statistics"""
+
+    def __init__(self):
+        self.original_size = 0
+        self.optimized_size = 0
+        self.files_processed = 0
+        self.errors = []
+        # Subset of errors caused by a tool being killed by the watchdog
+        self.timeouts = []
+        # Run-level counters (skipped inputs, cache hits, ...) by name
+        self.counters = {}
+        # Worker threads bump counters while the batch loop merges
+        self.lock = threading.Lock()
+        # Decisions of the adaptive concurrency controller, oldest first
+        self.concurrency_log = []
+
+    def bump(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_file(self, original_size, optimized_size):
+        self.original_size += original_size
+        self.optimized_size += optimized_size
+        self.files_processed += 1
+
+    def merge(self, other):
+        """Fold the stats of one processed input image into this total."""
+        self.original_size += other.original_size
+        self.optimized_size += other.optimized_size
+        self.files_processed += 1
+        self.errors.extend(other.errors)
+        self.timeouts.extend(other.timeouts)
+        for name, amount in other.counters.items():
+            self.bump(name, amount)
+
+    def get_compression_ratio(self):
+        if self.original_size == 0:
+            return 0
+        return ((self.original_size - self.optimized_size) / self.original_size) * 100
+
+    def get_size_saved(self):
+        return self.original_size - self.optimized_size
+
+    def format_size(self, size_bytes):
+        """Format size in human readable format"""
+        for unit in ["B", "KB", "MB", "GB"]:
+            if size_bytes < 1024.0:
+                return f"{size_bytes:.1f} {unit}"
+            size_bytes /= 1024.0
+        return f"{size_bytes:.1f} TB"
+
+    def to_dict(self):
+        """Machine-readable summary, used by the CLI progress stream."""
+        return {
+            "files_processed": self.files_processed,
+            "original_size": self.original_size,
+            "optimized_size": self.optimized_size,
+            "size_saved": self.get_size_saved(),
+            "compression_ratio": round(self.get_compression_ratio(), 2),
+            "errors": len(self.errors),
+            "timeouts": len(self.timeouts),
+            "counters": dict(self.counters),
+            "concurrency": list(self.concurrency_log),
+        }
+
+
+# --- Per-tool resource lanes ---
+# Threads one invocation of each tool is allowed to use. ImageProcessor
+# passes these as explicit thread flags, so the token cost of a call matches
+# the CPU it really burns instead of every tool grabbing all cores.
+TOOL_THREADS = {
+    "magick": 1,
+    "exiftool": 1,
+    "cwebp": 1,
+    "cjpegli": 1,
+    "pngquant": 1,
+    "avifenc": 2,
+    "oxipng": 2,
+}
+
+
+class ResourceLanes:
+    """Weighted CPU token budget shared by all subprocess calls of a batch.
+
+    Each tool has its own lane (a cap on concurrent instances) and costs
+    TOOL_THREADS tokens from a shared budget, normally the core count. Slow
+    encoders such as avifenc and oxipng are capped at half the budget by
+    default, so cheap cwebp/cjpegli encodes keep flowing next to them while
+    total CPU demand stays at the budget. Waiters are served in arrival
+    order unless the oldest one has waited less than `bypass_seconds`,
+    which lets cheap calls backfill without starving expensive ones.
+    """
+
+    def __init__(self, budget, lane_sizes=None, threads=None, bypass_seconds=0.5):
+        self.tool_threads = dict(TOOL_THREADS)
+        self.tool_threads.update(threads or {})
+        # Explicit sizes win over the ones derived from the budget
+        self.fixed_lane_sizes = dict(lane_sizes or {})
+        self.bypass_seconds = bypass_seconds
+        self.in_use = 0
+        self.running = {}
+        self.waiters = deque()
+        self.wait_seconds = {}
+        self._cond = threading.Condition()
+        self._apply_budget(budget)
+
+    def _apply_budget(self, budget):
+        self.budget = max(1, int(budget))
+        self.lane_sizes = {}
+        for tool, weight in self.tool_threads.items():
+            share = self.budget // 2 if weight > 1 else self.budget
+            self.lane_sizes[tool] = max(1, share // weight)
+        self.lane_sizes.update(self.fixed_lane_sizes)
+
+    def set_budget(self, budget):
+        """Resize the token budget; running calls finish on the old terms."""
+        with self._cond:
+            self._apply_budget(budget)
+            self._cond.notify_all()
+
+    @property
+    def waiting(self):
+        return len(self.waiters)
+
+    def threads(self, tool):
+        return self.tool_threads.get(tool, 1)
+
+    def _lane_full(self, tool):
+        # Tools without a lane of their own are only bound by the budget
+        return self.running.get(tool, 0) >= self.lane_sizes.get(tool, self.budget)
+
+    def _fits(self, tool, weight):
+        if self._lane_full(tool):
+            return False
+        # An oversized call may still run alone
+        return self.in_use + weight <= self.budget or self.in_use == 0
+
+    def _may_go(self, ticket):
+        _, tool, weight, _ = ticket
+        if not self._fits(tool, weight):
+            return False
+        head = self.waiters[0]
+        if head is ticket:
+            return True
+        head_since, head_tool, head_weight, _ = head
+        # The head is waiting on its own lane, not on tokens: reserving
+        # tokens for it would not help, so let others through
+        if self._lane_full(head_tool):
+            return True
+        # Backfill only while the head is young or there is room for both
+        return (
+            time.monotonic() - head_since < self.bypass_seconds
+            or self.in_use + weight + head_weight <= self.budget
+        )
+
+    def try_acquire(self, tool):
+        """Take a slot right away if nobody is waiting and it fits.
+
+        Returns the tokens taken, to be handed back to release(), or None.
+        """
+        with self._cond:
+            weight = min(self.threads(tool), self.budget)
+            if self.waiters or not self._fits(tool, weight):
+                return None
+            self.in_use += weight
+            self.running[tool] = self.running.get(tool, 0) + 1
+            return weight
+
+    def release(self, tool, weight):
+        """Give back a slot taken with try_acquire.
+
+        The budget may have changed since, so the tokens taken are passed in.
+        """
+        with self._cond:
+            self.in_use -= weight
+            self.running[tool] -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def acquire(self, tool):
+        weight = min(self.threads(tool), self.budget)
+        ticket = (time.monotonic(), tool, weight, object())
+        with self._cond:
+            self.waiters.append(ticket)
+            while not self._may_go(ticket):
+                self._cond.wait(self.bypass_seconds)
+            self.waiters.remove(ticket)
+            self.in_use += weight
+            self.running[tool] = self.running.get(tool, 0) + 1
+            waited = time.monotonic() - ticket[0]
+            self.wait_seconds[tool] = self.wait_seconds.get(tool, 0.0) + waited
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= weight
+                self.running[tool] -= 1
+                self._cond.notify_all()
+
+
+# --- Adaptive concurrency ---
+def read_cpu_times():
+    """(busy, total) CPU jiffies/ticks since boot, or None if unsupported."""
+    if platform.system() == "Windows":
+        try:
+            import ctypes
+
+            idle, kernel, user = (ctypes.c_ulonglong() for _ in range(3))
+            ok = ctypes.windll.kernel32.GetSystemTimes(
+                ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user)
+            )
+            if ok:
+                # Kernel time includes idle time
+                total = kernel.value + user.value
+                return total - idle.value, total
+        except Exception:
+            pass
+        return None
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+        idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+        return sum(fields) - idle, sum(fields)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_runnable():
+    """Number of runnable threads right now (Linux), else the 1-minute load."""
+    try:
+        with open("/proc/loadavg") as f:
+            return int(f.read().split()[3].split("/")[0])
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def read_memory():
+    """(available, total) bytes, honoring a cgroup memory limit; None if unknown."""
+    if platform.system() == "Windows":
+        try:
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [
+                    ("dwLength", ctypes.c_ulong),
+                    ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong),
+                    ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong),
+                    ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong),
+                    ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("sullAvailExtendedVirtual", ctypes.c_ulonglong),
+                ]
+
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return status.ullAvailPhys, status.ullTotalPhys
+        except Exception:
+            pass
+        return None
+    try:
+        info = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                info[key] = int(value.split()[0]) * 1024
+        available, total = info["MemAvailable"], info["MemTotal"]
+    except (OSError, ValueError, KeyError):
+        return None
+    try:
+        limit = Path("/sys/fs/cgroup/memory.max").read_text().strip()
+        if limit != "max":
+            used = int(Path("/sys/fs/cgroup/memory.current").read_text())
+            total = min(total, int(limit))
+            available = min(available, max(0, int(limit) - used))
+    except (OSError, ValueError):
+        pass
+    return available, total
+
+
+class ConcurrencyController:
+    """Grows or shrinks a batch's CPU token budget while it runs.
+
+    Every `interval` seconds it samples system CPU utilization, runnable
+    threads and available RAM, then:
+      - shrinks by a quarter when free memory drops under `low_memory`,
+      - shrinks by one when the CPU is saturated or oversubscribed,
+      - grows by one when there is idle CPU and calls waiting for tokens.
+    The budget stays within [minimum, maximum]; every change is appended to
+    stats.concurrency_log so the run summary shows what happened and why.
+    """
+
+    def __init__(
+        self,
+        lanes,
+        stats,
+        minimum=1,
+        maximum=None,
+        interval=1.0,
+        low_memory=0.10,
+        control=None,
+    ):
+        self.lanes = lanes
+        # Optional BatchControl; an idle CPU while paused means nothing
+        self.control = control
+        self.stats = stats
+        self.cpus = get_available_cpus()
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum or self.cpus)
+        self.interval = interval
+        self.low_memory = low_memory
+        self.started = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._loop, name="mmio-concurrency", daemon=True
+        )
+        self._last_cpu = read_cpu_times()
+        self.record(lanes.budget, "initial")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.record(self.lanes.budget, "final")
+
+    def record(self, budget, reason):
+        self.stats.concurrency_log.append(
+            {
+                "t": round(time.monotonic() - self.started, 2),
+                "budget": budget,
+                "reason": reason,
+            }
+        )
+
+    def sample(self):
+        """Return (cpu utilization 0..1 or None, runnable, memory fraction free)."""
+        cpu = None
+        now = read_cpu_times()
+        if now and self._last_cpu:
+            busy = now[0] - self._last_cpu[0]
+            total = now[1] - self._last_cpu[1]
+            if total > 0:
+                cpu = busy / total
+        self._last_cpu = now
+        memory = read_memory()
+        free = memory[0] / memory[1] if memory and memory[1] else None
+        return cpu, read_runnable(), free
+
+    def decide(self, cpu, runnable, free):
+        """Return (new budget, reason) for one set of samples."""
+        budget = self.lanes.budget
+        if free is not None and free < self.low_memory:
+            return max(self.minimum, budget - max(1, budget // 4)), (
+                f"low memory ({free:.0%} free)"
+            )
+        if (cpu is not None and cpu > 0.97) or (
+            runnable is not None and runnable > self.cpus * 1.5
+        ):
+            return max(self.minimum, budget - 1), (
+                f"saturated (cpu {cpu or 0:.0%}, runnable {runnable})"
+            )
+        if (
+            cpu is not None
+            and cpu < 0.85
+            and self.lanes.waiting
+            and (runnable is None or runnable < self.cpus)
+        ):
+            return min(self.maximum, budget + 1), (
+                f"idle cpu ({cpu:.0%}) with {self.lanes.waiting} calls waiting"
+            )
+        return budget, None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            if self.control and self.control.paused:
+                self._last_cpu = read_cpu_times()
+                continue
+            budget, reason = self.decide(*self.sample())
+            if budget != self.lanes.budget:
+                self.lanes.set_budget(budget)
+                self.record(budget, reason)
+
+
+# --- Robust call helper using robust_path ---
+# --- Subprocess watchdog ---
+# Wall-clock seconds one invocation of each tool may run before it is
+# killed. The CPU-time limit is the same figure times the tool's threads.
+TOOL_TIMEOUTS = {
+    "magick": 600,
+    "exiftool": 60,
+    "cwebp": 300,
+    "cjpegli": 300,
+    "pngquant": 300,
+    "avifenc": 900,
+    "oxipng": 300,
+}
+DEFAULT_TIMEOUT = 600
+# How often a cancellable call checks its cancel event
+CANCEL_POLL_SECONDS = 0.2
+
+
+class ToolTimeoutError(subprocess.SubprocessError):
+    """A tool ran past its wall-clock or CPU-time limit and was killed."""
+
+    def __init__(self, tool, limit, kind="wall"):
+        self.tool = tool
+        self.limit = limit
+        self.kind = kind
+        what = "CPU-time" if kind == "cpu" else "time"
+        super().__init__(f"{tool} exceeded its {limit:g}s {what} limit and was killed")
+
+
+class ToolCancelledError(subprocess.SubprocessError):
+    """A tool was killed on request before it finished."""
+
+    def __init__(self, tool):
+        self.tool = tool
+        super().__init__(f"{tool} was cancelled")
+
+
+def limit_cpu_time(pid, seconds):
+    """Set RLIMIT_CPU on a running child; False where that isn't possible.
+
+    Linux only, and only useful where SIGXCPU exists to report it.
+    """
+    if not hasattr(signal, "SIGXCPU"):
+        return False
+    try:
+        import resource
+
+        # Whole seconds; 0 would kill the tool before it gets going
+        seconds = max(1, math.ceil(seconds))
+        resource.prlimit(pid, resource.RLIMIT_CPU, (seconds, seconds + 5))
+    except (ImportError, AttributeError, OSError, ValueError):
+        return False
+    return True
+
+
+def kill_process_group(pid):
+    """Kill the tool started as pid and everything it spawned."""
+    try:
+        if platform.system() == "Windows":
+            subprocess.run(
+                ["taskkill", "/F", "/T", "/PID", str(pid)],
+                startupinfo=hidden_startupinfo(),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        else:
+            # The child leads its own session, so its group is its pid
+            os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def kill_process_tree(process):
+    """Kill a child and everything it spawned, then reap it."""
+    kill_process_group(process.pid)
+    with contextlib.suppress(OSError):
+        process.kill()
+    process.wait()
+
+
+def process_token(pid):
+    """Start time of a running process, which tells it from a reused pid.
+
+    None if it isn't running or the platform can't tell (only Linux and
+    Windows can).
+    """
+    if platform.system() == "Windows":
+        import ctypes
+        from ctypes import wintypes
+
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return None
+        try:
+            times = [wintypes.FILETIME() for _ in range(4)]
+            if not kernel32.GetProcessTimes(handle, *map(ctypes.byref, times)):
+                return None
+            return str(times[0].dwHighDateTime << 32 | times[0].dwLowDateTime)
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Field 22, counting from the state right after the command name
+    return stat.rsplit(b")", 1)[1].split()[19].decode()
+
+
+PROCESS_LOG_NAME = ".mmio-processes"
+
+
+def reap_orphans(path):
+    """Kill tools a crashed run left running, per its process log; how many.
+
+    Tools lead their own process group (session) on POSIX, so they outlive
+    a killed batch and could still write outputs. The log names the batch
+    and every tool it started and finished; a log whose batch still runs
+    is left alone. The log is removed.
+    """
+    try:
+        with open(robust_path(path), encoding="utf-8") as f:
+            lines = [line.split() for line in f]
+    except OSError:
+        return 0
+    owner, running = None, {}
+    for fields in lines:
+        if len(fields) != 3:
+            continue  # torn by the crash
+        kind, pid, token = fields
+        if kind == "owner":
+            owner = (int(pid), token)
+        elif kind == "+":
+            running[int(pid)] = token
+        elif kind == "-":
+            running.pop(int(pid), None)
+    if owner and process_token(owner[0]) == owner[1]:
+        return 0
+    reaped = 0
+    for pid, token in running.items():
+        current = process_token(pid)
+        # A POSIX group outlives its leader, and its id isn't reused
+        # while it has members
+        if current == token or current is None and platform.system() != "Windows":
+            kill_process_group(pid)
+            reaped += 1
+    with contextlib.suppress(OSError):
+        os.remove(robust_path(path))
+    return reaped
+
+
+def suspend_process(process):
+    """Stop a child (and on POSIX everything it spawned) until resume_process."""
+    with contextlib.suppress(OSError, AttributeError):
+        if platform.system() == "Windows":
+            windows_process_call(process, "NtSuspendProcess")
+        else:
+            os.killpg(process.pid, signal.SIGSTOP)
+
+
+def resume_process(process):
+    with contextlib.suppress(OSError, AttributeError):
+        if platform.system() == "Windows":
+            windows_process_call(process, "NtResumeProcess")
+        else:
+            os.killpg(process.pid, signal.SIGCONT)
+
+
+def windows_process_call(process, function):
+    """Call an ntdll process function such as NtSuspendProcess on a child."""
+    import ctypes
+
+    PROCESS_SUSPEND_RESUME = 0x0800
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.OpenProcess(PROCESS_SUSPEND_RESUME, False, process.pid)
+    if not handle:
+        raise OSError(f"cannot open process {process.pid}")
+    try:
+        getattr(ctypes.windll.ntdll, function)(handle)
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+class BatchControl:
+    """Cancel and pause switches shared by a batch and every tool it starts.
+
+    Tools started through call() register here, so pausing can suspend them
+    and cancelling kills them within CANCEL_POLL_SECONDS. Watchdog clocks
+    stop while paused. Scheduler workers wait at `running` before each task.
+    With open_log() they are also listed in a process log, for reap_orphans
+    after a crash.
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        # Set while not paused
+        self.running = threading.Event()
+        self.running.set()
+        self.processes = set()
+        self.process_log = None
+        self._lock = threading.Lock()
+
+    def open_log(self, path):
+        """Start a process log at path, owned by this process."""
+        with self._lock:
+            self.process_log = path
+            self.log_process("owner", os.getpid(), mode="w")
+
+    def close_log(self):
+        with self._lock:
+            if self.process_log and not self.processes:
+                with contextlib.suppress(OSError):
+                    os.remove(robust_path(self.process_log))
+            self.process_log = None
+
+    def log_process(self, kind, pid, mode="a"):
+        token = process_token(pid)
+        if self.process_log is None or token is None:
+            return
+        with contextlib.suppress(OSError):
+            with open(robust_path(self.process_log), mode, encoding="utf-8") as f:
+                f.write(f"{kind} {pid} {token}\n")
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
+
+    def cancel(self):
+        self.cancelled.set()
+        # Let paused workers and suspended tools run into the cancellation
+        self.unpause()
+
+    def pause(self):
+        with self._lock:
+            self.running.clear()
+            for process in self.processes:
+                suspend_process(process)
+
+    def unpause(self):
+        with self._lock:
+            for process in self.processes:
+                resume_process(process)
+            self.running.set()
+
+    def register(self, process):
+        with self._lock:
+            self.processes.add(process)
+            self.log_process("+", process.pid)
+            if self.paused:
+                suspend_process(process)
+
+    def unregister(self, process):
+        with self._lock:
+            self.processes.discard(process)
+            if self.process_log:
+                with contextlib.suppress(OSError):
+                    with open(robust_path(self.process_log), "a") as f:
+                        f.write(f"- {process.pid} -\n")
+
+
+def start_pipes(process, data):
+    """Threads feeding `data` to process's stdin and draining its stdout.
+
+    Each runs only if that pipe is open. Returns the threads and the list
+    the stdout reader appends its bytes to.
+    """
+    chunks = []
+
+    def feed():
+        # A tool that fails may quit before reading everything
+        with contextlib.suppress(OSError):
+            with process.stdin:
+                process.stdin.write(data)
+
+    def drain():
+        chunks.append(process.stdout.read())
+
+    threads = []
+    if process.stdin:
+        threads.append(threading.Thread(target=feed, daemon=True))
+    if process.stdout:
+        threads.append(threading.Thread(target=drain, daemon=True))
+    for thread in threads:
+        thread.start()
+    return threads, chunks
+
+
+def close_pipes(process, threads):
+    """Wait for start_pipes' threads, then close the process's pipes.
+
+    Only once the process and what it spawned are gone or killed, so the
+    reader sees the end of stdout.
+    """
+    for thread in threads:
+        thread.join()
+    for pipe in (process.stdin, process.stdout):
+        if pipe:
+            with contextlib.suppress(OSError):
+                pipe.close()
+
+
+def replace_option(cmd, flag, value):
+    """Copy of a command line with the value following `flag` replaced."""
+    i = cmd.index(flag)
+    return [*cmd[: i + 1], value, *cmd[i + 2 :]]
+
+
+def call(
+    args,
+    progress_callback=None,
+    use_gpu=False,
+    lanes=None,
+    timeout=None,
+    cancel=None,
+    on_start=None,
+    control=None,
+    input=None,
+    capture=False,
+):
+    """Call a tool silently, without console windows and robust to long paths.
+
+    When `lanes` is given the call first waits for a slot in its tool's lane.
+    The tool then runs under a watchdog: past `timeout` wall-clock seconds
+    (TOOL_TIMEOUTS by default, 0 disables) or the matching CPU time, its
+    whole process tree is killed and ToolTimeoutError is raised. Setting the
+    optional `cancel` event kills it too and raises ToolCancelledError.
+    `on_start` is called once the process has been started. An optional
+    BatchControl can cancel or pause the call as well; paused time doesn't
+    count against the timeout.
+
+    `input` bytes are fed to the tool's stdin and with `capture` what it
+    writes to stdout becomes the result's stdout, so one tool's output can
+    be handed to the next without a file. Both go through helper threads
+    while the watchdog keeps polling.
+    """
+    str_args = [robust_path(arg) for arg in args]
+
+    # Add GPU acceleration if available and requested
+    if use_gpu and tool_name(str_args[0]) == "magick":
+        gpu_info = TOOLS.gpu()
+        if gpu_info["available"]:
+            if gpu_info["opencl"]:
+                str_args.insert(1, "-define")
+                str_args.insert(2, "accelerate:auto-threshold=1")
+
+    tool = tool_name(str_args[0])
+    if timeout is None:
+        timeout = TOOL_TIMEOUTS.get(tool, DEFAULT_TIMEOUT)
+    threads = lanes.threads(tool) if lanes else TOOL_THREADS.get(tool, 1)
+    cpu_limit = timeout * threads
+
+    def cancelled():
+        return (cancel is not None and cancel.is_set()) or (
+            control is not None and control.cancelled.is_set()
+        )
+
+    lane = lanes.acquire(tool) if lanes else contextlib.nullcontext()
+    with lane:
+        if cancelled():
+            raise ToolCancelledError(tool)
+        # The clock starts once the lane is granted, not while queueing
+        process = subprocess.Popen(
+            str_args,
+            startupinfo=hidden_startupinfo(),
+            stdin=subprocess.PIPE if input is not None else None,
+            stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=platform.system() != "Windows",
+        )
+        pipes, chunks = start_pipes(process, input)
+        cpu_limited = bool(timeout) and limit_cpu_time(process.pid, cpu_limit)
+        if control:
+            control.register(process)
+        if on_start:
+            on_start()
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            while True:
+                # Wake up periodically only if someone may cancel us
+                wait_for = CANCEL_POLL_SECONDS if cancel or control else None
+                if deadline is not None:
+                    remaining = max(0.0, deadline - time.monotonic())
+                    wait_for = min(wait_for or remaining, remaining)
+                polled = time.monotonic()
+                try:
+                    returncode = process.wait(timeout=wait_for)
+                    break
+                except subprocess.TimeoutExpired:
+                    if cancelled():
+                        kill_process_tree(process)
+                        raise ToolCancelledError(tool)
+                    if deadline is not None and control and control.paused:
+                        deadline += time.monotonic() - polled
+                    if deadline is not None and time.monotonic() >= deadline:
+                        kill_process_tree(process)
+                        raise ToolTimeoutError(tool, timeout)
+        except (ToolCancelledError, ToolTimeoutError):
+            raise
+        except BaseException:
+            kill_process_tree(process)
+            raise
+        finally:
+            # Every way out has ended or killed the process tree by now
+            close_pipes(process, pipes)
+            if control:
+                control.unregister(process)
+
+    if cpu_limited and returncode == -signal.SIGXCPU:
+        raise ToolTimeoutError(tool, cpu_limit, kind="cpu")
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, str_args)
+    result = subprocess.CompletedProcess(
+        str_args, returncode, stdout=b"".join(chunks) if capture else None
+    )
+
+    if progress_callback:
+        progress_callback()
+
+    return result
+
+
+# --- Speculative re-execution ---
+class Race:
+    """One tool call that may be raced against a faster duplicate."""
+
+    def __init__(self, tool, pixels, faster, alt_output, use_gpu, timeout, input=None):
+        self.tool = tool
+        self.pixels = pixels
+        # The faster command, writing to alt_output instead of the real output
+        self.faster = faster
+        self.alt_output = alt_output
+        self.use_gpu = use_gpu
+        self.timeout = timeout
+        # Bytes both commands read from stdin, if any
+        self.input = input
+        self.started = None
+        self.thread = None
+        # Lane tokens the duplicate holds
+        self.weight = None
+        # "primary" or "duplicate", set by whichever finishes first
+        self.winner = None
+        self.primary_cancel = threading.Event()
+        self.duplicate_cancel = threading.Event()
+        self.lock = threading.Lock()
+
+    def mark_started(self):
+        self.started = time.monotonic()
+
+
+class Speculator:
+    """Races straggling tool calls against a faster duplicate near the end of a batch.
+
+    Every finished call teaches it the tool's seconds per megapixel (an
+    exponentially weighted average). Once `drained()` reports that no work
+    is waiting, a call running `slowdown` times longer than predicted for
+    its pixel count gets a duplicate at a faster preset, if a lane slot is
+    free right away. Whichever finishes first wins and the other is killed.
+    """
+
+    def __init__(
+        self,
+        lanes,
+        stats,
+        drained=None,
+        slowdown=3.0,
+        min_seconds=5.0,
+        min_samples=3,
+        interval=0.5,
+        alpha=0.3,
+        control=None,
+    ):
+        self.lanes = lanes
+        # Optional BatchControl passed to every call; no races while paused
+        self.control = control
+        self.stats = stats
+        self.drained = drained or (lambda: False)
+        self.slowdown = slowdown
+        self.min_seconds = min_seconds
+        self.min_samples = min_samples
+        self.interval = interval
+        self.alpha = alpha
+        # tool -> (seconds per megapixel, samples)
+        self.rates = {}
+        self.races = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._loop, name="mmio-speculator", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def observe(self, tool, pixels, seconds):
+        # Without a pixel count there is no rate to learn
+        if not pixels:
+            return
+        rate = seconds / (pixels / 1e6)
+        with self._lock:
+            old, samples = self.rates.get(tool, (rate, 0))
+            self.rates[tool] = (old + self.alpha * (rate - old), samples + 1)
+
+    def predict(self, tool, pixels):
+        """Expected seconds for a call, or None while there is too little data."""
+        with self._lock:
+            rate, samples = self.rates.get(tool, (0.0, 0))
+        if samples < self.min_samples:
+            return None
+        return rate * pixels / 1e6
+
+    def run(self, cmd, faster, output, pixels, use_gpu=False, timeout=None, input=None):
+        """Run cmd like call() does, possibly finishing through a duplicate.
+
+        `faster` must write to the same `output` path as cmd; the duplicate
+        writes next to it and is moved into place only if it wins. Returns
+        (result, True if the duplicate won).
+        """
+        root, ext = os.path.splitext(output)
+        alt_output = f"{root}.spec{ext}"
+        race = Race(
+            tool_name(cmd[0]),
+            pixels,
+            [alt_output if arg == output else arg for arg in faster],
+            alt_output,
+            use_gpu,
+            timeout,
+            input,
+        )
+        with self._lock:
+            self.races.add(race)
+        result = error = None
+        try:
+            result = call(
+                cmd,
+                use_gpu=use_gpu,
+                lanes=self.lanes,
+                timeout=timeout,
+                cancel=race.primary_cancel,
+                on_start=race.mark_started,
+                control=self.control,
+                input=input,
+            )
+        except ToolCancelledError as e:
+            # Killed by the batch rather than by a winning duplicate
+            if not race.primary_cancel.is_set():
+                error = e
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                self.races.discard(race)
+
+        with race.lock:
+            if race.winner is None and result is not None:
+                race.winner = "primary"
+            duplicate = race.thread
+        if duplicate:
+            if race.winner == "primary":
+                race.duplicate_cancel.set()
+            # After a primary failure the duplicate may still come through
+            duplicate.join()
+
+        if race.winner == "duplicate":
+            os.replace(alt_output, output)
+            self.stats.bump("speculative_wins")
+            return subprocess.CompletedProcess(race.faster, 0), True
+        if error is not None:
+            raise error
+        self.observe(race.tool, pixels, time.monotonic() - race.started)
+        return result, False
+
+    def _duplicate(self, race):
+        won = False
+        try:
+            call(
+                race.faster,
+                use_gpu=race.use_gpu,
+                timeout=race.timeout,
+                cancel=race.duplicate_cancel,
+                control=self.control,
+                input=race.input,
+            )
+            with race.lock:
+                if race.winner is None:
+                    race.winner = "duplicate"
+                    won = True
+        except Exception:
+            pass
+        finally:
+            self.lanes.release(race.tool, race.weight)
+        if won:
+            race.primary_cancel.set()
+        else:
+            with contextlib.suppress(OSError):
+                os.remove(race.alt_output)
+
+    def launch(self, race):
+        """Start a duplicate for a race if a lane slot is free right now."""
+        weight = self.lanes.try_acquire(race.tool)
+        if weight is None:
+            return
+        with race.lock:
+            if race.winner is not None:
+                self.lanes.release(race.tool, weight)
+                return
+            race.weight = weight
+            race.thread = threading.Thread(
+                target=self._duplicate,
+                args=(race,),
+                name="mmio-duplicate",
+                daemon=True,
+            )
+            race.thread.start()
+        self.stats.bump("speculative_launches")
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            if not self.drained() or (self.control and self.control.paused):
+                continue
+            now = time.monotonic()
+            with self._lock:
+                races = [r for r in self.races if r.thread is None and r.started]
+            for race in races:
+                predicted = self.predict(race.tool, race.pixels)
+                if predicted is None:
+                    continue
+                if now - race.started >= max(
+                    self.min_seconds, self.slowdown * predicted
+                ):
+                    self.launch(race)
+
+
+class Task:
+    """One pipeline stage of an image, runnable once its dependencies finish."""
+
+    def __init__(self, key, fn, deps=(), label=None):
+        self.key = key
+        self.fn = fn
+        self.deps = list(deps)
+        self.dependents = []
+        # Prefix for error messages, e.g. "WebP: photo_256.webp"
+        self.label = label or str(key)
+        self.pending = len(self.deps)
+        self.result = None
+        self.error = None
+        self.skipped = False
+        # Output file the stage writes, for stages that produce one
+        self.output = None
+        # Wall-clock seconds the stage ran for
+        self.seconds = 0.0
+
+    @property
+    def failed(self):
+        return self.error is not None or self.skipped
+
+    def run(self):
+        """Run the stage with its dependencies' results as arguments."""
+        if any(dep.failed for dep in self.deps):
+            self.skipped = True
+            return
+        started = time.monotonic()
+        try:
+            self.result = self.fn(*[dep.result for dep in self.deps])
+        except Exception as e:
+            self.error = e
+        finally:
+            self.seconds = time.monotonic() - started
+
+
+class TaskGraph:
+    """Dependency graph of the stages needed to process one image.
+
+    Tasks must be added after their dependencies, so insertion order is
+    always a valid serial execution order.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.tasks = []
+        # Non-fatal problems reported by stages that still produced a result
+        self.errors = []
+        self.remaining = 0
+        self.future = None
+        # Some stages were dropped or killed because the batch was cancelled
+        self.cancelled = False
+        # Optional ScratchSpace whose files the stages pass between them
+        self.scratch = None
+        self._readers = {}
+
+    def add(self, key, fn, deps=(), label=None):
+        task = Task(key, fn, deps, label)
+        for dep in task.deps:
+            dep.dependents.append(task)
+        self.tasks.append(task)
+        self.remaining += 1
+        return task
+
+    def ready_tasks(self):
+        return [t for t in self.tasks if not t.deps]
+
+    def release(self, task):
+        """Scratch files no stage will read any more now that `task` is done.
+
+        Stages may hand on the file they were given (strip returns the
+        normalized PNG), so readers are counted per path, not per task.
+        MemoryRasters are counted the same way and their bytes dropped here.
+        """
+        result = task.result
+        in_memory = isinstance(result, MemoryRaster)
+        if task.dependents and (
+            in_memory or self.scratch is not None and self.scratch.owns(result)
+        ):
+            if result not in self._readers and not in_memory:
+                self.scratch.track(result)
+            self._readers[result] = self._readers.get(result, 0) + len(task.dependents)
+        free = []
+        for dep in task.deps:
+            if dep.result in self._readers:
+                self._readers[dep.result] -= 1
+                if not self._readers[dep.result]:
+                    del self._readers[dep.result]
+                    if isinstance(dep.result, MemoryRaster):
+                        dep.result.data = None
+                    else:
+                        free.append(dep.result)
+        return free
+
+    def run(self):
+        """Run every task serially on the calling thread."""
+        for task in self.tasks:
+            task.run()
+        return self
+
+
+class TaskScheduler:
+    """Runs the tasks of many TaskGraphs on one shared pool of worker threads.
+
+    Ready tasks are queued by (graph priority, submission order), so stages of
+    an image that started earlier run first while independent stages of the
+    same image (resizes, per-format encodes) spread across idle workers.
+    """
+
+    def __init__(self, workers, control=None):
+        self.workers = max(1, int(workers))
+        # Optional BatchControl: workers hold off while paused and skip
+        # every queued task once cancelled
+        self.control = control
+        self._queue = queue.PriorityQueue()
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"mmio-worker-{i}")
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # Left by an exception such as a second Ctrl+C: kill running tools
+        # rather than waiting for them
+        if exc_type is not None and self.control:
+            self.control.cancel()
+        self.shutdown()
+
+    def submit(self, graph, priority=0):
+        """Schedule a graph; the returned Future resolves to the finished graph."""
+        graph.future = Future()
+        graph.priority = priority
+        if not graph.tasks:
+            graph.future.set_result(graph)
+            return graph.future
+        for task in graph.ready_tasks():
+            self._enqueue(graph, task)
+        return graph.future
+
+    @property
+    def queued(self):
+        """Ready tasks waiting for a worker."""
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True):
+        for _ in self._threads:
+            self._queue.put((float("inf"), next(self._seq), None, None))
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _enqueue(self, graph, task):
+        self._queue.put((graph.priority, next(self._seq), graph, task))
+
+    def _worker(self):
+        while True:
+            _, _, graph, task = self._queue.get()
+            if task is None:
+                return
+            if self.control:
+                self.control.running.wait()
+                if self.control.cancelled.is_set():
+                    task.skipped = True
+                    graph.cancelled = True
+                    self._task_done(graph, task)
+                    continue
+            task.run()
+            self._task_done(graph, task)
+
+    def _task_done(self, graph, task):
+        ready = []
+        free = []
+        finished = False
+        with self._lock:
+            stack = [task]
+            while stack:
+                done = stack.pop()
+                free.extend(graph.release(done))
+                graph.remaining -= 1
+                for dependent in done.dependents:
+                    dependent.pending -= 1
+                    if dependent.pending:
+                        continue
+                    if any(dep.failed for dep in dependent.deps):
+                        # Nothing to run; cascade the skip without a worker
+                        dependent.skipped = True
+                        stack.append(dependent)
+                    else:
+                        ready.append(dependent)
+            finished = graph.remaining == 0
+        for path in free:
+            graph.scratch.delete(path)
+        for dependent in ready:
+            self._enqueue(graph, dependent)
+        if finished:
+            graph.future.set_result(graph)
+
+
+class ScratchSpace:
+    """Scratch folder of a batch, with one subfolder per image.
+
+    An intermediate is deleted as soon as the last stage reading it is done
+    (see TaskGraph.release) and an image's subfolder once its graph is. The
+    quota caps the bytes admitted images may need, estimated up front like
+    their memory; BatchProcessor.admit_next waits while it is used up.
+
+    `root` is created if missing and removed by close(), so a shared folder
+    such as /tmp should be given as `parent`, which gets a private subfolder.
+    """
+
+    def __init__(self, root=None, parent=None, quota=None):
+        if parent is not None:
+            Path(parent).mkdir(parents=True, exist_ok=True)
+            root = tempfile.mkdtemp(prefix="mmio-", dir=robust_path(parent))
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        if quota is None:
+            quota = shutil.disk_usage(robust_path(self.root)).free // 2
+        self.quota = quota
+        self.reserved = 0
+        self.used = 0
+        self.peak = 0
+        self.sizes = {}
+        self._lock = threading.Lock()
+
+    def image_dir(self, index):
+        path = self.root / f"img_{index}"
+        path.mkdir(exist_ok=True)
+        return path
+
+    def owns(self, path):
+        """Whether path is an intermediate in one of the image subfolders."""
+        return isinstance(path, Path) and path.parent.parent == self.root
+
+    @staticmethod
+    def estimate(footprint):
+        """Scratch bytes an image needs, from its estimate_footprint bytes.
+
+        Intermediates are 8-bit and uncompressed: the normalized raster plus
+        downscales, which together rarely exceed it again.
+        """
+        return footprint // MAGICK_SAMPLE_BYTES * 2
+
+    def fits(self, nbytes):
+        with self._lock:
+            return self.reserved + nbytes <= self.quota
+
+    def reserve(self, nbytes):
+        with self._lock:
+            self.reserved += nbytes
+
+    def unreserve(self, nbytes):
+        with self._lock:
+            self.reserved -= nbytes
+
+    def track(self, path):
+        """Count a stage's output towards the space in use."""
+        try:
+            size = os.stat(robust_path(path)).st_size
+        except OSError:
+            return
+        with self._lock:
+            self.sizes[path] = size
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def delete(self, path):
+        with contextlib.suppress(OSError):
+            os.remove(robust_path(path))
+        with self._lock:
+            self.used -= self.sizes.pop(path, 0)
+
+    def drop(self, image_dir):
+        """Remove an image's subfolder with whatever its stages left behind."""
+        shutil.rmtree(robust_path(image_dir), ignore_errors=True)
+        with self._lock:
+            for path in [p for p in self.sizes if p.parent == image_dir]:
+                self.used -= self.sizes.pop(path)
+
+    def close(self):
+        shutil.rmtree(robust_path(self.root), ignore_errors=True)
+
+
+class MemoryRaster:
+    """An intermediate held in memory and piped to the stages that read it."""
+
+    def __init__(self, data, raster):
+        self.data = data
+        # ImageMagick format of data, "png" or "pam"
+        self.raster = raster
+
+
+# Filter for all downscales, applied in linear light
+RESIZE_FILTER = "RobidouxSharp"
+
+# Rasters passed between stages; see ImageProcessor.raster_for
+#   auto: PAM for encoders that read it, else PNG without compression
+#   png0: PNG without compression everywhere
+#   png:  ImageMagick's default zlib-compressed PNG
+INTERMEDIATE_FORMATS = ["auto", "png0", "png"]
+# Intermediates are read back once, right away: zlib there is wasted work
+PNG_STORED = [
+    "-define",
+    "png:compression-level=0",
+    "-define",
+    "png:compression-filter=0",
+]
+# Output formats whose encoder may read a PAM intermediate. PAM carries no
+# ICC profile, so only encoders that drop profiles anyway (cwebp) qualify
+PAM_OUTPUTS = ["WebP"]
+# Images whose intermediates would take at most this many bytes pass them
+# between stages in memory instead of scratch files; 0 always uses files
+DEFAULT_STREAM_LIMIT = 32 << 20
+# Bytes per pixel assumed for that: RGBA at up to 16 bits
+RASTER_PIXEL_BYTES = 8
+
+
+class ImageProcessor:
+    @staticmethod
+    def is_invalid_windows_filename(filename):
+        # Forbidden characters
+        forbidden = set('<>:"/\\|?*')
+        reserved = (
+            {"CON", "PRN", "AUX", "NUL"}
+            | {f"COM{i}" for i in range(1, 10)}
+            | {f"LPT{i}" for i in range(1, 10)}
+        )
+        # Remove extension for reserved check
+        name, *_ = filename.split(".")
+        # Check forbidden chars or reserved names
+        if any(c in forbidden for c in filename):
+            return True
+        if name.upper() in reserved:
+            return True
+        # Control chars
+        if any(ord(c) < 32 for c in filename):
+            return True
+        # Trailing space or dot
+        if filename.endswith(" ") or filename.endswith("."):
+            return True
+        # Only spaces or dots
+        if filename.strip(" .") == "":
+            return True
+        return False
+
+    """Class to handle individual image processing with GPU support"""
+
+    def __init__(
+        self,
+        use_gpu=False,
+        lanes=None,
+        timeouts=None,
+        retry_faster=True,
+        stats=None,
+        cache=None,
+        resize_cache=None,
+        intermediate="auto",
+        stream_limit=DEFAULT_STREAM_LIMIT,
+    ):
+        self.use_gpu = use_gpu
+        # Optional ResourceLanes shared by every call this processor makes
+        self.lanes = lanes
+        # Per-tool watchdog limits in seconds, overriding TOOL_TIMEOUTS
+        self.timeouts = dict(timeouts or {})
+        # Re-run a timed-out encode once with a faster preset
+        self.retry_faster = retry_faster
+        # Optional FileStats that receives run-level counters
+        self.stats = stats
+        # Optional Speculator that may race slow encodes; set per batch
+        self.speculator = None
+        # Optional OutputCache consulted before every encode
+        self.cache = cache
+        # Optional IntermediateCache of normalized and resized PNGs
+        self.resize_cache = resize_cache
+        # One of INTERMEDIATE_FORMATS
+        self.intermediate = intermediate
+        # Largest intermediate kept in memory; see DEFAULT_STREAM_LIMIT
+        self.stream_limit = stream_limit
+        # Per-thread flag: the last encode fell back to a faster preset
+        self.local = threading.local()
+        # Optional Journal that records every finished output; set per batch
+        self.journal = None
+        # Optional BatchControl that cancels or pauses every call
+        self.control = None
+        # Optional Catalog of input headers; set per batch
+        self.catalog = None
+        self.errors = []
+
+    def bump(self, name, amount=1):
+        if self.stats is not None:
+            self.stats.bump(name, amount)
+
+    def call(
+        self, cmd, use_gpu=False, faster=None, output=None, source=None, capture=False
+    ):
+        """Run a tool through the processor's resource lanes and watchdog.
+
+        If it times out and `faster` is given, that command is tried once
+        instead, with the same limit. When `output` and `source` are given
+        too, a speculator may race a slow call against `faster`. Either way
+        the output came from `faster`, which marks it degraded.
+
+        A MemoryRaster `source` is piped to the tool's stdin; `capture` keeps
+        its stdout, see call().
+        """
+        timeout = self.timeouts.get(tool_name(cmd[0]))
+        data = source.data if isinstance(source, MemoryRaster) else None
+        try:
+            header = None
+            if self.speculator and faster and output and source:
+                header = read_image_header(source)
+            if header:
+                pixels = header[0] * header[1]
+                result, degraded = self.speculator.run(
+                    cmd, faster, output, pixels, use_gpu, timeout, data
+                )
+                if degraded:
+                    self.local.degraded = True
+                return result
+            return call(
+                cmd,
+                use_gpu=use_gpu,
+                lanes=self.lanes,
+                timeout=timeout,
+                control=self.control,
+                input=data,
+                capture=capture,
+            )
+        except ToolTimeoutError:
+            if not (self.retry_faster and faster):
+                raise
+            self.bump("fast_retries")
+        self.local.degraded = True
+        return call(
+            faster,
+            use_gpu=use_gpu,
+            lanes=self.lanes,
+            timeout=timeout,
+            control=self.control,
+            input=data,
+            capture=capture,
+        )
+
+    def cached(self, in_png, out_path, commands, encode):
+        """Run `encode` unless the output cache already has its result.
+
+        `commands` are the argument lists `encode` runs, used for the cache
+        key. Outputs made with a faster fallback preset are not cached.
+        """
+        if self.cache is None:
+            return encode()
+        key = self.cache.key(in_png, out_path, commands)
+        if self.cache.fetch(key, out_path):
+            return None
+        self.local.degraded = False
+        encode()
+        if not self.local.degraded:
+            self.cache.store(key, out_path)
+
+    def thread_args(self, tool):
+        """Explicit thread-count flags matching the tool's lane weight."""
+        if self.lanes is None:
+            return []
+        return TOOLS.thread_args(tool, self.lanes.threads(tool))
+
+    def check_filename(self, file_path):
+        """Return an error message if the file name is unusable on Windows."""
+        if platform.system() == "Windows":
+            # Normalize Unicode to NFC
+            norm_name = unicodedata.normalize("NFC", file_path.name)
+            if self.is_invalid_windows_filename(norm_name):
+                return f"Invalid or reserved file name: {file_path.name}"
+        return None
+
+    def build_image_graph(
+        self,
+        file_path,
+        tmp_dir,
+        base_name,
+        resolutions,
+        formats,
+        qmap,
+        qlossless_map,
+        strip_meta,
+        output_dir,
+        plan=None,
+    ):
+        """Split the work for one image into a TaskGraph of independent stages.
+
+        normalize -> (strip) -> one resize per resolution -> one encode per
+        (resolution, format). Encodes of different formats and resolutions
+        only depend on their own resize, so they can run in parallel.
+
+        Resolutions with the same effective pixels, such as sizes that would
+        upscale and so keep the original ones, share one resize and one
+        encode per format; their other outputs are linked to that encode.
+
+        plan maps (size, format) to the output path from an OutputPlanner,
+        or None for a skipped output. Stages that only feed skipped outputs
+        are left out. Without a plan every output is written under base_name.
+        """
+        graph = TaskGraph(file_path.name)
+        graph.file_path = file_path
+        graph.original_size = 0
+
+        error = self.check_filename(file_path)
+        if error:
+            graph.errors.append(error)
+            return graph
+        graph.original_size = file_path.stat().st_size
+
+        if plan is None:
+            plan = output_paths(output_dir, base_name, resolutions, formats)
+        variants = {}
+        for res in resolutions:
+            outputs = [
+                (fmt, plan[(res["size"], fmt)])
+                for fmt in FORMATS
+                if fmt in formats and plan.get((res["size"], fmt))
+            ]
+            if outputs:
+                variants[res["size"]] = outputs
+        resolutions = [res for res in resolutions if res["size"] in variants]
+        if not resolutions:
+            return graph
+
+        def strip(normalized):
+            try:
+                self.strip_metadata(normalized)
+            except Exception as e:
+                graph.errors.append(f"Metadata strip failed: {file_path.name} ({e})")
+            return normalized
+
+        # Dimensions come from the catalog instead of a probe per resize
+        info = None
+        if self.catalog:
+            info = self.catalog.lookup(file_path, want_hash=bool(self.resize_cache))
+        dimensions = (info["width"], info["height"]) if info and info["width"] else None
+        if dimensions is None:
+            with contextlib.suppress(Exception):
+                dimensions = get_image_size(robust_path(file_path)).get_dimensions()
+
+        def pixels(res):
+            """What identifies the resize's result, given this input."""
+            entry = ("entry", str(res["size"]), str(res.get("mode")))
+            if dimensions is None and res["size"] != "original":
+                return entry
+            try:
+                geometry = resize_geometry(res, dimensions)
+            except ValueError:
+                return entry  # the resize stage reports it
+            return tuple(geometry) if geometry else ("original",)
+
+        groups = {}
+        for res in resolutions:
+            groups.setdefault(pixels(res), []).append(res)
+
+        # Encoders that read the input's own format get it without a raster
+        # round trip through normalize, for the outputs that keep its pixels
+        native = set()
+        if ("original",) in groups:
+            native = self.native_formats(file_path, info, formats)
+
+        def needs_raster(group):
+            return group != ("original",) or any(
+                fmt not in native
+                for member in groups[group]
+                for fmt, _ in variants[member["size"]]
+            )
+
+        raster_groups = [group for group in groups if needs_raster(group)]
+
+        def readers(group):
+            """Formats encoded from the group's intermediate."""
+            return {
+                fmt
+                for member in groups[group]
+                for fmt, _ in variants[member["size"]]
+                if group != ("original",) or fmt not in native
+            }
+
+        # Each resize writes the intermediate all of its encoders read
+        rasters = {}
+        for group in raster_groups:
+            rasters[group] = (
+                self.raster_for(readers(group)) if group[0] == "-resize" else "png"
+            )
+
+        def prepare(res, raster):
+            """normalize -> (strip) -> resize inline, for a vanished cache entry."""
+            normalized = self.normalize_to_png(
+                file_path, tmp_dir, base_name, strip_meta
+            )
+            if strip_meta:
+                strip(normalized)
+            return self.resize_variant(
+                normalized, tmp_dir, base_name, res, dimensions, raster
+            )
+
+        # Resized intermediates from earlier runs skip normalize and resize
+        cache_keys = {}
+        if self.resize_cache:
+            digest = info and info["hash"]
+            if not digest:
+                st = file_path.stat()
+                digest = cached_file_hash(
+                    robust_path(file_path), st.st_size, st.st_mtime_ns
+                )
+            for group, raster in rasters.items():
+                cache_keys[group] = self.resize_cache.key(
+                    digest, group, strip_meta, raster
+                )
+        cached = {
+            group for group, key in cache_keys.items() if self.resize_cache.has(key)
+        }
+
+        # Small images pipe their intermediates from stage to stage in memory,
+        # where every reader takes stdin and nothing goes to the cache
+        streamable = bool(
+            self.stream_limit
+            and dimensions
+            and dimensions[0] * dimensions[1] * RASTER_PIXEL_BYTES <= self.stream_limit
+        )
+        streamed = {
+            group
+            for group in raster_groups
+            if streamable
+            and group != ("original",)
+            and group not in cache_keys
+            and all(self.pipes(fmt) for fmt in readers(group))
+        }
+        # A strip rewrites the normalized file in place, so that stays one,
+        # as does a normalized PNG that goes to the cache as the original size
+        original = ("original",)
+        stream_normalized = (
+            streamable
+            and not strip_meta
+            and (
+                original not in raster_groups
+                or original in cached
+                or (
+                    original not in cache_keys
+                    and all(self.pipes(fmt) for fmt in readers(original))
+                )
+            )
+        )
+
+        source = None
+        if any(group not in cached for group in raster_groups):
+            source = graph.add(
+                "normalize",
+                lambda: self.normalize_to_png(
+                    file_path, tmp_dir, base_name, strip_meta, stream_normalized
+                ),
+                label=f"Normalize to PNG failed: {file_path.name}",
+            )
+            if strip_meta:
+                source = graph.add("strip", strip, deps=[source])
+
+        native_source = None
+        if native:
+
+            def read_natively():
+                staged = self.stage_input(
+                    file_path,
+                    tmp_dir / f"{base_name}_native{file_path.suffix.lower()}",
+                    writable=strip_meta,
+                )
+                self.bump("native_inputs")
+                return strip(staged) if strip_meta else staged
+
+            native_source = graph.add(
+                "native",
+                read_natively,
+                label=f"Staging input failed: {file_path.name}",
+            )
+
+        for group, members in groups.items():
+            res = members[0]
+            size = res["size"]
+            key = cache_keys.get(group)
+            raster = rasters.get(group)
+            if group not in raster_groups:
+                resized = None
+            elif group in cached:
+                resized = graph.add(
+                    ("resize", size),
+                    lambda res=res, key=key, raster=raster: self.cached_intermediate(
+                        key, tmp_dir, base_name, res, raster, prepare
+                    ),
+                    label=f"Resize failed: {file_path.name}",
+                )
+            else:
+                resized = graph.add(
+                    ("resize", size),
+                    lambda normalized, res=res, key=key, raster=raster, group=group: (
+                        self.resize_and_cache(
+                            normalized,
+                            tmp_dir,
+                            base_name,
+                            res,
+                            key,
+                            graph,
+                            dimensions,
+                            raster,
+                            group in streamed,
+                        )
+                    ),
+                    deps=[source],
+                    label=f"Resize failed: {file_path.name}",
+                )
+            encoded = {}
+            for member in members:
+                size = member["size"]
+                for fmt, out_path in variants[size]:
+                    if fmt in encoded:
+                        first, first_path = encoded[fmt]
+                        args = (
+                            file_path,
+                            graph.original_size,
+                            first_path,
+                            (size, fmt),
+                            out_path,
+                        )
+                        link = graph.add(
+                            ("encode", size, fmt),
+                            lambda _, args=args: self.link_variant(*args),
+                            deps=[first],
+                            label=f"{fmt}: {out_path.name}",
+                        )
+                        link.output = out_path
+                        continue
+                    reads_input = group == ("original",) and fmt in native
+                    encode = graph.add(
+                        ("encode", size, fmt),
+                        lambda source_png, fmt=fmt, size=size, out_path=out_path: (
+                            self.encode_logged(
+                                file_path,
+                                graph.original_size,
+                                fmt,
+                                source_png,
+                                size,
+                                out_path,
+                                qmap,
+                                qlossless_map,
+                            )
+                        ),
+                        deps=[native_source if reads_input else resized],
+                        label=f"{fmt}: {out_path.name}",
+                    )
+                    encode.output = out_path
+                    encoded[fmt] = (encode, out_path)
+        return graph
+
+    def cached_intermediate(self, key, tmp_dir, base_name, res, raster, prepare):
+        """Resize stage served from the intermediate cache."""
+        out_path = tmp_dir / f"{base_name}_{res['size']}.{raster}"
+        try:
+            return self.resize_cache.fetch_intermediate(key, out_path)
+        except OSError:
+            # Evicted since the graph was built
+            return prepare(res, raster)
+
+    def resize_and_cache(
+        self,
+        normalized,
+        tmp_dir,
+        base_name,
+        res,
+        key,
+        graph,
+        dimensions=None,
+        raster="png",
+        stream=False,
+    ):
+        """Resize stage that adds its result to the intermediate cache."""
+        resized = self.resize_variant(
+            normalized, tmp_dir, base_name, res, dimensions, raster, stream
+        )
+        # A failed metadata strip must not be cached as a stripped result
+        if key and not graph.errors:
+            self.resize_cache.store_intermediate(key, resized)
+        return resized
+
+    def collect_stats(self, graph):
+        """Turn a finished image graph into FileStats."""
+        stats = FileStats()
+        errors = list(graph.errors)
+        for task in graph.tasks:
+            if isinstance(task.error, ToolCancelledError):
+                # Not a failure of the image; cancelling was asked for
+                graph.cancelled = True
+            elif task.error is not None:
+                errors.append(f"{task.label} ({task.error})")
+            elif (
+                isinstance(task.key, tuple)
+                and task.key[0] == "encode"
+                and task.result is not None
+            ):
+                stats.add_file(graph.original_size, task.result)
+        stats.errors = errors
+        stats.timeouts = [
+            f"{task.label} ({task.error})"
+            for task in graph.tasks
+            if isinstance(task.error, ToolTimeoutError)
+        ]
+        return stats
+
+    def process_single_image(
+        self,
+        file_path,
+        tmp_dir,
+        base_name,
+        resolutions,
+        formats,
+        qmap,
+        qlossless_map,
+        strip_meta,
+        output_dir,
+    ):
+        """Process a single image serially and return statistics"""
+        graph = self.build_image_graph(
+            file_path,
+            tmp_dir,
+            base_name,
+            resolutions,
+            formats,
+            qmap,
+            qlossless_map,
+            strip_meta,
+            output_dir,
+        )
+        return self.collect_stats(graph.run())
+
+    def strip_metadata(self, path):
+        # Strip metadata using exiftool
+        self.call([EXIFTOOL, "-all=", "-overwrite_original", str(path)])
+
+    def encode_logged(
+        self, file_path, original_size, fmt, source_png, size, out_path, *maps
+    ):
+        """encode_variant, then record the finished output in the journal."""
+        out_bytes = self.encode_variant(fmt, source_png, size, out_path, *maps)
+        if self.journal:
+            self.journal.done(file_path, (size, fmt), out_bytes, original_size)
+        return out_bytes
+
+    def link_variant(self, file_path, original_size, source, variant, out_path):
+        """Materialize an output with the same pixels and format as source."""
+        self.bump(f"collapsed_{link_or_copy(source, out_path)}")
+        out_bytes = out_path.stat().st_size
+        if self.journal:
+            self.journal.done(file_path, variant, out_bytes, original_size)
+        return out_bytes
+
+    def encode_variant(self, fmt, source_png, size, out_path, qmap, qlossless_map):
+        """Encode one (resolution, format) output; returns its size.
+
+        The encoders write to a partial file that replaces out_path only once
+        it is complete, so an interrupted run never leaves a truncated output.
+        """
+        final_path, out_path = out_path, partial_path(out_path)
+        try:
+            self.encode_to(fmt, source_png, out_path, qmap, qlossless_map)
+            os.replace(robust_path(out_path), robust_path(final_path))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(robust_path(out_path))
+            raise
+        return final_path.stat().st_size
+
+    def encode_to(self, fmt, source_png, out_path, qmap, qlossless_map):
+        if fmt == "PNG":
+            self.encode_png(
+                robust_path(source_png),
+                robust_path(out_path),
+                qmap.get("PNG", 82),
+                qlossless_map.get("PNG", True),
+            )
+        elif fmt == "WebP":
+            self.encode_webp(
+                robust_path(source_png), robust_path(out_path), qmap.get("WebP", 82)
+            )
+        elif fmt == "AVIF":
+            self.encode_avif(
+                robust_path(source_png), robust_path(out_path), qmap.get("AVIF", 65)
+            )
+        elif fmt == "JPEG":
+            self.encode_jpegli(
+                robust_path(source_png),
+                robust_path(out_path),
+                qmap.get("JPEG", 82),
+                qlossless_map.get("JPEG", False),
+            )
+        else:
+            raise ValueError(f"Unknown format: {fmt}")
+
+    def png_args(self):
+        """ImageMagick options for writing a PNG intermediate."""
+        return [] if self.intermediate == "png" else PNG_STORED
+
+    def raster_for(self, formats):
+        """Extension of a resized intermediate that encoders of `formats` read."""
+        if self.intermediate == "auto" and all(
+            fmt in PAM_OUTPUTS and TOOLS.reads(FORMAT_TOOLS[fmt][0], "PAM")
+            for fmt in formats
+        ):
+            return "pam"
+        return "png"
+
+    def pipes(self, fmt):
+        """Whether the encoder of `fmt` reads its input from stdin."""
+        tool = FORMAT_TOOLS[fmt][0]
+        return tool_name(tool) in STDIN_ARGS and TOOLS.info(tool)["stdin"]
+
+    def source_args(self, tool, source):
+        """Arguments naming a stage's input: its path, or stdin for a MemoryRaster."""
+        if not isinstance(source, MemoryRaster):
+            return [robust_path(source)]
+        if tool == "magick":
+            return [f"{source.raster}:-"]
+        return STDIN_ARGS[tool]
+
+    def call_to_memory(self, cmd, raster, source=None):
+        """Run an ImageMagick command writing `raster` to stdout; its MemoryRaster."""
+        data = self.call(cmd, use_gpu=self.use_gpu, source=source, capture=True).stdout
+        self.bump("streamed_rasters")
+        self.bump("stream_bytes", len(data))
+        return MemoryRaster(data, raster)
+
+    def stage(self, src, dst, hardlink=True):
+        """link_or_copy for pipeline files, counting the copies it avoided."""
+        count_staging(self.bump, link_or_copy(src, dst, hardlink), dst)
+        return dst
+
+    def stage_input(self, input_path, out_path, writable=False):
+        """input_path itself for stages that only read it, else a copy at out_path.
+
+        The copy is never a hardlink, so rewriting it leaves the input intact.
+        """
+        if not writable:
+            count_staging(self.bump, "direct", input_path)
+            return input_path
+        return self.stage(input_path, out_path, hardlink=False)
+
+    def native_formats(self, file_path, info, formats):
+        """Output formats whose encoder reads this input without normalizing it.
+
+        Only single-frame inputs qualify, and JPEGs only in 8-bit gray or
+        YCbCr; the encoders mishandle CMYK JPEGs.
+        """
+        info = info or probe_image(file_path)
+        input_format = info["format"]
+        if input_format not in ("JPEG", "TIFF", "WEBP") or (info["frames"] or 1) > 1:
+            return set()
+        if input_format == "JPEG" and jpeg_components(file_path) not in (1, 3):
+            return set()
+        return {
+            fmt
+            for fmt in formats
+            if fmt != "PNG" and TOOLS.reads(FORMAT_TOOLS[fmt][0], input_format)
+        }
+
+    def normalize_to_png(
+        self, input_path, tmp_dir, base_name, writable=False, stream=False
+    ):
+        """The input as a PNG the later stages can read.
+
+        A PNG input is read in place unless `writable`, i.e. a metadata strip
+        will rewrite the result; then it gets its own copy-on-write or copy.
+        Other inputs are converted, with `stream` into a MemoryRaster.
+        """
+        out_png = tmp_dir / f"{base_name}_norm.png"
+        if input_path.suffix.lower() == ".png":
+            return self.stage_input(input_path, out_png, writable)
+        cmd = [
+            MAGICK,
+            *self.thread_args("magick"),
+            robust_path(input_path),
+            *self.png_args(),
+            "png:-" if stream else robust_path(out_png),
+        ]
+        if stream:
+            return self.call_to_memory(cmd, "png")
+        self.call(cmd, use_gpu=self.use_gpu)
+        return out_png
+
+    def sort_res_modes(self, res_modes):
+        def key_fn(r):
+            size = r.get("size")
+            if isinstance(size, str) and size.endswith("%"):
+                return float(size.rstrip("%"))
+            try:
+                return float(size)
+            except (TypeError, ValueError):
+                return float("inf")
+
+        return sorted(res_modes, key=key_fn, reverse=True)
+
+    def generate_resized_variants(
+        self,
+        input_path,
+        tmp_dir,
+        base_name,
+        res_modes,
+    ):
+        """Generate independent resized copies from the original for maximum quality.
+
+        Args:
+            input_path: Path to original image.
+            tmp_dir: Temporary directory for outputs.
+            base_name: Base filename without extension.
+            res_modes: List of dicts like [{'size': 256, 'mode': 'fit'}, {'size': '50%', 'mode': 'crop'}].
+
+        Returns:
+            Dict of {size_key: output_path} for successful resizes.
+
+        Raises:
+            ValueError: If invalid resize parameters.
+        """
+        intermediates = {}
+
+        # Sort modes descending (largest first) for potential future optimizations
+        for r in self.sort_res_modes(res_modes):
+            try:
+                out_path = self.resize_variant(input_path, tmp_dir, base_name, r)
+            except subprocess.CalledProcessError as e:
+                # Robust: Skip and log instead of crashing
+                self.errors.append(f"Error resizing to {r['size']}: {e}")
+                continue
+            if out_path is not None:
+                key = r["size"]
+                if key != "original":
+                    key = validate_resize_input(key)
+                intermediates[key] = out_path
+
+        return intermediates
+
+    def resize_variant(
+        self,
+        input_path,
+        tmp_dir,
+        base_name,
+        r,
+        dimensions=None,
+        raster="png",
+        stream=False,
+    ):
+        """Produce one resized copy of input_path for a res_modes entry.
+
+        An entry that would not downscale returns input_path itself.
+        `dimensions` are the input's (width, height) if already known;
+        `raster` is the extension to write, "png" or "pam". With `stream`
+        the copy is a MemoryRaster; input_path may be one as well.
+
+        Raises:
+            ValueError: If invalid resize parameters.
+        """
+        geometry = None
+        if r.get("size") != "original":
+            # Get original dimensions (header only, avoids a full decode)
+            try:
+                dimensions = (
+                    dimensions
+                    or get_image_size(robust_path(input_path)).get_dimensions()
+                )
+            except Exception as e:
+                raise ValueError(f"Failed to get original dimensions: {e}")
+            geometry = resize_geometry(r, dimensions)
+
+        if geometry is None:
+            # Encoders only read their source, so no copy is needed
+            if not isinstance(input_path, MemoryRaster):
+                count_staging(self.bump, "direct", input_path)
+            return input_path
+
+        size = validate_resize_input(r["size"])
+        out_path = tmp_dir / f"{base_name}_{size}.{raster}"
+        # cwebp only reads 8-bit PAM; it would reduce a deeper PNG to 8 bits too
+        write_args = ["-depth", "8"] if raster == "pam" else self.png_args()
+
+        cmd = [
+            MAGICK,
+            *self.thread_args("magick"),
+            *self.source_args("magick", input_path),
+            "-colorspace",
+            "RGB",
+            "-filter",
+            RESIZE_FILTER,  # Your high-quality filter
+            *geometry,
+            "-colorspace",
+            "sRGB",
+            *write_args,
+            f"{raster}:-" if stream else robust_path(out_path),
+        ]
+        if stream:
+            return self.call_to_memory(cmd, raster, source=input_path)
+        self.call(cmd, use_gpu=self.use_gpu, source=input_path)
+        return out_path
+
+    def encode_webp(self, in_png, out_path, quality):
+        cmd = [
+            CWEBP,
+            "-q",
+            str(quality),
+            "-o",
+            robust_path(out_path),
+            *self.source_args("cwebp", in_png),
+        ]
+        self.cached(
+            in_png,
+            out_path,
+            [cmd],
+            lambda: self.call(
+                cmd,
+                faster=[*cmd[:3], "-m", "1", *cmd[3:]],
+                output=robust_path(out_path),
+                source=in_png,
+            ),
+        )
+
+    def encode_avif(self, in_png, out_path, quality):
+        cmd = [
+            AVIFENC,
+            "-q",
+            str(quality),
+            "--speed",
+            "2",
+            *self.thread_args("avifenc"),
+            robust_path(in_png),
+            robust_path(out_path),
+        ]
+        self.cached(
+            in_png,
+            out_path,
+            [cmd],
+            lambda: self.call(
+                cmd,
+                faster=replace_option(cmd, "--speed", "8"),
+                output=robust_path(out_path),
+                source=in_png,
+            ),
+        )
+
+    def encode_jpegli(
+        self, in_png, out_path, quality=None, lossless=False, chroma_444=False
+    ):
+        """Encode JPEG with jpegli (cjpegli) CLI."""
+        cmd = [
+            str(CJPEGLI),
+            *self.source_args("cjpegli", in_png),
+            robust_path(out_path),
+        ]
+
+        if lossless:
+            cmd += ["--distance", "1.0"]
+        elif quality is not None:
+            cmd += ["--quality", str(quality)]
+        else:
+            cmd += ["--quality", "82"]
+
+        if chroma_444:
+            cmd += ["--chroma_subsampling=444"]
+
+        # Remove empty strings (for safety)
+        cmd = [arg for arg in cmd if arg]
+
+        self.cached(in_png, out_path, [cmd], lambda: self.call(cmd, source=in_png))
+
+    def encode_png(self, in_png, out_path, quality=None, lossless=True):
+        commands = self.png_commands(in_png, out_path, quality, lossless)
+        self.cached(
+            in_png,
+            out_path,
+            commands,
+            lambda: self.run_png_commands(in_png, out_path, *commands),
+        )
+
+    def png_commands(self, in_png, out_path, quality, lossless):
+        """oxipng command, plus a pngquant one when lossy."""
+        oxi_cmd = [
+            OXIPNG,
+            "--opt",
+            "max",
+            "--zopfli",
+            "--force",
+            "--out",
+            robust_path(out_path),
+            *self.source_args("oxipng", in_png),
+            "--timeout",
+            "30",
+            "--interlace",
+            "0",
+            *self.thread_args("oxipng"),
+        ]
+        if lossless:
+            return [oxi_cmd]
+        oxi_cmd.append("--scale16")
+
+        # If not lossless, use pngquant for further optimization
+        if quality is None:
+            quality = 82
+        pq_cmd = [
+            PNGQUANT,
+            "--quality",
+            f"{max(quality - 15, 50)}-{quality}",
+            "--speed",
+            "1",
+            "--output",
+            robust_path(out_path),
+            "--force",
+            robust_path(out_path),
+        ]
+        return [oxi_cmd, pq_cmd]
+
+    def run_png_commands(self, in_png, out_path, oxi_cmd, pq_cmd=None):
+        # Without zopfli at a medium level oxipng is many times faster
+        faster = replace_option(oxi_cmd, "--opt", "2")
+        self.call(
+            oxi_cmd,
+            faster=[arg for arg in faster if arg != "--zopfli"],
+            output=robust_path(out_path),
+            source=in_png,
+        )
+        if pq_cmd:
+            self.call(pq_cmd, faster=replace_option(pq_cmd, "--speed", "10"))
+
+
+# Batch ordering policies; see order_image_files
+SCHEDULING_POLICIES = ["discovery", "largest", "smallest", "interleaved"]
+
+
+# PNG color type -> channels (palettes are expanded to RGB on decode)
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+
+def read_image_header(path):
+    """(width, height, channels, bits per channel) from the file header, or None.
+
+    PNG, PAM and PSD/PSB headers carry the real channel count and bit depth; other
+    formats get their dimensions from pymage_size and are assumed 8-bit RGBA.
+    `path` may also be a MemoryRaster.
+    """
+    if isinstance(path, MemoryRaster):
+        head = path.data[:128]
+    else:
+        try:
+            with open(robust_path(path), "rb") as f:
+                head = f.read(128)
+        except OSError:
+            return None
+    if head[:3] == b"P7\n":
+        fields = dict(
+            line.split(None, 1)
+            for line in head.decode("ascii", "replace").splitlines()[1:]
+            if " " in line
+        )
+        try:
+            return (
+                int(fields["WIDTH"]),
+                int(fields["HEIGHT"]),
+                int(fields["DEPTH"]),
+                8 if int(fields["MAXVAL"]) < 256 else 16,
+            )
+        except (KeyError, ValueError):
+            return None
+    if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+        width, height, depth, color = struct.unpack(">IIBB", head[16:26])
+        return width, height, PNG_CHANNELS.get(color, 4), depth
+    if head[:4] == b"8BPS" and len(head) >= 26:
+        channels, height, width, depth = struct.unpack(">HIIH", head[12:26])
+        return width, height, channels, depth
+    try:
+        width, height = get_image_size(robust_path(path)).get_dimensions()
+        return width, height, 4, 8
+    except Exception:
+        return None
+
+
+# ImageMagick 7 defaults to a Q16 HDRI build: every channel of the pixel
+# cache is a 4-byte float, whatever the depth of the source file
+MAGICK_SAMPLE_BYTES = 4
+
+
+def estimate_footprint(path, header=False):
+    """(pixels, bytes) one image needs once decoded; pixels is 0 if unknown.
+
+    `header` is the result of read_image_header if the caller has it.
+    Without a readable header the file size stands in for the footprint,
+    which still ranks huge files above small ones.
+    """
+    if header is False:
+        header = read_image_header(path)
+    if header is None:
+        try:
+            return 0, Path(path).stat().st_size
+        except OSError:
+            return 0, 0
+    width, height, channels, depth = header
+    pixels = width * height
+    sample_bytes = max(MAGICK_SAMPLE_BYTES, (depth + 7) // 8)
+    return pixels, pixels * max(channels, 1) * sample_bytes
+
+
+# Inputs above this many pixels are rejected before anything decodes them
+MAX_PIXELS = 1_000_000_000
+# How long small images may keep overtaking one that doesn't fit the
+# memory budget before admission stops so the big one can drain in
+ADMISSION_BYPASS_SECONDS = 10.0
+# How far past a blocked image the admission loop looks for smaller ones
+ADMISSION_LOOKAHEAD = 64
+
+
+def default_memory_budget():
+    """Half of the memory available right now, or 4 GiB if that's unknown."""
+    memory = read_memory()
+    return memory[0] // 2 if memory else 4 << 30
+
+
+# --- Incremental manifest ---
+MANIFEST_NAME = ".mmio-manifest.json"
+# Encoders whose version affects the output of each format
+FORMAT_TOOLS = {
+    "WebP": [CWEBP],
+    "AVIF": [AVIFENC],
+    "JPEG": [CJPEGLI],
+    "PNG": [OXIPNG, PNGQUANT],
+}
+
+
+def settings_hash(formats, resolutions, qmap, qlossless_map, strip_meta):
+    """Short hash of everything besides the input that shapes the outputs."""
+    tools = [MAGICK, EXIFTOOL] if strip_meta else [MAGICK]
+    for fmt in formats:
+        tools.extend(FORMAT_TOOLS.get(fmt, []))
+    settings = {
+        "formats": sorted(formats),
+        "resolutions": resolutions,
+        "quality": {fmt: qmap.get(fmt) for fmt in formats},
+        "lossless": {fmt: qlossless_map.get(fmt) for fmt in formats},
+        "strip_meta": bool(strip_meta),
+        "tools": {tool_name(t): tool_version(t) for t in tools},
+    }
+    encoded = json.dumps(settings, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """BLAKE2b digest of a file's content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(robust_path(path), "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Which inputs were turned into which outputs, with which settings.
+
+    Stored as JSON in the output folder and keyed on the absolute input path.
+    An input is current when its size and mtime match the entry (or, with
+    hash_inputs, its content hash does), the settings hash matches and all
+    of its outputs still exist.
+    """
+
+    VERSION = 1
+
+    def __init__(self, output_dir, settings, hash_inputs=False):
+        self.path = Path(output_dir) / MANIFEST_NAME
+        self.output_dir = Path(output_dir)
+        self.settings = settings
+        self.hash_inputs = hash_inputs
+        self.entries = {}
+        # Stat (and hash) taken when an input was found to be out of date
+        self.fresh = {}
+        self._lock = threading.Lock()
+        try:
+            with open(robust_path(self.path), encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.entries = data.get("entries", {})
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    @staticmethod
+    def key(file_path):
+        return os.path.normcase(os.path.abspath(file_path))
+
+    def is_current(self, file_path, digest=None):
+        """True if the input can be skipped; otherwise remember its new state.
+
+        `digest` is the input's file_hash if the caller already computed it.
+        An input that can't be read counts as changed, and nothing is
+        remembered for it.
+        """
+        key = self.key(file_path)
+        try:
+            st = os.stat(robust_path(file_path))
+            return self._is_current(key, file_path, st, digest)
+        except OSError:
+            return False
+
+    def _is_current(self, key, file_path, st, digest):
+        with self._lock:
+            entry = self.entries.get(key)
+        current = entry is not None and entry.get("settings") == self.settings
+        if current and (st.st_size, st.st_mtime_ns) != (
+            entry.get("size"),
+            entry.get("mtime_ns"),
+        ):
+            # Touched or copied but maybe identical: only a hash can tell
+            if self.hash_inputs and entry.get("hash") and st.st_size == entry["size"]:
+                digest = digest or file_hash(file_path)
+                current = digest == entry["hash"]
+            else:
+                current = False
+        if current:
+            current = all(
+                (self.output_dir / name).exists() for name in entry.get("outputs", [])
+            )
+        if current:
+            return True
+        if self.hash_inputs and digest is None:
+            digest = file_hash(file_path)
+        with self._lock:
+            self.fresh[key] = (st.st_size, st.st_mtime_ns, digest)
+        return False
+
+    def outputs(self, file_path):
+        """Output paths recorded for an input."""
+        with self._lock:
+            entry = self.entries.get(self.key(file_path), {})
+        return [self.output_dir / name for name in entry.get("outputs", [])]
+
+    def record(self, file_path, outputs):
+        """Remember that an input was fully processed into `outputs`."""
+        key = self.key(file_path)
+        with self._lock:
+            fresh = self.fresh.pop(key, None)
+        if fresh is None:
+            return
+        size, mtime_ns, digest = fresh
+        names = []
+        for path in outputs:
+            try:
+                names.append(Path(path).relative_to(self.output_dir).as_posix())
+            except ValueError:
+                names.append(str(path))
+        with self._lock:
+            self.entries[key] = {
+                "size": size,
+                "mtime_ns": mtime_ns,
+                "hash": digest,
+                "settings": self.settings,
+                "outputs": names,
+            }
+
+    def save(self):
+        """Write the manifest atomically next to the outputs."""
+        with self._lock:
+            data = {"version": self.VERSION, "entries": dict(self.entries)}
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(robust_path(tmp_path), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(robust_path(tmp_path), robust_path(self.path))
+
+
+# --- Input catalog ---
+CATALOG_NAME = "catalog.sqlite"
+# Pending catalog rows are written in one transaction once this many pile up
+CATALOG_BATCH = 256
+
+
+def sniff_format(head, path):
+    """Image format from the first bytes of a file, else from its extension."""
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "PNG"
+    if head[:3] == b"\xff\xd8\xff":
+        return "JPEG"
+    if head[:4] == b"GIF8":
+        return "GIF"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "TIFF"
+    if head[:4] == b"8BPS":
+        return "PSD"
+    if head[:2] == b"BM":
+        return "BMP"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in (b"avif", b"avis"):
+            return "AVIF"
+        if brand in (b"heic", b"heix", b"mif1", b"msf1"):
+            return "HEIC"
+    return Path(path).suffix.lstrip(".").upper()
+
+
+def jpeg_components(path):
+    """Color components (1 gray, 3 YCbCr, 4 CMYK) of an 8-bit JPEG, else None."""
+    try:
+        with open(robust_path(path), "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                return None
+            while True:
+                marker = f.read(2)
+                while marker[:1] == b"\xff" and marker[1:] == b"\xff":
+                    marker = marker[1:] + f.read(1)  # fill bytes
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                code = marker[1]
+                if 0xD0 <= code <= 0xD9 or code == 0x01:
+                    continue  # no length field
+                (length,) = struct.unpack(">H", f.read(2))
+                # SOF0-SOF15 except DHT, JPG and DAC
+                if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                    precision, _, _, components = struct.unpack(">BHHB", f.read(6))
+                    return components if precision == 8 else None
+                f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, IndexError, struct.error):
+        return None
+
+
+def png_features(f):
+    """(alpha, frames) from the PNG chunks before the image data."""
+    f.seek(8)
+    alpha = False
+    frames = 1
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            break
+        length, kind = struct.unpack(">I4s", head)
+        if kind == b"IHDR":
+            alpha = f.read(13)[9] in (4, 6)
+            length -= 13
+        elif kind == b"acTL":
+            frames = struct.unpack(">I", f.read(4))[0]
+            length -= 4
+        elif kind == b"tRNS":
+            alpha = True
+        elif kind in (b"IDAT", b"IEND"):
+            break
+        f.seek(length + 4, os.SEEK_CUR)
+    return alpha, frames
+
+
+def gif_features(f):
+    """(alpha, frames) by walking the GIF blocks; pixel data is skipped, not decoded."""
+
+    def skip_sub_blocks():
+        while True:
+            size = f.read(1)
+            if not size or size[0] == 0:
+                return
+            f.seek(size[0], os.SEEK_CUR)
+
+    f.seek(10)
+    flags = f.read(3)[0]
+    if flags & 0x80:
+        f.seek(3 << ((flags & 7) + 1), os.SEEK_CUR)
+    alpha = False
+    frames = 0
+    while True:
+        block = f.read(1)
+        if not block or block == b";":
+            break
+        if block == b"!":
+            label = f.read(1)
+            if label == b"\xf9":
+                gce = f.read(2)
+                alpha = alpha or bool(len(gce) == 2 and gce[1] & 1)
+                f.seek(-len(gce), os.SEEK_CUR)
+            skip_sub_blocks()
+        elif block == b",":
+            frames += 1
+            flags = f.read(9)[-1]
+            if flags & 0x80:
+                f.seek(3 << ((flags & 7) + 1), os.SEEK_CUR)
+            f.seek(1, os.SEEK_CUR)
+            skip_sub_blocks()
+        else:
+            break
+    return alpha, max(frames, 1)
+
+
+def webp_features(f):
+    """(alpha, frames) from the RIFF chunk headers of a WebP file."""
+    f.seek(12)
+    alpha = None
+    frames = 0
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            break
+        kind, length = struct.unpack("<4sI", head)
+        # Chunks are padded to an even size
+        end = f.tell() + length + (length & 1)
+        if kind == b"VP8X":
+            alpha = bool(f.read(1)[0] & 0x10)
+        elif kind == b"VP8L":
+            alpha = bool(f.read(5)[4] & 0x10)
+        elif kind == b"VP8 ":
+            alpha = bool(alpha)
+        elif kind == b"ANMF":
+            frames += 1
+        f.seek(end)
+    return alpha, max(frames, 1)
+
+
+def probe_image(path):
+    """Header facts about an image without decoding it.
+
+    Returns a dict with width, height, channels and depth (None where
+    read_image_header can't tell), format, alpha (None if unknown) and
+    frames.
+    """
+    header = read_image_header(path)
+    width, height, channels, depth = header or (None, None, None, None)
+    info = {
+        "width": width,
+        "height": height,
+        "channels": channels,
+        "depth": depth,
+        "format": Path(path).suffix.lstrip(".").upper(),
+        "alpha": None,
+        "frames": 1,
+    }
+    try:
+        with open(robust_path(path), "rb") as f:
+            info["format"] = fmt = sniff_format(f.read(16), path)
+            if fmt == "PNG":
+                info["alpha"], info["frames"] = png_features(f)
+            elif fmt == "GIF":
+                info["alpha"], info["frames"] = gif_features(f)
+            elif fmt == "WEBP":
+                info["alpha"], info["frames"] = webp_features(f)
+            elif fmt == "JPEG":
+                info["alpha"] = False
+    except (OSError, IndexError, struct.error):
+        pass
+    return info
+
+
+class Catalog:
+    """SQLite catalog of probed input headers, kept across runs.
+
+    Rows are keyed on the absolute input path and reused while the file's
+    size and mtime match, so rescanning an unchanged tree only stats files.
+    The content hash is filled in on first request. New rows are written
+    in batches; call flush() or close() to persist the rest. If the
+    database can't be opened the catalog lives in memory for this run.
+    """
+
+    COLUMNS = (
+        "size",
+        "mtime_ns",
+        "width",
+        "height",
+        "channels",
+        "depth",
+        "format",
+        "alpha",
+        "frames",
+        "hash",
+    )
+
+    def __init__(self, path=None):
+        self.path = Path(path or default_cache_dir() / CATALOG_NAME)
+        self.rows = {}
+        self.pending = {}
+        self._lock = threading.Lock()
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(robust_path(self.path), check_same_thread=False)
+            self.create()
+        except (OSError, sqlite3.Error):
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
+            self.create()
+
+    def create(self):
+        columns = ", ".join(self.COLUMNS)
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, {columns})"
+        )
+        self.db.commit()
+
+    key = staticmethod(Manifest.key)
+
+    def lookup(self, path, want_hash=False):
+        """Catalog row for path as a dict, probing the file if it is new or changed.
+
+        Returns None if the file can't be read.
+        """
+        key = self.key(path)
+        try:
+            st = os.stat(robust_path(path))
+        except OSError:
+            return None
+        with self._lock:
+            row = self.rows.get(key)
+            if row is None:
+                try:
+                    found = self.db.execute(
+                        f"SELECT {', '.join(self.COLUMNS)} FROM images WHERE path = ?",
+                        (key,),
+                    ).fetchone()
+                except sqlite3.Error:
+                    found = None
+                if found:
+                    row = dict(zip(self.COLUMNS, found))
+        if row is None or (row["size"], row["mtime_ns"]) != (
+            st.st_size,
+            st.st_mtime_ns,
+        ):
+            row = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": None}
+            row.update(probe_image(path))
+        elif not (want_hash and row["hash"] is None):
+            with self._lock:
+                self.rows[key] = row
+            return row
+        if want_hash and row["hash"] is None:
+            try:
+                row["hash"] = file_hash(path)
+            except OSError:
+                pass
+        with self._lock:
+            self.rows[key] = row
+            self.pending[key] = row
+            if len(self.pending) >= CATALOG_BATCH:
+                self.flush_locked()
+        return row
+
+    def dimensions(self, path):
+        """(width, height) of an input, or None if its header is unreadable."""
+        row = self.lookup(path)
+        if row and row["width"]:
+            return row["width"], row["height"]
+        return None
+
+    @staticmethod
+    def header(row):
+        """read_image_header's tuple for a row, or None."""
+        if not row or not row["width"]:
+            return None
+        return row["width"], row["height"], row["channels"], row["depth"]
+
+    def flush(self):
+        with self._lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.pending:
+            return
+        rows = [
+            (key, *(row.get(c) for c in self.COLUMNS))
+            for key, row in self.pending.items()
+        ]
+        self.pending = {}
+        placeholders = ", ".join("?" * (len(self.COLUMNS) + 1))
+        try:
+            with self.db:
+                self.db.executemany(
+                    f"INSERT OR REPLACE INTO images VALUES ({placeholders})", rows
+                )
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self.db.close()
+
+
+# --- Job journal ---
+JOURNAL_NAME = ".mmio-journal.jsonl"
+# fsync after this many records or seconds, whichever comes first
+JOURNAL_SYNC_EVERY = 32
+JOURNAL_SYNC_SECONDS = 2.0
+# Marker in the name of an output that is still being written
+PARTIAL_MARKER = ".mmio-part"
+
+
+def partial_path(path):
+    """Sibling of path that an output is written to before it is moved into place.
+
+    Keeps the extension, which some encoders use to pick the output format.
+    """
+    path = Path(path)
+    return path.with_name(f"{path.stem}{PARTIAL_MARKER}{path.suffix}")
+
+
+def remove_partial_outputs(output_dir):
+    """Delete outputs an interrupted run left half-written."""
+    with contextlib.suppress(OSError), os.scandir(output_dir) as entries:
+        for entry in entries:
+            if PARTIAL_MARKER in entry.name and entry.is_file():
+                with contextlib.suppress(OSError):
+                    os.remove(entry.path)
+
+
+class Journal:
+    """Append-only log of finished outputs, so an interrupted batch can resume.
+
+    One JSON object per line: a header with the settings hash, a "plan"
+    record with the planned outputs of each input, and a "done" record per
+    finished (input, resolution, format) unit. Lines are flushed as they are
+    written and fsynced every JOURNAL_SYNC_EVERY records or
+    JOURNAL_SYNC_SECONDS, so a crash loses at most the last few units. A
+    torn last line is cut off when resuming, before new records are appended
+    after it, and any other unreadable line is skipped. The journal is
+    deleted once a batch runs to the end.
+
+    Every batch keeps one, not just resumed ones, since only the interrupted
+    run can write it; that is a line per output and an fsync per
+    JOURNAL_SYNC_EVERY outputs. Use it as a context manager, or close() it.
+    """
+
+    VERSION = 1
+
+    def __init__(self, output_dir, settings, resume=False):
+        self.path = Path(output_dir) / JOURNAL_NAME
+        self.settings = settings
+        # Input key -> (size, mtime_ns, {(size, format): path or None})
+        self.plans = {}
+        # (input key, (size, format)) -> (output bytes, input bytes)
+        self.units = {}
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+        self._lock = threading.Lock()
+        # Bytes up to the end of the last complete line, set by load()
+        self.length = None
+        if resume:
+            self.load()
+        fresh = not self.plans
+        if not fresh:
+            os.truncate(robust_path(self.path), self.length)
+        self.file = open(
+            robust_path(self.path), "w" if fresh else "a", encoding="utf-8"
+        )
+        if fresh:
+            try:
+                self.write({"version": self.VERSION, "settings": settings})
+                self.sync()
+            except BaseException:
+                self.file.close()
+                raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    key = staticmethod(Manifest.key)
+
+    def load(self):
+        """Read back a journal written with the same settings."""
+        try:
+            with open(robust_path(self.path), "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        # A crash may leave the last line without its newline
+        self.length = data.rfind(b"\n") + 1
+        records = []
+        for line in data[: self.length].decode("utf-8", "replace").splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        if not records or records[0] != {
+            "version": self.VERSION,
+            "settings": self.settings,
+        }:
+            return
+        for record in records[1:]:
+            if "plan" in record:
+                self.plans[record["plan"]] = (
+                    record["size"],
+                    record["mtime_ns"],
+                    {
+                        (size, fmt): Path(name) if name else None
+                        for size, fmt, name in record["outputs"]
+                    },
+                )
+            elif "done" in record:
+                size, fmt = record["variant"]
+                self.units[(record["done"], (size, fmt))] = (
+                    record["bytes"],
+                    record["original"],
+                )
+
+    def valid_plans(self):
+        """Plans of inputs that haven't changed since they were journaled."""
+        plans = {}
+        for key, (size, mtime_ns, plan) in self.plans.items():
+            try:
+                st = os.stat(robust_path(key))
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+                plans[key] = plan
+        return plans
+
+    def finished(self, file_path, plan):
+        """{(size, format): (path, output bytes, input bytes)} already done."""
+        key = self.key(file_path)
+        found = {}
+        for variant, path in plan.items():
+            unit = self.units.get((key, variant))
+            if path is None or unit is None:
+                continue
+            try:
+                # A lost or truncated output is redone
+                if os.stat(robust_path(path)).st_size == unit[0]:
+                    found[variant] = (path, *unit)
+            except OSError:
+                pass
+        return found
+
+    def plan(self, file_path, plan):
+        key = self.key(file_path)
+        if key in self.plans and self.plans[key][2] == plan:
+            return
+        try:
+            st = os.stat(robust_path(file_path))
+        except OSError:
+            return
+        self.plans[key] = (st.st_size, st.st_mtime_ns, plan)
+        outputs = [
+            [size, fmt, str(path) if path else None]
+            for (size, fmt), path in plan.items()
+        ]
+        self.write(
+            {
+                "plan": key,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "outputs": outputs,
+            }
+        )
+
+    def done(self, file_path, variant, out_bytes, original):
+        size, fmt = variant
+        self.write(
+            {
+                "done": self.key(file_path),
+                "variant": [size, fmt],
+                "bytes": out_bytes,
+                "original": original,
+            }
+        )
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if self.file.closed:
+                return
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.unsynced += 1
+            if (
+                self.unsynced >= JOURNAL_SYNC_EVERY
+                or time.monotonic() - self.synced_at >= JOURNAL_SYNC_SECONDS
+            ):
+                self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if not self.file.closed:
+                with contextlib.suppress(OSError):
+                    self.sync()
+                self.file.close()
+
+    def remove(self):
+        self.close()
+        with contextlib.suppress(OSError):
+            os.remove(robust_path(self.path))
+
+
+# --- Output cache ---
+DEFAULT_CACHE_SIZE = 2 << 30
+
+
+def default_cache_dir():
+    """Per-user cache folder; each cache keeps its own subfolder in it."""
+    if platform.system() == "Windows":
+        base = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "MMImageOptimizer"
+
+
+@functools.lru_cache(maxsize=4096)
+def cached_file_hash(path, size, mtime_ns):
+    """file_hash memoized on (path, size, mtime), for intermediates read per format."""
+    return file_hash(path)
+
+
+class OutputCache:
+    """Content-addressed store of encoder outputs, capped in size with LRU eviction.
+
+    An entry is keyed on the hash of the encoder's input file plus, for every
+    command it runs, the tool's version and the argument list with the input
+    and output paths left out; an input piped from memory is hashed likewise.
+    Resize parameters are part of the key through the resized input's
+    content. Hits copy the file out and refresh its mtime, which eviction
+    treats as the last access time.
+    """
+
+    # Subfolder of the cache folder, and prefix of the hit/miss counters
+    folder = "outputs"
+    counter = "cache"
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_SIZE, stats=None):
+        self.directory = Path(directory or default_cache_dir()) / self.folder
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.total_bytes = None
+        self._lock = threading.Lock()
+
+    def bump(self, name, amount=1):
+        if self.stats is not None:
+            self.stats.bump(name, amount)
+
+    def key(self, source, output, commands):
+        if isinstance(source, MemoryRaster):
+            parts = [hashlib.blake2b(source.data, digest_size=16).hexdigest()]
+        else:
+            st = os.stat(robust_path(source))
+            parts = [cached_file_hash(robust_path(source), st.st_size, st.st_mtime_ns)]
+        source, output = robust_path(source), robust_path(output)
+        for cmd in commands:
+            args = [robust_path(arg) for arg in cmd]
+            parts.append(tool_version(str(cmd[0])))
+            parts.extend(
+                "{input}" if arg == source else "{output}" if arg == output else arg
+                for arg in args[1:]
+            )
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return self.directory / key[:2] / key
+
+    def fetch(self, key, out_path, hardlink=False):
+        """Copy a cached output to out_path; False on a miss.
+
+        Only a file nothing writes to again may be hardlinked to the entry.
+        """
+        entry = self.entry_path(key)
+        try:
+            count_staging(self.bump, link_or_copy(entry, out_path, hardlink), entry)
+            os.utime(robust_path(entry))
+        except OSError:
+            self.bump(f"{self.counter}_misses")
+            return False
+        self.bump(f"{self.counter}_hits")
+        return True
+
+    def store(self, key, out_path):
+        """Add a fresh output to the cache, evicting old entries if over the cap."""
+        entry = self.entry_path(key)
+        tmp = entry.with_name(f"{key}.{threading.get_ident()}.tmp")
+        try:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            method = link_or_copy(out_path, tmp, hardlink=False)
+            os.replace(robust_path(tmp), robust_path(entry))
+            count_staging(self.bump, method, entry)
+            size = entry.stat().st_size
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(robust_path(tmp))
+            return
+        with self._lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.entries())
+            else:
+                self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        """(mtime, size, path) of every cached file."""
+        found = []
+        with contextlib.suppress(OSError), os.scandir(self.directory) as buckets:
+            for bucket in buckets:
+                if not bucket.is_dir():
+                    continue
+                with contextlib.suppress(OSError), os.scandir(bucket.path) as files:
+                    for f in files:
+                        with contextlib.suppress(OSError):
+                            st = f.stat()
+                            found.append((st.st_mtime, st.st_size, f.path))
+        return found
+
+    def evict(self):
+        """Drop least recently used entries until 90% of the cap is free."""
+        target = self.max_bytes * 0.9
+        entries = sorted(self.entries())
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.total_bytes <= target:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                self.total_bytes -= size
+                self.bump(f"{self.counter}_evictions")
+
+
+class IntermediateCache(OutputCache):
+    """Normalized and resized PNGs, so settings-only reruns go straight to encoding.
+
+    Keyed on the input's content hash, the effective resize (see
+    resize_geometry), the intermediate format, the resize filter, whether
+    metadata is stripped and the ImageMagick version, so entries that
+    collapse to the same pixels share it.
+    """
+
+    folder = "intermediates"
+    counter = "resize_cache"
+
+    def key(self, digest, pixels, strip_meta, raster="png"):
+        parts = [
+            digest,
+            " ".join(pixels),
+            raster,
+            RESIZE_FILTER,
+            "strip" if strip_meta else "keep",
+            tool_version(str(MAGICK)),
+        ]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def has(self, key):
+        return self.entry_path(key).exists()
+
+    def fetch_intermediate(self, key, out_path):
+        """Copy an entry to out_path and return it.
+
+        Raises OSError if the entry has gone missing.
+        """
+        # Intermediates are only read, so sharing the entry's inode is safe
+        if not self.fetch(key, out_path, hardlink=True):
+            raise FileNotFoundError(f"cached intermediate {key[:12]} disappeared")
+        return out_path
+
+    def store_intermediate(self, key, path):
+        """Cache a resize result."""
+        self.store(key, path)
+
+
+# --- Content deduplication ---
+# Linux FICLONE ioctl: share the source's extents (btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """Copy-on-write clone of src at dst; raises OSError where unsupported."""
+    if platform.system() != "Linux":
+        raise OSError("reflinks are only supported on Linux")
+    import fcntl
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+def copy_range(src, dst):
+    """In-kernel copy of src to dst; raises OSError where unsupported.
+
+    copy_file_range lets the filesystem share extents or copy server-side
+    (NFS, SMB), and never moves the data through user space.
+    """
+    if not hasattr(os, "copy_file_range"):
+        raise OSError("copy_file_range is not available")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        remaining = os.fstat(s.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+            if not copied:
+                raise OSError(f"copy_file_range stopped short of {src}")
+            remaining -= copied
+
+
+def link_or_copy(src, dst, hardlink=True):
+    """Materialize dst as a reflink, hardlink or copy of src; returns which.
+
+    Pass hardlink=False when either file may be changed in place later,
+    which a hardlink would carry over to the other one.
+    """
+    src, dst = robust_path(src), robust_path(dst)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(dst)
+    try:
+        reflink(src, dst)
+        return "reflink"
+    except OSError:
+        pass
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    tmp = partial_path(dst)
+    try:
+        copy_range(src, tmp)
+        method = "copy_range"
+    except OSError:
+        shutil.copyfile(src, tmp)
+        method = "copy"
+    os.replace(tmp, dst)
+    return method
+
+
+def count_staging(bump, method, path):
+    """Count one staged file; reflinks, hardlinks and direct reads copy no bytes."""
+    bump(f"staged_{method}")
+    if method in ("reflink", "hardlink", "direct"):
+        bump("staging_bytes_saved", os.stat(robust_path(path)).st_size)
+
+
+def estimate_pixels(path):
+    """Cheap work estimate for an image: pixel count from its header.
+
+    Falls back to the file size when the header can't be parsed, which still
+    ranks huge files above small ones.
+    """
+    pixels, footprint = estimate_footprint(path)
+    return pixels or footprint
+
+
+def order_image_files(image_files, policy="discovery", workers=1, estimate=None):
+    """Reorder a batch according to a scheduling policy.
+
+    discovery:   keep the order files were found in
+    largest:     largest first (LPT), shortest makespan for skewed batches
+    smallest:    smallest first, fastest early feedback
+    interleaved: alternate largest and smallest, a mix of both
+
+    estimate maps a file to its cost and defaults to estimate_pixels.
+    """
+    if policy == "discovery" or len(image_files) < 2:
+        return list(image_files)
+    if policy not in SCHEDULING_POLICIES:
+        raise ValueError(f"Unknown scheduling policy: {policy}")
+
+    # Header probes are I/O bound; run them in parallel on slow shares
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        sizes = list(executor.map(estimate or estimate_pixels, image_files))
+    ranked = [f for _, _, f in sorted(zip(sizes, range(len(sizes)), image_files))]
+
+    if policy == "smallest":
+        return ranked
+    ranked.reverse()
+    if policy == "largest":
+        return ranked
+    interleaved = []
+    lo, hi = 0, len(ranked) - 1
+    while lo <= hi:
+        interleaved.append(ranked[lo])
+        if lo != hi:
+            interleaved.append(ranked[hi])
+        lo += 1
+        hi -= 1
+    return interleaved
+
+
+def file_identity(path, st=None):
+    """Key that is equal for two paths naming the same file (hardlinks included)."""
+    try:
+        st = st or os.stat(path)
+        if st.st_ino:
+            return (st.st_dev, st.st_ino)
+    except OSError:
+        pass
+    return os.path.normcase(os.path.abspath(path))
+
+
+def scan_directory(directory, recursive=False):
+    """List one directory with a single scandir call.
+
+    Returns (image files, subdirectories); files come as (identity, Path)
+    pairs. Extensions are matched case-insensitively, so ".Jpg" is found too.
+    """
+    files = []
+    subdirs = []
+    try:
+        device = os.stat(directory).st_dev
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subdirs.append(Path(entry.path))
+                    elif entry.is_file():
+                        ext = os.path.splitext(entry.name)[1].lower()
+                        if ext in IMAGE_EXTENSIONS:
+                            inode = entry.inode()
+                            key = (
+                                (device, inode)
+                                if inode
+                                else os.path.normcase(os.path.abspath(entry.path))
+                            )
+                            files.append((key, Path(entry.path)))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def iter_image_files(sources, recursive=False, workers=1):
+    """Yield image files under sources in one streaming pass.
+
+    Each directory is listed once with os.scandir and files are yielded as
+    soon as their directory has been read, so processing can start while
+    the walk continues. With workers > 1 subdirectories are scanned in
+    parallel, which helps on network shares. Overlapping sources and
+    hardlinked duplicates are yielded only once.
+    """
+    seen_files = set()
+    seen_dirs = set()
+    roots = []
+    for src in sources:
+        src = Path(src)
+        if src.is_dir():
+            key = file_identity(src)
+            if key not in seen_dirs:
+                seen_dirs.add(key)
+                roots.append(src)
+        elif src.is_file() and src.suffix.lower() in IMAGE_EXTENSIONS:
+            key = file_identity(src)
+            if key not in seen_files:
+                seen_files.add(key)
+                yield src
+
+    def unseen_dirs(subdirs):
+        for d in subdirs:
+            key = file_identity(d)
+            if key not in seen_dirs:
+                seen_dirs.add(key)
+                yield d
+
+    if workers <= 1:
+        stack = list(reversed(roots))
+        while stack:
+            files, subdirs = scan_directory(stack.pop(), recursive)
+            for key, path in files:
+                if key not in seen_files:
+                    seen_files.add(key)
+                    yield path
+            stack.extend(reversed(list(unseen_dirs(subdirs))))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_directory, d, recursive) for d in roots}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                for key, path in files:
+                    if key not in seen_files:
+                        seen_files.add(key)
+                        yield path
+                for d in unseen_dirs(subdirs):
+                    pending.add(executor.submit(scan_directory, d, recursive))
+
+
+def gather_image_files(sources, recursive=False):
+    """Flat list of the image files in sources, a list of files or folders."""
+    return list(iter_image_files(sources, recursive))
+
+
+# --- Output planning ---
+CONFLICT_POLICIES = ["ask", "overwrite", "skip", "rename"]
+
+
+def output_paths(output_dir, stem, resolutions, formats):
+    """{(size, format): output path} for one input written under `stem`."""
+    paths = {}
+    for res in resolutions:
+        size = res["size"]
+        base = stem if size == "original" else f"{stem}_{size}"
+        for fmt in FORMATS:
+            if fmt in formats:
+                paths[(size, fmt)] = (
+                    Path(output_dir) / f"{base}{OUTPUT_EXTENSIONS[fmt]}"
+                )
+    return paths
+
+
+class OutputPlanner:
+    """Decides every output path of a batch before anything runs.
+
+    Inputs that share a stem (photo.jpg next to photo.png, or the same name
+    in two subfolders) get "-2", "-3", ... in discovery order so they never
+    write over each other. Outputs that already exist on disk are handled
+    by the conflict policy:
+
+    overwrite: write over them
+    skip:      leave them alone and don't produce them again
+    rename:    keep both, writing this batch's outputs under a new stem
+    ask:       the caller resolves it to one of the above for the whole batch;
+               inputs without a conflict may be planned before that
+
+    The output folder is listed once up front instead of stat-ing each path.
+    """
+
+    def __init__(self, output_dir, resolutions, formats, policy="overwrite"):
+        if policy not in CONFLICT_POLICIES:
+            raise ValueError(f"Unknown conflict policy: {policy}")
+        self.output_dir = Path(output_dir)
+        self.resolutions = resolutions
+        self.formats = formats
+        self.policy = policy
+        # Normalized paths owned by an input of this batch
+        self.claimed = set()
+        # Input key -> plan carried over from an interrupted run
+        self.adopted = {}
+        self.existing = set()
+        with contextlib.suppress(OSError), os.scandir(self.output_dir) as entries:
+            for entry in entries:
+                self.existing.add(self.key(entry.path))
+
+    @staticmethod
+    def key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def exists(self, path):
+        return self.key(path) in self.existing
+
+    def reserve(self, paths):
+        """Keep other inputs off outputs that stay in place, e.g. unchanged ones."""
+        self.claimed.update(self.key(p) for p in paths)
+
+    def resume(self, plans):
+        """Reuse the plans of an interrupted run, {input key: plan}.
+
+        Their outputs were written by that run, so they are not conflicts.
+        """
+        for key, plan in plans.items():
+            self.adopted[key] = plan
+            for path in plan.values():
+                if path:
+                    self.claimed.add(self.key(path))
+                    self.existing.discard(self.key(path))
+
+    def candidate(self, stem, claimed, rename):
+        """First free stem -> its output paths; n > 1 means it was renamed."""
+        n = 1
+        while True:
+            name = stem if n == 1 else f"{stem}-{n}"
+            paths = output_paths(self.output_dir, name, self.resolutions, self.formats)
+            keys = [self.key(p) for p in paths.values()]
+            if not any(k in claimed or (rename and k in self.existing) for k in keys):
+                return paths, keys, n
+            n += 1
+
+    def conflicts(self, file_paths):
+        """Existing outputs the inputs would write to, before any policy applies."""
+        claimed = set(self.claimed)
+        found = []
+        for file_path in file_paths:
+            if self.key(file_path) in self.adopted:
+                continue
+            paths, keys, _ = self.candidate(file_path.stem, claimed, rename=False)
+            claimed.update(keys)
+            found.extend(p for p in paths.values() if self.exists(p))
+        return found
+
+    def in_conflict(self, file_path):
+        """Whether claiming the input now would meet an existing output."""
+        if self.key(file_path) in self.adopted:
+            return False
+        paths, _, _ = self.candidate(file_path.stem, self.claimed, rename=False)
+        return any(self.exists(p) for p in paths.values())
+
+    def claim(self, file_path):
+        """Plan one input's outputs: {(size, format): path or None if skipped}.
+
+        Returns (plan, renamed). Under "ask" only inputs without a conflict
+        can be planned; every policy plans them the same way.
+        """
+        adopted = self.adopted.pop(self.key(file_path), None)
+        if adopted is not None:
+            return adopted, False
+        if self.policy == "ask" and self.in_conflict(file_path):
+            raise ValueError("resolve the 'ask' conflict policy before planning")
+        paths, keys, n = self.candidate(
+            file_path.stem, self.claimed, rename=self.policy == "rename"
+        )
+        self.claimed.update(keys)
+        plan = {
+            variant: None if self.policy == "skip" and self.exists(path) else path
+            for variant, path in paths.items()
+        }
+        return plan, n > 1
+
+
+class BatchProcessor:
+    """Runs a whole batch on a thread pool and reports through plain callbacks.
+
+    The GUI's ProcessingThread forwards the callbacks to Qt signals; the CLI
+    prints them as JSON lines.
+    """
+
+    def __init__(
+        self,
+        input_sources,
+        output_dir,
+        resolutions,
+        formats,
+        qmap,
+        qlossless_map,
+        strip_meta,
+        recursive,
+        thread_count,
+        use_gpu=False,
+        progress_callback=None,
+        status_callback=None,
+        stats_callback=None,
+        conflict_policy="overwrite",
+        conflict_callback=None,
+        max_in_flight=None,
+        scheduling="discovery",
+        lane_sizes=None,
+        adaptive=False,
+        max_threads=None,
+        memory_budget=None,
+        max_pixels=MAX_PIXELS,
+        timeouts=None,
+        retry_faster=True,
+        speculate=True,
+        incremental=False,
+        hash_inputs=False,
+        dedupe=False,
+        cache=False,
+        cache_dir=None,
+        cache_size=DEFAULT_CACHE_SIZE,
+        resume=False,
+        catalog=True,
+        intermediate="auto",
+        scratch_dir=None,
+        scratch_quota=None,
+        stream_limit=DEFAULT_STREAM_LIMIT,
+    ):
+        self.input_sources = input_sources
+        self.output_dir = Path(output_dir)
+        self.resolutions = resolutions
+        self.formats = formats
+        self.qmap = qmap
+        self.qlossless_map = qlossless_map
+        self.strip_meta = strip_meta
+        self.recursive = recursive
+        self.thread_count = max(1, int(thread_count))
+        self.use_gpu = use_gpu
+        self.progress_callback = progress_callback
+        self.status_callback = status_callback
+        self.stats_callback = stats_callback
+        # What to do with outputs that already exist; "ask" calls
+        # conflict_callback once with all of them after the scan and expects
+        # "overwrite", "skip" or "rename" back
+        self.conflict_policy = conflict_policy
+        self.conflict_callback = conflict_callback
+        self.planner = None
+        # Planned outputs per input until it is submitted or skipped, see
+        # OutputPlanner.claim
+        self.plans = {}
+        # Pick up an interrupted batch from its journal in the output folder
+        self.resume = resume
+        self.journal = None
+        # Outputs of an input already finished before a resume
+        self.resumed = {}
+        # Keep probed input headers in a Catalog under cache_dir
+        self.use_catalog = catalog
+        # Raster format between stages, one of INTERMEDIATE_FORMATS
+        self.intermediate = intermediate
+        # Intermediates go to a private folder under scratch_dir, else to
+        # _tmp in the output folder; scratch_quota defaults to half its
+        # free space
+        self.scratch_dir = scratch_dir
+        self.scratch_quota = scratch_quota
+        self.scratch = None
+        # Intermediates up to this size stay in memory; see DEFAULT_STREAM_LIMIT
+        self.stream_limit = stream_limit
+        self.catalog = None
+        # Cancel and pause switches; see cancel(), pause() and unpause()
+        self.control = BatchControl()
+        # Set by request_cancel(); the dispatch loop turns it into cancel()
+        self.cancel_requested = False
+        self.events = None
+        self.scheduling = scheduling
+        # thread_count is the CPU token budget; tools draw from it per lane
+        self.lanes = ResourceLanes(self.thread_count, lane_sizes)
+        # With adaptive on, thread_count is only the starting budget
+        self.adaptive = adaptive
+        self.max_threads = max(
+            self.thread_count, int(max_threads or get_available_cpus())
+        )
+        self.peak_threads = self.max_threads if adaptive else self.thread_count
+        # Images admitted to the scheduler at once; bounds memory on huge
+        # batches while keeping enough queued stages to feed every worker
+        self.max_in_flight = max(1, int(max_in_flight or self.peak_threads * 4))
+        # Decoded bytes admitted at once; None means half of free memory
+        self.memory_budget = memory_budget
+        self.max_pixels = max_pixels
+        # Per-tool watchdog limits in seconds; see TOOL_TIMEOUTS
+        self.timeouts = timeouts
+        self.retry_faster = retry_faster
+        # Race stragglers against faster duplicates once the queue drains
+        self.speculate = speculate
+        # Skip inputs whose manifest entry shows nothing changed
+        self.incremental = incremental
+        self.hash_inputs = hash_inputs
+        self.manifest = None
+        # Process identical inputs once and link the results for the rest
+        self.dedupe = dedupe
+        # Content hash per discovered file, filled by the scanner and dropped
+        # once the file's outcome is recorded
+        self.digests = {}
+        # Content hash -> first input with it and the variants it writes,
+        # files waiting on it, and its result once finished
+        self.primaries = {}
+        self.followers = {}
+        self.content_done = {}
+        # Reuse encoder outputs from earlier runs, across output folders
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        # (pixels, decoded bytes) per discovered file, filled by the scanner
+        # and dropped once the file is submitted or skipped
+        self.footprints = {}
+        self.memory_in_use = 0
+        # (file, since) for the backlog head that is waiting for memory
+        self.blocked = None
+        # Files held back until the scan finishes, for ordering policies or
+        # an answer about conflicts, and the stems of the latter
+        self.pending_files = []
+        self.held_stems = set()
+        self.total_stats = FileStats()
+
+    def cancel(self):
+        """Stop the batch: nothing new starts and running tools are killed.
+
+        run() returns soon after with what finished so far; the journal is
+        kept, so the batch can be resumed later.
+        """
+        if self.control.cancelled.is_set():
+            return
+        self.emit_status("Cancelling...")
+        self.control.cancel()
+        if self.events is not None:
+            # Wake the dispatch loop
+            self.events.put(("cancel", None))
+
+    def request_cancel(self):
+        """cancel() for signal handlers, which must not emit or take locks.
+
+        Only sets a flag; the dispatch loop notices it within
+        CANCEL_POLL_SECONDS and cancels from there.
+        """
+        self.cancel_requested = True
+
+    def pause(self):
+        """Hold back new stages and suspend the running tools."""
+        self.control.pause()
+        self.emit_status("Paused")
+
+    def unpause(self):
+        self.control.unpause()
+        self.emit_status("Resumed")
+
+    @property
+    def cancelled(self):
+        return self.control.cancelled.is_set()
+
+    def required_tools(self):
+        """Binaries this batch's settings will run."""
+        tools = [MAGICK, EXIFTOOL] if self.strip_meta else [MAGICK]
+        for fmt in self.formats:
+            if fmt == "PNG":
+                tools.append(OXIPNG)
+                if not self.qlossless_map.get("PNG", True):
+                    tools.append(PNGQUANT)
+            else:
+                tools.extend(FORMAT_TOOLS.get(fmt, []))
+        return tools
+
+    def emit_progress(self, current, total, filename):
+        if self.progress_callback:
+            self.progress_callback(current, total, filename)
+
+    def emit_status(self, message):
+        if self.status_callback:
+            self.status_callback(message)
+
+    def emit_stats(self, stats):
+        if self.stats_callback:
+            self.stats_callback(stats)
+
+    def gather_image_files(self, sources, recursive=False):
+        return gather_image_files(sources, recursive)
+
+    def build_graph(self, index, file_path):
+        """Build the task graph for one input, turning setup errors into a stub."""
+        # Stages of one image run on different workers, so each image
+        # gets its own scratch directory instead of a per-thread one
+        try:
+            image_tmp_dir = self.scratch.image_dir(index)
+            graph = self.processor.build_image_graph(
+                file_path,
+                image_tmp_dir,
+                file_path.stem,
+                self.resolutions,
+                self.formats,
+                self.qmap,
+                self.qlossless_map,
+                self.strip_meta,
+                self.output_dir,
+                self.plans.pop(file_path, None),
+            )
+        except Exception as e:
+            graph = TaskGraph(file_path.name)
+            graph.file_path = file_path
+            graph.original_size = 0
+            graph.errors.append(f"{file_path.name}: {e}")
+            return graph
+        graph.scratch = self.scratch
+        graph.scratch_dir = image_tmp_dir
+        return graph
+
+    def record_result(self, future, total_files):
+        """Fold one finished image into the totals and report progress."""
+        graph = future.result()
+        filename = graph.name
+        resumed = self.resumed.pop(getattr(graph, "file_path", None), [])
+        try:
+            stats = self.processor.collect_stats(graph)
+            if graph.cancelled:
+                # Its finished outputs are in the journal for a resumed run
+                self.total_stats.bump("cancelled")
+                return
+            self.total_stats.merge(stats)
+            if self.manifest and not stats.errors:
+                self.manifest.record(
+                    graph.file_path,
+                    [t.output for t in graph.tasks if t.output and not t.failed]
+                    + resumed,
+                )
+
+            self.completed_files += 1
+            self.emit_progress(self.completed_files, total_files, filename)
+            self.emit_status(
+                f"Processed: {filename} ({self.completed_files}/{total_files})"
+            )
+            self.emit_stats(self.total_stats)
+
+        except Exception as e:
+            self.total_stats.errors.append(f"{filename}: {e}")
+            self.emit_status(f"Error processing {filename}: {str(e)}")
+
+    def plan(self, file_path, total_files):
+        """Claim an input's outputs; False if there is nothing left to run."""
+        plan, renamed = self.planner.claim(file_path)
+        if renamed:
+            self.total_stats.bump("renamed")
+        skipped = sum(path is None for path in plan.values())
+        if skipped:
+            self.total_stats.bump("skipped_outputs", skipped)
+        finished = self.journal.finished(file_path, plan)
+        self.journal.plan(file_path, plan)
+        resumed = FileStats()
+        if finished:
+            for _, out_bytes, original in finished.values():
+                resumed.add_file(original, out_bytes)
+            self.total_stats.bump("resumed", len(finished))
+            self.resumed[file_path] = [path for path, _, _ in finished.values()]
+            plan = {v: None if v in finished else p for v, p in plan.items()}
+        if all(path is None for path in plan.values()):
+            finished_outputs = self.resumed.get(file_path)
+            self.forget(file_path)
+            if finished:
+                # One processed image, however many outputs it has
+                self.total_stats.merge(resumed)
+            if finished and self.manifest:
+                self.manifest.record(file_path, finished_outputs)
+            self.total_stats.bump("resumed_inputs" if finished else "skipped_existing")
+            self.completed_files += 1
+            self.emit_progress(self.completed_files, total_files, file_path.name)
+            self.emit_status(
+                f"Skipped: {file_path.name} "
+                f"({'finished before resume' if finished else 'outputs exist'})"
+            )
+            return False
+        self.plans[file_path] = plan
+        # The image itself is counted once its remaining outputs are done
+        self.total_stats.original_size += resumed.original_size
+        self.total_stats.optimized_size += resumed.optimized_size
+        if self.dedupe and self.follow_duplicate(file_path, total_files):
+            return False
+        return True
+
+    def must_hold(self, file_path):
+        """Whether a streamed input must wait for the conflict policy.
+
+        That is one with an existing output, or with the stem of one that
+        waits, so stems still get their "-2", "-3" in discovery order.
+        """
+        if self.planner.policy != "ask":
+            return False
+        stem = os.path.normcase(file_path.stem)
+        if stem in self.held_stems or self.planner.in_conflict(file_path):
+            self.held_stems.add(stem)
+            return True
+        return False
+
+    def resolve_conflicts(self):
+        """Turn the 'ask' policy into a concrete one with a single callback."""
+        conflicts = self.planner.conflicts(self.pending_files)
+        policy = "overwrite"
+        if conflicts:
+            self.emit_status(f"{len(conflicts)} output files already exist")
+            policy = "skip"
+            if self.conflict_callback:
+                policy = self.conflict_callback(conflicts) or "skip"
+        self.planner.policy = policy
+
+    def follow_duplicate(self, file_path, total_files):
+        """Hold back an input whose content is already being processed.
+
+        Returns False for the first input with a given content, which is
+        processed normally, and for copies that want outputs the first
+        one won't produce.
+        """
+        digest = self.digests.get(file_path)
+        if digest is None:
+            return False
+        wanted = {variant for variant, path in self.plans[file_path].items() if path}
+        primary, variants = self.primaries.setdefault(digest, (file_path, wanted))
+        if primary is file_path or not wanted <= variants:
+            return False
+        # Only its plan is needed from here on
+        self.digests.pop(file_path)
+        self.footprints.pop(file_path, None)
+        if digest in self.content_done:
+            self.materialize_duplicate(file_path, digest, total_files)
+        else:
+            self.followers.setdefault(digest, []).append(file_path)
+        return True
+
+    def release_duplicates(self, graph, total_files):
+        """Give the inputs waiting on a finished image their outputs."""
+        file_path = getattr(graph, "file_path", None)
+        digest = self.digests.pop(file_path, None)
+        if digest is None:
+            return
+        if graph.cancelled:
+            # The copies are left for a resumed run, like the backlog
+            for follower in self.followers.pop(digest, []):
+                self.forget(follower)
+            return
+        failed = bool(graph.errors) or any(t.error for t in graph.tasks)
+        self.content_done[digest] = {
+            "name": graph.name,
+            "outputs": {
+                t.key[1:]: t.output for t in graph.tasks if t.output and not t.failed
+            },
+            "seconds": sum(t.seconds for t in graph.tasks),
+            "failed": failed,
+        }
+        for follower in self.followers.pop(digest, []):
+            self.materialize_duplicate(follower, digest, total_files)
+
+    def materialize_duplicate(self, file_path, digest, total_files):
+        """Link or copy the outputs of an identical input under this one's name."""
+        done = self.content_done[digest]
+        plan = self.plans.pop(file_path)
+        resumed = self.resumed.pop(file_path, [])
+        stats = FileStats()
+        if done["failed"]:
+            stats.errors.append(
+                f"{file_path.name}: same content as {done['name']}, which failed"
+            )
+        else:
+            original_size = file_path.stat().st_size
+            targets = []
+            for variant, target in plan.items():
+                output = done["outputs"].get(variant)
+                if target is None or output is None:
+                    continue
+                try:
+                    if target != output:
+                        stats.bump(f"dedupe_{link_or_copy(output, target)}")
+                    out_bytes = target.stat().st_size
+                    stats.add_file(original_size, out_bytes)
+                    targets.append(target)
+                    self.journal.done(file_path, variant, out_bytes, original_size)
+                except OSError as e:
+                    stats.errors.append(f"{file_path.name}: {target.name} ({e})")
+            stats.bump("duplicates")
+            stats.bump("dedupe_saved_seconds", round(done["seconds"], 3))
+            if self.manifest and not stats.errors:
+                self.manifest.record(file_path, targets + resumed)
+        self.total_stats.merge(stats)
+        self.completed_files += 1
+        self.emit_progress(self.completed_files, total_files, file_path.name)
+        self.emit_status(
+            f"Deduplicated: {file_path.name} (same as {done['name']}) "
+            f"({self.completed_files}/{total_files})"
+        )
+        self.emit_stats(self.total_stats)
+
+    def skip_unchanged(self, file_path, total_files):
+        """Count an input whose outputs are already up to date as done."""
+        self.total_stats.bump("unchanged")
+        self.completed_files += 1
+        self.emit_progress(self.completed_files, total_files, file_path.name)
+
+    def forget(self, file_path):
+        """Drop what the scan and planning kept for an input that won't run."""
+        self.footprints.pop(file_path, None)
+        self.plans.pop(file_path, None)
+        self.digests.pop(file_path, None)
+        self.resumed.pop(file_path, None)
+
+    def reject(self, file_path, message, total_files):
+        """Count an input as done without processing it."""
+        self.forget(file_path)
+        self.total_stats.errors.append(f"{file_path.name}: {message}")
+        self.total_stats.bump("rejected")
+        self.completed_files += 1
+        self.emit_progress(self.completed_files, total_files, file_path.name)
+        self.emit_status(f"Skipped: {file_path.name} ({message})")
+
+    def fits_memory(self, file_path):
+        footprint = self.footprints.get(file_path, (0, 0))[1]
+        return self.memory_in_use + footprint <= self.memory_budget
+
+    def fits_scratch(self, file_path):
+        footprint = self.footprints.get(file_path, (0, 0))[1]
+        return self.scratch.fits(self.scratch.estimate(footprint))
+
+    def fits(self, file_path):
+        return self.fits_memory(file_path) and self.fits_scratch(file_path)
+
+    def admit_next(self, backlog, idle):
+        """Pop the next backlog file that fits the memory budget and scratch quota.
+
+        An image that doesn't fit waits at the head while smaller ones are
+        admitted around it, for up to ADMISSION_BYPASS_SECONDS; after that
+        admission pauses until enough memory or scratch space frees up. With
+        nothing in flight the head is always admitted, so oversized images
+        run alone.
+        """
+        head = backlog[0]
+        if idle or self.fits(head):
+            self.blocked = None
+            return backlog.popleft()
+        now = time.monotonic()
+        if self.blocked is None or self.blocked[0] is not head:
+            self.blocked = (head, now)
+            self.total_stats.bump(
+                "scratch_waits" if self.fits_memory(head) else "memory_waits"
+            )
+        if now - self.blocked[1] > ADMISSION_BYPASS_SECONDS:
+            return None
+        for i, file_path in enumerate(itertools.islice(backlog, ADMISSION_LOOKAHEAD)):
+            if i and self.fits(file_path):
+                del backlog[i]
+                return file_path
+        return None
+
+    def probe(self, path):
+        """Per-file checks run next to the scan: content hash, manifest, header."""
+        digest = None
+        info = None
+        if self.catalog:
+            info = self.catalog.lookup(path, want_hash=self.dedupe)
+            digest = info and info["hash"]
+        elif self.dedupe:
+            try:
+                digest = file_hash(path)
+            except OSError:
+                pass
+        if self.manifest and self.manifest.is_current(path, digest):
+            return "unchanged", path
+        if digest and self.dedupe:
+            self.digests[path] = digest
+        # Header probe only; nothing is decoded here
+        if info:
+            self.footprints[path] = estimate_footprint(path, Catalog.header(info))
+        else:
+            self.footprints[path] = estimate_footprint(path)
+        return "file", path
+
+    @staticmethod
+    def probed(path, future):
+        """The event for a finished probe; a failed one rejects just that file."""
+        try:
+            return future.result()
+        except Exception as e:
+            return "unreadable", (path, f"Probing failed: {e}")
+
+    def discover(self, events):
+        """Background scan: push ("file", path) events, then ("scan_done", None).
+
+        Files are probed on a small pool so hashing keeps up with the walk;
+        events still go out in discovery order.
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=self.thread_count) as probes:
+                window = deque()
+                for path in iter_image_files(
+                    self.input_sources, self.recursive, self.thread_count
+                ):
+                    if self.cancelled:
+                        break
+                    window.append((path, probes.submit(self.probe, path)))
+                    while window and (
+                        window[0][1].done() or len(window) > self.thread_count * 8
+                    ):
+                        events.put(self.probed(*window.popleft()))
+                while window:
+                    events.put(self.probed(*window.popleft()))
+        except Exception as e:
+            self.total_stats.errors.append(f"Scanning input failed: {e}")
+        finally:
+            events.put(("scan_done", None))
+
+    def run(self):
+        """Process images using multiple threads"""
+        missing = TOOLS.missing(self.required_tools())
+        if missing:
+            raise FileNotFoundError(
+                f"Required tools not found: {', '.join(missing)} "
+                f"(looked in {RESOURCES_DIR} and on PATH)"
+            )
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        tmp_dir = self.output_dir / "_tmp"
+        # Tools, scratch files and half-written outputs of a run that crashed
+        process_log = self.output_dir / PROCESS_LOG_NAME
+        reaped = reap_orphans(process_log)
+        if reaped:
+            self.total_stats.bump("reaped_processes", reaped)
+        self.control.open_log(process_log)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        remove_partial_outputs(self.output_dir)
+        if self.scratch_dir:
+            self.scratch = ScratchSpace(
+                parent=self.scratch_dir, quota=self.scratch_quota
+            )
+        else:
+            self.scratch = ScratchSpace(tmp_dir, quota=self.scratch_quota)
+
+        self.emit_status("Gathering image files...")
+        self.completed_files = 0
+        self.total_files = 0
+        self.processor = ImageProcessor(
+            self.use_gpu,
+            self.lanes,
+            timeouts=self.timeouts,
+            retry_faster=self.retry_faster,
+            stats=self.total_stats,
+            cache=OutputCache(self.cache_dir, self.cache_size, self.total_stats)
+            if self.cache
+            else None,
+            resize_cache=IntermediateCache(
+                self.cache_dir, self.cache_size, self.total_stats
+            )
+            if self.cache
+            else None,
+            intermediate=self.intermediate,
+            stream_limit=self.stream_limit,
+        )
+        if self.memory_budget is None:
+            self.memory_budget = default_memory_budget()
+        settings = settings_hash(
+            self.formats,
+            self.resolutions,
+            self.qmap,
+            self.qlossless_map,
+            self.strip_meta,
+        )
+        if self.incremental:
+            self.manifest = Manifest(self.output_dir, settings, self.hash_inputs)
+        self.planner = OutputPlanner(
+            self.output_dir, self.resolutions, self.formats, self.conflict_policy
+        )
+        # Closed on every way out; whatever finished survives for --resume
+        with Journal(self.output_dir, settings, resume=self.resume) as self.journal:
+            self.processor.journal = self.journal
+            self.processor.control = self.control
+            if self.use_catalog:
+                self.catalog = Catalog(
+                    Path(self.cache_dir or default_cache_dir()) / CATALOG_NAME
+                )
+                self.processor.catalog = self.catalog
+            if self.resume:
+                plans = self.journal.valid_plans()
+                if plans:
+                    self.emit_status(
+                        f"Resuming an interrupted batch ({len(plans)} images)"
+                    )
+                self.planner.resume(plans)
+
+            controller = None
+            if self.adaptive:
+                controller = ConcurrencyController(
+                    self.lanes,
+                    self.total_stats,
+                    maximum=self.max_threads,
+                    control=self.control,
+                ).start()
+            try:
+                self.dispatch()
+            finally:
+                if controller:
+                    controller.stop()
+                if self.catalog:
+                    self.catalog.close()
+                self.scratch.close()
+                self.total_stats.bump("scratch_peak_bytes", self.scratch.peak)
+                self.control.close_log()
+        if self.cancelled:
+            self.emit_status(
+                f"Cancelled after {self.completed_files}/{self.total_files} images"
+            )
+        else:
+            # The batch ran to the end; nothing is left to resume
+            self.journal.remove()
+
+        if self.manifest:
+            try:
+                self.manifest.save()
+            except OSError as e:
+                self.total_stats.errors.append(f"Saving manifest failed: {e}")
+            unchanged = self.total_stats.counters.get("unchanged", 0)
+            if unchanged:
+                self.emit_status(f"Skipped {unchanged} unchanged images")
+        return self.total_stats
+
+    def dispatch(self):
+        """Stream discovered files through the scheduler until every one is done."""
+        # Discovered files and finished graphs (in completion order, not
+        # submission order) both arrive on this queue
+        events = self.events = queue.Queue()
+        scanner = threading.Thread(
+            target=self.discover, args=(events,), name="mmio-scan", daemon=True
+        )
+        scanner.start()
+
+        # Ordering policies need the whole batch; otherwise files stream in
+        # discovery order, except those waiting for an answer about conflicts
+        streaming = self.scheduling == "discovery"
+        backlog = deque()
+        scan_done = False
+        submitted = 0
+        in_flight = 0
+
+        # Every stage of every image is a task on one shared worker pool. It is
+        # oversized on purpose: workers blocked on a busy lane hold no CPU,
+        # and the spare ones let cheap encodes run next to the slow ones.
+        with TaskScheduler(self.peak_threads * 2, self.control) as scheduler:
+            speculator = None
+            if self.speculate:
+                speculator = Speculator(
+                    self.lanes,
+                    self.total_stats,
+                    drained=lambda: scan_done and not backlog and scheduler.queued == 0,
+                    control=self.control,
+                ).start()
+                self.processor.speculator = speculator
+
+            while True:
+                if self.cancel_requested:
+                    self.cancel()
+                if self.cancelled:
+                    # Only wait for what is in flight
+                    for file_path in itertools.chain(backlog, self.pending_files):
+                        self.forget(file_path)
+                    backlog.clear()
+                    self.pending_files = []
+                    scan_done = True
+                # Top up the window; waiting for events provides the backpressure
+                while backlog and in_flight < self.max_in_flight:
+                    file_path = self.admit_next(backlog, idle=in_flight == 0)
+                    if file_path is None:
+                        break
+                    graph = self.build_graph(submitted, file_path)
+                    graph.footprint = self.footprints.pop(file_path, (0, 0))[1]
+                    self.memory_in_use += graph.footprint
+                    graph.scratch_bytes = self.scratch.estimate(graph.footprint)
+                    self.scratch.reserve(graph.scratch_bytes)
+                    scheduler.submit(graph, priority=submitted).add_done_callback(
+                        lambda future: events.put(("done", future))
+                    )
+                    submitted += 1
+                    in_flight += 1
+
+                if scan_done and not backlog and in_flight == 0:
+                    break
+
+                try:
+                    # Time out now and then to notice request_cancel()
+                    kind, item = events.get(timeout=CANCEL_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if self.cancelled and kind in (
+                    "file",
+                    "unchanged",
+                    "unreadable",
+                    "scan_done",
+                ):
+                    continue
+                if kind == "file":
+                    self.total_files += 1
+                    pixels = self.footprints.get(item, (0, 0))[0]
+                    if self.max_pixels and pixels > self.max_pixels:
+                        self.reject(
+                            item,
+                            f"{pixels:,} pixels exceeds the "
+                            f"{self.max_pixels:,} pixel limit",
+                            self.total_files,
+                        )
+                    elif not streaming or self.must_hold(item):
+                        self.pending_files.append(item)
+                    elif self.plan(item, self.total_files):
+                        backlog.append(item)
+                elif kind == "unchanged":
+                    self.total_files += 1
+                    self.planner.reserve(self.manifest.outputs(item))
+                    self.skip_unchanged(item, self.total_files)
+                elif kind == "unreadable":
+                    self.total_files += 1
+                    self.reject(*item, self.total_files)
+                elif kind == "scan_done":
+                    scan_done = True
+                    self.on_scan_done(backlog)
+                elif kind == "done":
+                    in_flight -= 1
+                    self.memory_in_use -= item.result().footprint
+                    self.scratch.unreserve(item.result().scratch_bytes)
+                    if item.result().scratch:
+                        self.scratch.drop(item.result().scratch_dir)
+                    self.record_result(item, self.total_files)
+                    self.release_duplicates(item.result(), self.total_files)
+
+            if speculator:
+                speculator.stop()
+
+    def on_scan_done(self, backlog):
+        """Report the final count and release an ordered batch to the backlog."""
+        total_files = self.total_files
+        if total_files == 0:
+            self.emit_status("No image files found")
+            return
+        if self.planner.policy == "ask":
+            self.resolve_conflicts()
+        if self.pending_files:
+            # Claim outputs in discovery order so renames don't depend on it
+            files = [f for f in self.pending_files if self.plan(f, total_files)]
+            if self.scheduling != "discovery":
+                self.emit_status(
+                    f"Ordering {total_files} images ({self.scheduling})..."
+                )
+                files = order_image_files(
+                    files,
+                    self.scheduling,
+                    estimate=lambda path: self.footprints[path][1],
+                )
+            backlog.extend(files)
+            self.pending_files = []
+        self.emit_status(
+            f"Found {total_files} images. Starting multi-threaded processing..."
+        )
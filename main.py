@@ -7,16 +7,10 @@ version: 1.2.0
 
 import os
 import platform
-import shutil
-import subprocess
 import sys
-import unicodedata
-import winreg
-from concurrent.futures import ThreadPoolExecutor
+import threading
 from pathlib import Path
-from typing import Union
 
-from pymage_size import get_image_size
 from PySide6.QtCore import QByteArray, Qt, QThread, QTimer, Signal
 from PySide6.QtGui import (
     QDragEnterEvent,
@@ -53,30 +47,23 @@ from PySide6.QtWidgets import (
     QWidget,
 )
 
+from engine import (
+    FORMATS,
+    JOURNAL_NAME,
+    MAX_PIXELS,
+    SCHEDULING_POLICIES,
+    BatchProcessor,
+    Catalog,
+    FileStats,
+    ImageProcessor,
+    detect_gpu_acceleration,
+    get_available_cpus,
+    get_optimal_thread_count,
+    validate_resize_input,
+)
 
-# --- Robust Path Helper for Windows Long/Unicode Paths ---
-def robust_path(p: Union[str, Path]) -> str:
-    """Return a path string robust for long/Unicode paths on Windows."""
-    if not isinstance(p, (str, Path)):
-        return p
-    p = str(p)
-    if platform.system() == "Windows":
-        # Remove any existing prefix
-        if p.startswith("\\\\?\\"):
-            return p
-        # Accept both forward and backward slashes
-        p = p.replace("/", "\\")
-        # If path is already short, don't add prefix
-        if len(p) < 240 and not any(ord(c) > 127 for c in p):
-            return p
-        # Only add prefix for absolute paths
-        if os.path.isabs(p):
-            # UNC path
-            if p.startswith("\\\\"):  # network path
-                return "\\\\?\\UNC" + p[1:]
-            else:
-                return "\\\\?\\" + p
-    return p
+if platform.system() == "Windows":
+    import winreg
 
 
 def is_windows_light_theme():
@@ -103,25 +90,6 @@ def is_windows_light_theme():
         return brightness > 127.5
 
 
-def get_resources_folder():
-    """Get the resources folder in LocalAppData"""
-    if platform.system() != "Windows":
-        # Fallback for non-Windows systems
-        return Path(__file__).parent / "resources"
-
-    local_appdata = os.getenv("LOCALAPPDATA")
-    if local_appdata is None:
-        local_appdata = str(Path.home() / "AppData" / "Local")
-
-    resources_path = Path(local_appdata) / "MMImageOptimizer" / "resources"
-
-    # If resources folder doesn't exist, fall back to local resources
-    if not resources_path.exists():
-        return Path(__file__).parent / "resources"
-
-    return resources_path
-
-
 def get_localappdata_folder():
     global local_appdata
     if platform.system() != "Windows":
@@ -145,18 +113,6 @@ def get_localappdata_folder():
         return None
 
 
-# Use pathlib for robust path handling
-RESOURCES_DIR = get_resources_folder()
-MAGICK = RESOURCES_DIR / "magick.exe"
-CWEBP = RESOURCES_DIR / "cwebp.exe"
-AVIFENC = RESOURCES_DIR / "avifenc.exe"
-CJPEGLI = RESOURCES_DIR / "cjpegli.exe"
-OXIPNG = RESOURCES_DIR / "oxipng.exe"
-PNGQUANT = RESOURCES_DIR / "pngquant.exe"
-EXIFTOOL = RESOURCES_DIR / "exiftool.exe"
-
-FORMATS = ["PNG", "JPEG", "WebP", "AVIF"]
-
 MOHSENI_LOGO = """<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 256 256"><rect width="256" height="256" rx="64" fill="#0f52ba"/><path d="M63.9,79.1c-3.7-5.4-9.9-8.7-16.4-8.7h-15.9l13.7,17.8h2.3c.7,0,1.3.3,1.6.9l47.1,69.4c12,17.5,35.9,22,53.4,9.9,3.9-2.7,7.3-6,9.9-9.9l47.1-69.4c.1-.2.3-.4.5-.5.9-.6,2.1-.4,2.7.5v63.7c0,8.2-6.7,14.9-14.9,14.9h-7.3v17.8h7.3c18.1,0,32.7-14.6,32.7-32.7v-63.7c-.5-10.8-9.6-19.1-20.4-18.7-6.2.3-11.9,3.5-15.4,8.7l-47.2,69.6c-1.4,1.9-3,3.6-4.9,4.9-9.3,6.6-22.2,4.4-28.8-4.9l-47.2-69.6h0ZM46,152.9v-34l-17.8,24v10c0,18.1,14.6,32.7,32.7,32.7h7.3v-17.8h-7.3c-8.2,0-14.9-6.7-14.9-14.9Z" fill="#fff"/></svg>"""
 ICON_FOLDER_INPUT = """<svg xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24" stroke-width="1.5" stroke="currentColor" class="size-6">
   <path stroke-linecap="round" stroke-linejoin="round" d="M12 10.5v6m3-3H9m4.06-7.19-2.12-2.12a1.5 1.5 0 0 0-1.061-.44H4.5A2.25 2.25 0 0 0 2.25 6v12a2.25 2.25 0 0 0 2.25 2.25h15A2.25 2.25 0 0 0 21.75 18V9a2.25 2.25 0 0 0-2.25-2.25h-5.379a1.5 1.5 0 0 1-1.06-.44Z" />
@@ -208,562 +164,6 @@ def svg_to_icon(svg_str, color="#181818", size=(24, 24), type="icon"):
         return pixmap
 
 
-def detect_gpu_acceleration():
-    """Detect if GPU acceleration is available for ImageMagick"""
-    try:
-        result = subprocess.run(
-            [str(MAGICK), "-list", "configure"],
-            capture_output=True,
-            text=True,
-            timeout=10,
-        )
-        output = result.stdout.lower()
-
-        # Check for OpenCL or CUDA support
-        has_opencl = "opencl" in output
-        has_cuda = "cuda" in output
-
-        return {
-            "available": has_opencl or has_cuda,
-            "opencl": has_opencl,
-            "cuda": has_cuda,
-        }
-    except:
-        return {"available": False, "opencl": False, "cuda": False}
-
-
-def get_optimal_thread_count():
-    """Get optimal thread count for processing"""
-    cpu_count = os.cpu_count() or 4
-    # Use 75% of available cores, minimum 1, maximum 8
-    return max(1, min(8, int(cpu_count * 0.75)))
-
-
-def should_resize(input_img_path, target_size):
-    img = get_image_size(robust_path(input_img_path))
-    width, height = img.get_dimensions()
-
-    # Pixel value
-    if isinstance(target_size, int):
-        # Don't upscale: skip if target size is larger than original
-        if target_size >= min(width, height):
-            return False
-        else:
-            return True
-
-    # Percentage string, e.g., "50%"
-    if isinstance(target_size, str) and target_size.endswith("%"):
-        try:
-            pct = float(target_size.rstrip("%"))
-            if pct <= 0:
-                return False
-            new_w = int(width * pct / 100)
-            new_h = int(height * pct / 100)
-            # Don't upscale
-            if new_w >= width or new_h >= height:
-                return False
-            else:
-                return True
-        except Exception:
-            return False
-
-    # Float < 1, treat as percent
-    if isinstance(target_size, float) and 0 < target_size < 1:
-        new_w = int(width * target_size)
-        new_h = int(height * target_size)
-        if new_w >= width or new_h >= height:
-            return False
-        else:
-            return True
-
-    # fallback
-    return False
-
-
-def validate_resize_input(val):
-    val = str(val).strip().replace(" ", "")
-
-    # Blank or missing input becomes default
-    if not val:
-        return 256
-
-    # Handle percentage like '0%' or '105%'
-    if val.endswith("%"):
-        pct_str = val[:-1]
-        try:
-            pct_val = float(pct_str)
-        except Exception:
-            pct_val = 100  # fallback
-        # Clamp between 1 and 100
-        pct_val = max(1, min(pct_val, 100))
-        return f"{int(pct_val)}%" if pct_val.is_integer() else f"{pct_val:.2f}%"
-
-    # Accept float <1 as percent (e.g. 0.5 means 50%)
-    try:
-        float_val = float(val)
-        if 0 < float_val < 1:
-            pct_val = float_val * 100
-            pct_val = max(1, min(pct_val, 100))
-            return f"{int(pct_val)}%" if pct_val.is_integer() else f"{pct_val:.2f}%"
-        # Otherwise, treat as pixel size
-        n = int(round(float_val))
-        # Clamp to safe range
-        n = max(2, min(n, 10000))
-        return n
-    except Exception:
-        return 256  # fallback default
-
-
-class FileStats:
-    """Class to track file size statistics"""
-
-    def __init__(self):
-        self.original_size = 0
-        self.optimized_size = 0
-        self.files_processed = 0
-
-    def add_file(self, original_size, optimized_size):
-        self.original_size += original_size
-        self.optimized_size += optimized_size
-        self.files_processed += 1
-
-    def get_compression_ratio(self):
-        if self.original_size == 0:
-            return 0
-        return ((self.original_size - self.optimized_size) / self.original_size) * 100
-
-    def get_size_saved(self):
-        return self.original_size - self.optimized_size
-
-    def format_size(self, size_bytes):
-        """Format size in human readable format"""
-        for unit in ["B", "KB", "MB", "GB"]:
-            if size_bytes < 1024.0:
-                return f"{size_bytes:.1f} {unit}"
-            size_bytes /= 1024.0
-        return f"{size_bytes:.1f} TB"
-
-
-# --- Robust call helper using robust_path ---
-def call(args, progress_callback=None, use_gpu=False):
-    """Helper to call subprocess silently without console windows, robust to long/Unicode paths."""
-    str_args = [robust_path(arg) for arg in args]
-
-    # Add GPU acceleration if available and requested
-    if use_gpu and str_args[0].endswith("magick.exe"):
-        gpu_info = detect_gpu_acceleration()
-        if gpu_info["available"]:
-            if gpu_info["opencl"]:
-                str_args.insert(1, "-define")
-                str_args.insert(2, "accelerate:auto-threshold=1")
-
-    startupinfo = None
-    if platform.system() == "Windows":
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        startupinfo.wShowWindow = subprocess.SW_HIDE
-
-    result = subprocess.run(
-        str_args,
-        check=True,
-        startupinfo=startupinfo,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-
-    if progress_callback:
-        progress_callback()
-
-    return result
-
-
-class ImageProcessor:
-    @staticmethod
-    def is_invalid_windows_filename(filename):
-        # Forbidden characters
-        forbidden = set('<>:"/\\|?*')
-        reserved = (
-            {"CON", "PRN", "AUX", "NUL"}
-            | {f"COM{i}" for i in range(1, 10)}
-            | {f"LPT{i}" for i in range(1, 10)}
-        )
-        # Remove extension for reserved check
-        name, *_ = filename.split(".")
-        # Check forbidden chars or reserved names
-        if any(c in forbidden for c in filename):
-            return True
-        if name.upper() in reserved:
-            return True
-        # Control chars
-        if any(ord(c) < 32 for c in filename):
-            return True
-        # Trailing space or dot
-        if filename.endswith(" ") or filename.endswith("."):
-            return True
-        # Only spaces or dots
-        if filename.strip(" .") == "":
-            return True
-        return False
-
-    """Class to handle individual image processing with GPU support"""
-
-    def __init__(self, use_gpu=False):
-        self.use_gpu = use_gpu
-
-    def process_single_image(
-        self,
-        file_path,
-        tmp_dir,
-        base_name,
-        resolutions,
-        formats,
-        qmap,
-        qlossless_map,
-        strip_meta,
-        output_dir,
-    ):
-        # Pre-check for invalid or reserved file names (Windows)
-        errors = []
-        if platform.system() == "Windows":
-            # Normalize Unicode to NFC
-            norm_name = unicodedata.normalize("NFC", file_path.name)
-            if self.is_invalid_windows_filename(norm_name):
-                errors.append(f"Invalid or reserved file name: {file_path.name}")
-                stats = FileStats()
-                stats.errors = errors
-                return stats
-        """Process a single image and return statistics"""
-        stats = FileStats()
-        original_size = file_path.stat().st_size
-        errors = []
-
-        # Normalize to PNG
-        try:
-            normalized = self.normalize_to_png(file_path, tmp_dir, base_name)
-        except Exception as e:
-            errors.append(f"Normalize to PNG failed: {file_path.name} ({e})")
-            stats.errors = errors
-            return stats
-
-        if strip_meta:
-            try:
-                # Strip metadata using exiftool
-                call([EXIFTOOL, "-all=", "-overwrite_original", str(normalized)])
-            except Exception as e:
-                errors.append(f"Metadata strip failed: {file_path.name} ({e})")
-
-        # Resize step
-        try:
-            resized = self.generate_resized_variants(
-                normalized, tmp_dir, base_name, resolutions
-            )
-        except Exception as e:
-            errors.append(f"Resize failed: {file_path.name} ({e})")
-            stats.errors = errors
-            return stats
-
-        # Process each resolution and format
-
-        for res in resolutions:
-            size = res["size"]
-            source_png = resized[size]
-            filename_base = base_name if size == "original" else f"{base_name}_{size}"
-
-            if "PNG" in formats:
-                try:
-                    png_out = output_dir / f"{filename_base}.png"
-                    if png_out.exists():
-                        if not self.ask_overwrite(png_out):
-                            continue
-                    shutil.copyfile(robust_path(source_png), robust_path(png_out))
-                    self.encode_png(
-                        robust_path(source_png),
-                        robust_path(png_out),
-                        qmap.get("PNG", 82),
-                        qlossless_map.get("PNG", True),
-                    )
-                    optimized_size = png_out.stat().st_size
-                    stats.add_file(original_size, optimized_size)
-                except Exception as e:
-                    errors.append(f"PNG: {filename_base}.png ({e})")
-
-            if "WebP" in formats:
-                try:
-                    webp_out = output_dir / f"{filename_base}.webp"
-                    if webp_out.exists():
-                        if not self.ask_overwrite(webp_out):
-                            continue
-                    self.encode_webp(
-                        robust_path(source_png),
-                        robust_path(webp_out),
-                        qmap.get("WebP", 82),
-                    )
-                    optimized_size = webp_out.stat().st_size
-                    stats.add_file(original_size, optimized_size)
-                except Exception as e:
-                    errors.append(f"WebP: {filename_base}.webp ({e})")
-
-            if "AVIF" in formats:
-                try:
-                    avif_out = output_dir / f"{filename_base}.avif"
-                    if avif_out.exists():
-                        if not self.ask_overwrite(avif_out):
-                            continue
-                    self.encode_avif(
-                        robust_path(source_png),
-                        robust_path(avif_out),
-                        qmap.get("AVIF", 65),
-                    )
-                    optimized_size = avif_out.stat().st_size
-                    stats.add_file(original_size, optimized_size)
-                except Exception as e:
-                    errors.append(f"AVIF: {filename_base}.avif ({e})")
-
-            if "JPEG" in formats:
-                try:
-                    jpg_out = output_dir / f"{filename_base}.jpg"
-                    if jpg_out.exists():
-                        if not self.ask_overwrite(jpg_out):
-                            continue
-                    self.encode_jpegli(
-                        robust_path(source_png),
-                        robust_path(jpg_out),
-                        qmap.get("JPEG", 82),
-                        qlossless_map.get("JPEG", False),
-                    )
-                    optimized_size = jpg_out.stat().st_size
-                    stats.add_file(original_size, optimized_size)
-                except Exception as e:
-                    errors.append(f"JPEG: {filename_base}.jpg ({e})")
-
-        stats.errors = errors
-        return stats
-
-    def normalize_to_png(self, input_path, tmp_dir, base_name):
-        out_png = tmp_dir / f"{base_name}_norm.png"
-        if input_path.suffix.lower() == ".png":
-            shutil.copyfile(robust_path(input_path), robust_path(out_png))
-        else:
-            cmd = [MAGICK, robust_path(input_path), robust_path(out_png)]
-            call(cmd, use_gpu=self.use_gpu)
-        return out_png
-
-    def sort_res_modes(self, res_modes):
-        def key_fn(r):
-            size = r.get("size")
-            if isinstance(size, str) and size.endswith("%"):
-                return float(size.rstrip("%"))
-            try:
-                return float(size)
-            except (TypeError, ValueError):
-                return float("inf")
-
-        return sorted(res_modes, key=key_fn, reverse=True)
-
-    def generate_resized_variants(
-        self,
-        input_path,
-        tmp_dir,
-        base_name,
-        res_modes,
-    ):
-        """Generate independent resized copies from the original for maximum quality.
-
-        Args:
-            input_path: Path to original image.
-            tmp_dir: Temporary directory for outputs.
-            base_name: Base filename without extension.
-            res_modes: List of dicts like [{'size': 256, 'mode': 'fit'}, {'size': '50%', 'mode': 'crop'}].
-
-        Returns:
-            Dict of {size_key: output_path} for successful resizes.
-
-        Raises:
-            ValueError: If invalid resize parameters.
-        """
-        intermediates = {}
-
-        # Early exit if no modes
-        if not res_modes:
-            return intermediates
-
-        # Get original dimensions once (avoids repeated I/O)
-        try:
-            img_info = get_image_size(robust_path(input_path))
-            orig_width, orig_height = img_info.get_dimensions()
-        except Exception as e:
-            raise ValueError(f"Failed to get original dimensions: {e}")
-
-        # Handle "original" separately if present
-        has_original = any(r.get("size") == "original" for r in res_modes)
-        if has_original:
-            out_path = tmp_dir / f"{base_name}_original.png"
-            shutil.copyfile(robust_path(input_path), robust_path(out_path))
-            intermediates["original"] = out_path
-            res_modes = [r for r in res_modes if r.get("size") != "original"]
-
-        # Sort modes descending (largest first) for potential future optimizations
-        sorted_modes = self.sort_res_modes(res_modes)
-
-        for r in sorted_modes:
-            size = r["size"]
-            mode = r.get("mode", "fit")
-
-            # Validate and normalize size early
-            try:
-                validated_size = validate_resize_input(size)
-            except ValueError as e:
-                self.errors.append(f"Invalid resize size '{size}': {e}")
-                continue
-
-            # Compute target dimensions as integers to avoid float drift
-            if isinstance(validated_size, str) and validated_size.endswith("%"):
-                pct = float(validated_size.rstrip("%")) / 100.0
-                target_width = int(orig_width * pct)  # Truncate to int
-                target_height = int(orig_height * pct)
-                if target_width < 1 or target_height < 1:
-                    continue  # Skip tiny sizes
-                resize_str = f"{target_width}x{target_height}"
-            else:  # Pixel size
-                target_size = int(validated_size)
-                if mode in ["fit", "crop"]:
-                    # Preserve aspect ratio for fit/crop
-                    aspect = orig_width / orig_height
-                    if orig_width > orig_height:
-                        target_width = target_size
-                        target_height = int(target_size / aspect)
-                    else:
-                        target_height = target_size
-                        target_width = int(target_size * aspect)
-                    resize_str = f"{target_width}x{target_height}"
-                elif mode == "width":
-                    resize_str = f"{target_size}x"
-                elif mode == "height":
-                    resize_str = f"x{target_size}"
-                else:
-                    raise ValueError(f"Unknown mode: {mode}")
-
-            # Skip if not downscaling (as per should_resize)
-            if not should_resize(input_path, validated_size):
-                continue
-
-            out_path = tmp_dir / f"{base_name}_{validated_size}.png"
-
-            # Build cmd with quality flags
-            cmd_base = [
-                MAGICK,
-                robust_path(input_path),
-                "-colorspace",
-                "RGB",
-                "-filter",
-                "RobidouxSharp",  # Your high-quality filter
-            ]
-
-            if mode == "crop":
-                cmd = cmd_base + [
-                    "-resize",
-                    f"{resize_str}^",
-                    "-gravity",
-                    "center",
-                    "-extent",
-                    f"{target_width}x{target_height}",
-                ]
-            else:
-                cmd = cmd_base + ["-resize", resize_str]
-
-            cmd += ["-colorspace", "sRGB", robust_path(out_path)]
-
-            try:
-                call(cmd, use_gpu=self.use_gpu)
-                intermediates[validated_size] = out_path
-            except subprocess.CalledProcessError as e:
-                # Robust: Skip and log instead of crashing
-                self.errors.append(f"Error resizing to {validated_size}: {e}")
-                continue  # Or raise if critical
-
-        return intermediates
-
-    def encode_webp(self, in_png, out_path, quality):
-        cmd = [
-            CWEBP,
-            "-q",
-            str(quality),
-            robust_path(in_png),
-            "-o",
-            robust_path(out_path),
-        ]
-        call(cmd)
-
-    def encode_avif(self, in_png, out_path, quality):
-        cmd = [
-            AVIFENC,
-            "-q",
-            str(quality),
-            "--speed",
-            "2",
-            robust_path(in_png),
-            robust_path(out_path),
-        ]
-        call(cmd)
-
-    def encode_jpegli(
-        self, in_png, out_path, quality=None, lossless=False, chroma_444=False
-    ):
-        """Encode JPEG with jpegli (cjpegli) CLI."""
-        cmd = [str(CJPEGLI), robust_path(in_png), robust_path(out_path)]
-
-        if lossless:
-            cmd += ["--distance", "1.0"]
-        elif quality is not None:
-            cmd += ["--quality", str(quality)]
-        else:
-            cmd += ["--quality", "82"]
-
-        if chroma_444:
-            cmd += ["--chroma_subsampling=444"]
-
-        # Remove empty strings (for safety)
-        cmd = [arg for arg in cmd if arg]
-
-        call(cmd)
-
-    def encode_png(self, in_png, out_path, quality=None, lossless=True):
-        oxi_cmd = [
-            OXIPNG,
-            "--opt",
-            "max",
-            "--zopfli",
-            "--force",
-            "--out",
-            robust_path(out_path),
-            robust_path(in_png),
-            "--timeout",
-            "30",
-            "--interlace",
-            "0",
-        ]
-        if not lossless:
-            oxi_cmd.append("--scale16")
-        call(oxi_cmd)
-
-        if not lossless:
-            # If not lossless, use pngquant for further optimization
-            if quality is None:
-                quality = 82
-            pq_cmd = [
-                PNGQUANT,
-                "--quality",
-                f"{max(quality - 15, 50)}-{quality}",
-                "--speed",
-                "1",
-                "--output",
-                robust_path(out_path),
-                "--force",
-                robust_path(out_path),
-            ]
-            call(pq_cmd)
-
-
 class ProcessingThread(QThread):
     """Thread for multi-threaded image processing"""
 
@@ -772,6 +172,8 @@ class ProcessingThread(QThread):
     stats_updated = Signal(object)  # FileStats object
     finished = Signal()
     error_occurred = Signal(str)
+    # Existing output paths; connect blocking and set conflict_choice
+    conflicts_found = Signal(list)
 
     def __init__(
         self,
@@ -786,20 +188,46 @@ class ProcessingThread(QThread):
         recursive,
         thread_count,
         use_gpu,
+        scheduling="discovery",
+        adaptive=False,
+        memory_budget=None,
+        max_pixels=MAX_PIXELS,
+        incremental=False,
+        dedupe=False,
+        cache=False,
+        resume=False,
     ):
         super().__init__()
         self.processor = processor
-        self.input_sources = input_sources
-        self.output_dir = Path(output_dir)
-        self.resolutions = resolutions
-        self.formats = formats
-        self.qmap = qmap
-        self.qlossless_map = qlossless_map
-        self.strip_meta = strip_meta
-        self.recursive = recursive
-        self.thread_count = thread_count
-        self.use_gpu = use_gpu
-        self.total_stats = FileStats()
+        self.conflict_choice = "skip"
+        self.batch = BatchProcessor(
+            input_sources,
+            output_dir,
+            resolutions,
+            formats,
+            qmap,
+            qlossless_map,
+            strip_meta,
+            recursive,
+            thread_count,
+            use_gpu,
+            progress_callback=lambda current, total, filename: (
+                self.progress_updated.emit(current, total)
+            ),
+            status_callback=self.status_updated.emit,
+            stats_callback=self.stats_updated.emit,
+            conflict_policy="ask",
+            conflict_callback=self.ask_conflicts,
+            scheduling=scheduling,
+            adaptive=adaptive,
+            memory_budget=memory_budget,
+            max_pixels=max_pixels,
+            incremental=incremental,
+            dedupe=dedupe,
+            cache=cache,
+            resume=resume,
+        )
+        self.total_stats = self.batch.total_stats
 
     def run(self):
         try:
@@ -808,127 +236,28 @@ class ProcessingThread(QThread):
         except Exception as e:
             self.error_occurred.emit(str(e))
 
-    def gather_image_files(self, sources, recursive=False):
-        """Given a list of Path objects (files or folders), return a flat list of image files"""
-        exts = {
-            ".jpg",
-            ".jpeg",
-            ".png",
-            ".webp",
-            ".avif",
-            ".gif",
-            ".bmp",
-            ".tiff",
-            ".tif",
-            ".heic",
-            ".heif",
-            ".dds",
-            ".j2c",
-            ".j2k",
-            ".jp2",
-            ".jpe",
-            ".jxl",
-            ".png24",
-            ".png32",
-            ".png48",
-            ".png64",
-            ".png16",
-            ".png8",
-            ".psd",
-            ".tga",
-            ".ico",
-        }
-        image_files = []
-        for src in sources:
-            src = Path(src)
-            if src.is_dir():
-                if recursive:
-                    for ext in exts:
-                        image_files.extend(src.rglob(f"*{ext}"))
-                        image_files.extend(src.rglob(f"*{ext.upper()}"))
-                else:
-                    for f in src.iterdir():
-                        if f.is_file() and f.suffix.lower() in exts:
-                            image_files.append(f)
-            elif src.is_file() and src.suffix.lower() in exts:
-                image_files.append(src)
-        return image_files
+    def ask_conflicts(self, paths):
+        """Ask the UI once how to handle outputs that already exist."""
+        self.conflicts_found.emit(paths)
+        return self.conflict_choice
 
-    def process_images_multithreaded(self):
-        """Process images using multiple threads"""
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-        tmp_dir = self.output_dir / "_tmp"
-        tmp_dir.mkdir(parents=True, exist_ok=True)
+    def cancel(self):
+        """Stop the batch; run() finishes shortly after, keeping finished outputs."""
+        self.batch.cancel()
 
-        self.status_updated.emit("Gathering image files...")
-        image_files = self.gather_image_files(self.input_sources, self.recursive)
-        total_files = len(image_files)
+    def pause(self):
+        self.batch.pause()
 
-        if total_files == 0:
-            self.status_updated.emit("No image files found")
-            return
-
-        self.status_updated.emit(
-            f"Found {total_files} images. Starting multi-threaded processing..."
-        )
+    def unpause(self):
+        self.batch.unpause()
 
-        # Create individual tmp directories for each thread to avoid conflicts
-        thread_tmp_dirs = []
-        for i in range(self.thread_count):
-            thread_tmp_dir = tmp_dir / f"thread_{i}"
-            thread_tmp_dir.mkdir(exist_ok=True)
-            thread_tmp_dirs.append(thread_tmp_dir)
-
-        completed_files = 0
-
-        # Process images using ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
-            # Create processor instances for each thread
-            processors = [
-                ImageProcessor(self.use_gpu) for _ in range(self.thread_count)
-            ]
-
-            # Submit all tasks
-            futures = []
-            for i, file_path in enumerate(image_files):
-                thread_id = i % self.thread_count
-                processor = processors[thread_id]
-                thread_tmp_dir = thread_tmp_dirs[thread_id]
-
-                future = executor.submit(
-                    processor.process_single_image,
-                    file_path,
-                    thread_tmp_dir,
-                    file_path.stem,
-                    self.resolutions,
-                    self.formats,
-                    self.qmap,
-                    self.qlossless_map,
-                    self.strip_meta,
-                    self.output_dir,
-                )
-                futures.append((future, file_path.name))
-
-            # Process completed tasks
-            for future, filename in futures:
-                try:
-                    stats = future.result()
-                    self.total_stats.original_size += stats.original_size
-                    self.total_stats.optimized_size += stats.optimized_size
-                    self.total_stats.files_processed += 1
+    @property
+    def cancelled(self):
+        return self.batch.cancelled
 
-                    completed_files += 1
-                    self.progress_updated.emit(completed_files, total_files)
-                    self.status_updated.emit(
-                        f"Processed: {filename} ({completed_files}/{total_files})"
-                    )
-                    self.stats_updated.emit(self.total_stats)
-
-                except Exception as e:
-                    self.status_updated.emit(f"Error processing {filename}: {str(e)}")
-
-        # Cleanup
-        shutil.rmtree(tmp_dir)
+    def process_images_multithreaded(self):
+        """Process images using multiple threads"""
+        return self.batch.run()
 
 
 class DragDropLabel(QLabel):
@@ -1120,11 +449,13 @@ class ResolutionDialog(QDialog):
     def get_reference_dimensions(self):
         """Get dimensions of a sample input file or use default."""
         if self.input_files:
+            catalog = Catalog()
             try:
-                img = get_image_size(robust_path(self.input_files[0]))
-                return img.get_dimensions()
-            except Exception:
-                pass
+                dimensions = catalog.dimensions(self.input_files[0])
+            finally:
+                catalog.close()
+            if dimensions:
+                return dimensions
         return 1920, 1080  # Default if no files or error
 
     def handle_text_changed(self, text):
@@ -1332,24 +663,47 @@ class ResolutionDialog(QDialog):
 
 
 class MainWin(QWidget):
+    gpu_detected = Signal(object)  # detect_gpu_acceleration() result
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("MMImageOptimizer - Mohammadreza Mohseni")
         self.setMinimumWidth(800)
         self.setMinimumHeight(600)
         self.setWindowIcon(svg_to_icon(MOHSENI_LOGO, type="icon"))
-        self.overwrite_policy = None
 
         self.input_dir = ""
         self.output_dir = ""
         self.processing_thread = None
-        self.gpu_info = detect_gpu_acceleration()
+        self.gpu_info = {"available": False, "opencl": False, "cuda": False}
         self.process_completed = False
 
         QApplication.instance().paletteChanged.connect(self.apply_icon_style)
         self.apply_icon_style()
         self.initUI()
 
+        # Probing ImageMagick can take seconds the first time; don't block startup
+        self.gpu_detected.connect(self.apply_gpu_info)
+        threading.Thread(
+            target=lambda: self.gpu_detected.emit(detect_gpu_acceleration()),
+            daemon=True,
+        ).start()
+
+    def apply_gpu_info(self, gpu_info):
+        """Enable the GPU option once the tool registry has probed ImageMagick."""
+        self.gpu_info = gpu_info
+        self.gpu_check.setChecked(gpu_info["available"])
+        self.gpu_check.setEnabled(gpu_info["available"])
+        if gpu_info["available"]:
+            gpu_text = "GPU acceleration available"
+            if gpu_info["opencl"]:
+                gpu_text += " (OpenCL)"
+            if gpu_info["cuda"]:
+                gpu_text += " (CUDA)"
+        else:
+            gpu_text = "GPU acceleration not available"
+        self.gpu_check.setToolTip(gpu_text)
+
     def initUI(self):
         initial_icon_color = "#181818" if is_windows_light_theme() else "#ffffff"
         layout = QVBoxLayout(self)
@@ -1392,6 +746,31 @@ class MainWin(QWidget):
         self.recursiveCheck.setFixedHeight(16)
         self.recursiveCheck.setToolTip("Process images in subfolders as well")
 
+        self.incrementalCheck = QCheckBox("Skip unchanged files")
+        self.incrementalCheck.setChecked(False)
+        self.incrementalCheck.setFixedHeight(16)
+        self.incrementalCheck.setToolTip(
+            "Skip images already optimized into this output folder\n"
+            "with the same settings, if neither they nor their outputs changed"
+        )
+
+        self.dedupeCheck = QCheckBox("Process identical files once")
+        self.dedupeCheck.setChecked(False)
+        self.dedupeCheck.setFixedHeight(16)
+        self.dedupeCheck.setToolTip(
+            "Files with the same content are optimized once;\n"
+            "the other copies get linked or copied outputs"
+        )
+
+        self.cacheCheck = QCheckBox("Cache resized and encoded images")
+        self.cacheCheck.setChecked(False)
+        self.cacheCheck.setFixedHeight(16)
+        self.cacheCheck.setToolTip(
+            "Keep resized and encoded files in a local cache (up to 2 GB each).\n"
+            "Reruns that only change quality settings skip resizing, and\n"
+            "unchanged encodes are copied from the cache"
+        )
+
         input_widget = QWidget()
         input_widget.setLayout(input_layout)
 
@@ -1458,6 +837,9 @@ class MainWin(QWidget):
         folder_layout = QVBoxLayout(folder_group)
         folder_layout.addLayout(side_by_side)
         folder_layout.addWidget(self.recursiveCheck)
+        folder_layout.addWidget(self.incrementalCheck)
+        folder_layout.addWidget(self.dedupeCheck)
+        folder_layout.addWidget(self.cacheCheck)
         folder_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
         folder_group.setLayout(folder_layout)
         layout.addWidget(folder_group)
@@ -1468,7 +850,7 @@ class MainWin(QWidget):
 
         # Thread count and GPU in one row
         self.thread_count_spin = QSpinBox()
-        self.thread_count_spin.setRange(1, 16)
+        self.thread_count_spin.setRange(1, max(16, get_available_cpus() * 2))
         self.thread_count_spin.setValue(get_optimal_thread_count())
         self.thread_count_spin.setToolTip("Number of parallel processing threads")
         self.thread_count_spin.setFixedWidth(80)
@@ -1480,18 +862,45 @@ class MainWin(QWidget):
         extra_layout.addWidget(self.thread_count_spin)
         extra_layout.addWidget(QLabel(f"(Optimal: {get_optimal_thread_count()})"))
 
+        self.adaptive_check = QCheckBox("Adaptive")
+        self.adaptive_check.setChecked(False)
+        self.adaptive_check.setToolTip(
+            "Start from the thread count above and adjust it while running,\n"
+            "based on CPU load and free memory (up to all available cores)"
+        )
+        extra_layout.addWidget(self.adaptive_check)
+
+        self.memory_spin = QSpinBox()
+        self.memory_spin.setRange(0, 1024)
+        self.memory_spin.setValue(0)
+        self.memory_spin.setSpecialValueText("Auto")
+        self.memory_spin.setSuffix(" GB")
+        self.memory_spin.setToolTip(
+            "Memory for decoded images in flight at once.\n"
+            "Large images wait (small ones keep going) until it fits.\n"
+            "Auto: half of the free memory"
+        )
+        self.memory_spin.setFixedWidth(80)
+        extra_layout.addSpacing(30)
+        extra_layout.addWidget(QLabel("Memory:"))
+        extra_layout.addWidget(self.memory_spin)
+
+        self.order_combo = QComboBox()
+        self.order_combo.addItems(SCHEDULING_POLICIES)
+        self.order_combo.setCurrentText("discovery")
+        self.order_combo.setToolTip(
+            "Discovery: process files in the order they are found\n"
+            "Largest: biggest images first, shortest total time\n"
+            "Smallest: smallest images first, fastest first results\n"
+            "Interleaved: alternate largest and smallest"
+        )
+        extra_layout.addSpacing(30)
+        extra_layout.addWidget(QLabel("Order:"))
+        extra_layout.addWidget(self.order_combo)
+
         self.gpu_check = QCheckBox("Enable GPU Acceleration")
-        self.gpu_check.setChecked(self.gpu_info["available"])
-        self.gpu_check.setEnabled(self.gpu_info["available"])
-        if self.gpu_info["available"]:
-            gpu_text = "GPU acceleration available"
-            if self.gpu_info["opencl"]:
-                gpu_text += " (OpenCL)"
-            if self.gpu_info["cuda"]:
-                gpu_text += " (CUDA)"
-        else:
-            gpu_text = "GPU acceleration not available"
-        self.gpu_check.setToolTip(gpu_text)
+        self.gpu_check.setEnabled(False)
+        self.gpu_check.setToolTip("Checking for GPU acceleration...")
         extra_layout.addSpacing(30)
         extra_layout.addWidget(self.gpu_check)
 
@@ -1685,39 +1094,76 @@ class MainWin(QWidget):
         self.btnGo.clicked.connect(self.runProcess)
         progress_layout.addWidget(self.btnGo)
 
+        # Pause and cancel the running batch
+        batch_controls = QHBoxLayout()
+        self.btnPause = QPushButton("Pause")
+        self.btnPause.setToolTip("Suspend the running tools; click again to continue.")
+        self.btnPause.setEnabled(False)
+        self.btnPause.clicked.connect(self.toggle_pause)
+        batch_controls.addWidget(self.btnPause)
+        self.btnCancel = QPushButton("Cancel")
+        self.btnCancel.setToolTip(
+            "Stop the batch. Finished outputs are kept and the batch can be resumed."
+        )
+        self.btnCancel.setEnabled(False)
+        self.btnCancel.clicked.connect(self.cancel_processing)
+        batch_controls.addWidget(self.btnCancel)
+        progress_layout.addLayout(batch_controls)
+
         # Add both groups to main_hbox
         main_hbox.addWidget(res_group, 2)
         main_hbox.addWidget(progress_group, 3)
         layout.addLayout(main_hbox)
 
-    def ask_overwrite(self, file_path):
-        if self.overwrite_policy == "overwrite_all":
-            return True
-        elif self.overwrite_policy == "skip_all":
-            return False
+    def toggle_pause(self):
+        if self.processing_thread is None:
+            return
+        if self.btnPause.text() == "Pause":
+            self.processing_thread.pause()
+            self.btnPause.setText("Continue")
+        else:
+            self.processing_thread.unpause()
+            self.btnPause.setText("Pause")
 
+    def cancel_processing(self):
+        if self.processing_thread is None:
+            return
+        self.btnPause.setEnabled(False)
+        self.btnCancel.setEnabled(False)
+        self.processing_thread.cancel()
+
+    def closeEvent(self, event):
+        # Don't leave tools running once the window is gone
+        if self.processing_thread is not None and self.processing_thread.isRunning():
+            self.process_completed = True
+            self.processing_thread.cancel()
+            self.processing_thread.wait()
+        super().closeEvent(event)
+
+    def resolve_conflicts(self, paths):
+        """Ask once for the whole batch; the processing thread waits for it."""
         msg = QMessageBox(self)
-        msg.setWindowTitle("File Exists")
-        msg.setText(f"Output file already exists:\n{file_path}\nOverwrite?")
-        overwrite = msg.addButton("Overwrite", QMessageBox.YesRole)
-        skip = msg.addButton("Skip", QMessageBox.NoRole)
-        overwrite_all = msg.addButton("Overwrite All", QMessageBox.AcceptRole)
-        skip_all = msg.addButton("Skip All", QMessageBox.RejectRole)
+        msg.setWindowTitle("Files Exist")
+        msg.setText(
+            f"{len(paths)} output files already exist in the output folder.\n"
+            "What should happen to them?"
+        )
+        msg.setDetailedText("\n".join(str(p) for p in paths[:200]))
+        overwrite = msg.addButton("Overwrite All", QMessageBox.YesRole)
+        rename = msg.addButton("Keep Both", QMessageBox.AcceptRole)
+        skip = msg.addButton("Skip Existing", QMessageBox.RejectRole)
+        msg.setDefaultButton(skip)
         msg.setIcon(QMessageBox.Warning)
         msg.exec()
 
         clicked = msg.clickedButton()
         if clicked == overwrite:
-            return True
-        elif clicked == overwrite_all:
-            self.overwrite_policy = "overwrite_all"
-            return True
-        elif clicked == skip:
-            return False
-        elif clicked == skip_all:
-            self.overwrite_policy = "skip_all"
-            return False
-        return False
+            choice = "overwrite"
+        elif clicked == rename:
+            choice = "rename"
+        else:
+            choice = "skip"
+        self.processing_thread.conflict_choice = choice
 
     def apply_icon_style(self):
         is_light = is_windows_light_theme()
@@ -1963,11 +1409,31 @@ class MainWin(QWidget):
         # Strip metadata option
         strip_meta = self.stripMeta_check.isChecked()
         recursive = self.recursiveCheck.isChecked()
+        incremental = self.incrementalCheck.isChecked()
+        dedupe = self.dedupeCheck.isChecked()
+        cache = self.cacheCheck.isChecked()
         thread_count = self.thread_count_spin.value()
         use_gpu = self.gpu_check.isChecked() and self.gpu_info["available"]
+        scheduling = self.order_combo.currentText()
+        adaptive = self.adaptive_check.isChecked()
+        memory_budget = (self.memory_spin.value() << 30) or None
+        resume = False
+        if (Path(self.output_dir) / JOURNAL_NAME).exists():
+            resume = (
+                QMessageBox.question(
+                    self,
+                    "Resume Batch",
+                    "An unfinished batch was found in the output folder.\n"
+                    "Resume it and skip the outputs it already finished?",
+                )
+                == QMessageBox.StandardButton.Yes
+            )
 
         # Start processing in thread
         self.btnGo.setEnabled(False)
+        self.btnPause.setText("Pause")
+        self.btnPause.setEnabled(True)
+        self.btnCancel.setEnabled(True)
         self.status_label.setText("Preparing multi-threaded processing...")
         self.progress_bar.setVisible(True)
         self.progress_bar.setValue(0)
@@ -1997,6 +1463,12 @@ class MainWin(QWidget):
                 self.processing_thread.error_occurred.disconnect(self.processing_error)
             except TypeError:
                 pass
+            try:
+                self.processing_thread.conflicts_found.disconnect(
+                    self.resolve_conflicts
+                )
+            except TypeError:
+                pass
             self.processing_thread.deleteLater()
             self.processing_thread = None
 
@@ -2015,12 +1487,22 @@ class MainWin(QWidget):
             recursive,
             thread_count,
             use_gpu,
+            scheduling,
+            adaptive,
+            memory_budget,
+            incremental=incremental,
+            dedupe=dedupe,
+            cache=cache,
+            resume=resume,
         )
         self.processing_thread.progress_updated.connect(self.update_progress)
         self.processing_thread.status_updated.connect(self.update_status)
         self.processing_thread.stats_updated.connect(self.update_stats)
         self.processing_thread.finished.connect(self.processing_finished)
         self.processing_thread.error_occurred.connect(self.processing_error)
+        self.processing_thread.conflicts_found.connect(
+            self.resolve_conflicts, Qt.ConnectionType.BlockingQueuedConnection
+        )
         self.processing_thread.start()
 
     def update_progress(self, current, total):
@@ -2053,13 +1535,57 @@ class MainWin(QWidget):
             Size Saved: {stats.format_size(size_saved)}
             Compression Ratio: {compression_ratio:.1f}%
         """.strip()
+        if stats.counters.get("unchanged"):
+            stats_text += f"\nSkipped (unchanged): {stats.counters['unchanged']}"
+        if stats.counters.get("skipped_outputs"):
+            stats_text += f"\nSkipped (exist): {stats.counters['skipped_outputs']}"
+        if stats.counters.get("resumed"):
+            stats_text += f"\nFinished before resume: {stats.counters['resumed']}"
+        if stats.counters.get("renamed"):
+            stats_text += f"\nRenamed to keep both: {stats.counters['renamed']}"
+        if stats.counters.get("duplicates"):
+            stats_text += (
+                f"\nDuplicates linked: {stats.counters['duplicates']} "
+                f"(saved ~{stats.counters.get('dedupe_saved_seconds', 0):.0f}s)"
+            )
+        collapsed = sum(
+            n for name, n in stats.counters.items() if name.startswith("collapsed_")
+        )
+        if collapsed:
+            stats_text += f"\nSame-pixel outputs linked: {collapsed}"
+        if stats.counters.get("cache_hits") or stats.counters.get("resize_cache_hits"):
+            stats_text += (
+                f"\nCache hits: {stats.counters.get('cache_hits', 0)} encoded, "
+                f"{stats.counters.get('resize_cache_hits', 0)} resized"
+            )
+        if stats.counters.get("staging_bytes_saved"):
+            stats_text += (
+                "\nCopying avoided: "
+                f"{stats.format_size(stats.counters['staging_bytes_saved'])}"
+            )
+        if stats.counters.get("streamed_rasters"):
+            stats_text += (
+                f"\nPiped in memory: {stats.counters['streamed_rasters']} rasters, "
+                f"{stats.format_size(stats.counters.get('stream_bytes', 0))}"
+            )
+        if stats.counters.get("speculative_wins"):
+            stats_text += f"\nSped up stragglers: {stats.counters['speculative_wins']}"
+        if stats.timeouts:
+            stats_text += f"\nTimed out: {len(stats.timeouts)}"
+        if stats.concurrency_log:
+            budgets = [d["budget"] for d in stats.concurrency_log]
+            stats_text += (
+                f"\nThreads: {budgets[-1]} (range {min(budgets)}-{max(budgets)}, "
+                f"{len(budgets) - 1} adjustments)"
+            )
 
         self.stats_text.setPlainText(stats_text)
         # Collect errors for summary
         if not hasattr(self, "all_errors"):
             self.all_errors = []
         if hasattr(stats, "errors") and stats.errors:
-            self.all_errors.extend(stats.errors)
+            # Totals carry every error so far; keep the latest snapshot
+            self.all_errors = list(stats.errors)
 
     def processing_finished(self):
         if not self.process_completed:
@@ -2072,7 +1598,14 @@ class MainWin(QWidget):
                 self.all_errors = []
             self.process_completed = True
             self.btnGo.setEnabled(True)
+            self.btnPause.setEnabled(False)
+            self.btnCancel.setEnabled(False)
             self.progress_bar.setVisible(False)
+            if self.processing_thread.cancelled:
+                self.status_label.setText(
+                    "Optimization cancelled. Start again to resume the batch."
+                )
+                return
             self.status_label.setText(
                 "Multi-threaded optimization completed successfully!"
             )
@@ -2084,6 +1617,8 @@ class MainWin(QWidget):
 
     def processing_error(self, error_msg):
         self.btnGo.setEnabled(True)
+        self.btnPause.setEnabled(False)
+        self.btnCancel.setEnabled(False)
         self.progress_bar.setVisible(False)
         self.status_label.setText("Error occurred during processing")
         QMessageBox.critical(self, "Error", f"Processing failed: {error_msg}")
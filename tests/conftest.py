@@ -0,0 +1,26 @@
+import struct
+import zlib
+
+import pytest
+
+
+@pytest.fixture
+def make_png():
+    """Write a flat grey RGB PNG of the given size."""
+
+    def make_png(path, width, height, shade=0x80):
+        def chunk(kind, data):
+            crc = struct.pack(">I", zlib.crc32(kind + data))
+            return struct.pack(">I", len(data)) + kind + data + crc
+
+        row = b"\x00" + bytes([shade]) * (width * 3)
+        header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        path.write_bytes(
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(row * height))
+            + chunk(b"IEND", b"")
+        )
+        return path
+
+    return make_png
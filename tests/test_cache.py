@@ -0,0 +1,61 @@
+import engine
+from engine import FileStats, OutputCache
+
+
+def fake_versions(monkeypatch, versions):
+    monkeypatch.setattr(engine, "tool_version", lambda tool: versions[str(tool)])
+
+
+def test_output_cache_hits_only_the_same_tool_version_and_args(tmp_path, monkeypatch):
+    versions = {"cwebp": "cwebp 1.0"}
+    fake_versions(monkeypatch, versions)
+    stats = FileStats()
+    cache = OutputCache(tmp_path / "cache", stats=stats)
+    source = tmp_path / "in.png"
+    source.write_bytes(b"pixels")
+    out = tmp_path / "out.webp"
+
+    def key(quality=80, source=source, out=out):
+        return cache.key(
+            source, out, [["cwebp", "-q", str(quality), source, "-o", out]]
+        )
+
+    first = key()
+    assert not cache.fetch(first, out)
+    out.write_bytes(b"encoded")
+    cache.store(first, out)
+    out.unlink()
+    assert cache.fetch(first, out)
+    assert out.read_bytes() == b"encoded"
+    assert (stats.counters["cache_misses"], stats.counters["cache_hits"]) == (1, 1)
+
+    # Paths don't matter, only content, arguments and the tool version do
+    copy = tmp_path / "copy.png"
+    copy.write_bytes(b"pixels")
+    assert key(source=copy, out=tmp_path / "other.webp") == first
+    assert key(quality=70) != first
+    versions["cwebp"] = "cwebp 1.1"
+    assert key() != first
+    assert not cache.fetch(key(), out)
+
+
+def test_intermediate_cache_keys_on_resize_strip_and_magick(tmp_path, monkeypatch):
+    versions = {str(engine.MAGICK): "magick 7.1"}
+    fake_versions(monkeypatch, versions)
+    cache = engine.IntermediateCache(tmp_path / "cache", stats=FileStats())
+    geometry = ("-resize", "64x64")
+    first = cache.key("digest", geometry, False)
+    resized = tmp_path / "a_64.png"
+    resized.write_bytes(b"resized")
+    assert not cache.has(first)
+    cache.store_intermediate(first, resized)
+    assert cache.has(first)
+    assert cache.fetch_intermediate(first, tmp_path / "b.png").read_bytes() == (
+        b"resized"
+    )
+
+    assert cache.key("digest", ("-resize", "32x32"), False) != first
+    assert cache.key("digest", geometry, True) != first
+    assert cache.key("other", geometry, False) != first
+    versions[str(engine.MAGICK)] = "magick 7.2"
+    assert not cache.has(cache.key("digest", geometry, False))
@@ -0,0 +1,72 @@
+import signal
+import sys
+
+import pytest
+
+import engine
+
+
+def test_success_without_sigxcpu(monkeypatch):
+    # Windows has no SIGXCPU; a clean exit must not read as a CPU timeout
+    monkeypatch.delattr(signal, "SIGXCPU", raising=False)
+    result = engine.call([sys.executable, "-c", "pass"], timeout=30)
+    assert result.returncode == 0
+
+
+def test_reap_orphans_kills_tools_of_a_dead_batch(tmp_path):
+    import subprocess
+
+    tool = subprocess.Popen(
+        [sys.executable, "-c", "import time; time.sleep(60)"],
+        start_new_session=True,
+    )
+    done = subprocess.Popen([sys.executable, "-c", "pass"])
+    done.wait()
+    log = tmp_path / engine.PROCESS_LOG_NAME
+    log.write_text(
+        f"owner {done.pid} 1\n"
+        f"+ {tool.pid} {engine.process_token(tool.pid)}\n"
+        f"+ {done.pid} 1\n- {done.pid} -\n"
+    )
+    if engine.process_token(tool.pid) is None:
+        tool.kill()
+        pytest.skip("no process start times on this platform")
+    assert engine.reap_orphans(log) == 1
+    assert tool.wait(timeout=10) == -signal.SIGKILL
+    assert not log.exists()
+
+
+SLEEP = [sys.executable, "-c", "import time; time.sleep(30)"]
+
+
+def test_wall_clock_timeout_kills_the_tool():
+    with pytest.raises(engine.ToolTimeoutError) as info:
+        engine.call(SLEEP, timeout=0.5)
+    assert info.value.kind == "wall"
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGXCPU"), reason="no SIGXCPU")
+def test_cpu_time_limit_stops_a_busy_tool():
+    import subprocess
+
+    busy = subprocess.Popen([sys.executable, "-c", "while True: pass"])
+    if not engine.limit_cpu_time(busy.pid, 1):
+        busy.kill()
+        pytest.skip("RLIMIT_CPU can't be set on a child here")
+    assert busy.wait(timeout=30) == -signal.SIGXCPU
+
+
+def test_timed_out_call_retries_with_the_faster_preset():
+    stats = engine.FileStats()
+    processor = engine.ImageProcessor(
+        timeouts={engine.tool_name(sys.executable): 0.5}, stats=stats
+    )
+    fast = [sys.executable, "-c", "print('fast')"]
+    result = processor.call(SLEEP, faster=fast, capture=True)
+    assert result.stdout.strip() == b"fast"
+    assert processor.local.degraded
+    assert stats.counters["fast_retries"] == 1
+
+    processor.retry_faster = False
+    with pytest.raises(engine.ToolTimeoutError):
+        processor.call(SLEEP, faster=fast)
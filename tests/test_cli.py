@@ -0,0 +1,17 @@
+import argparse
+
+import pytest
+
+import cli
+
+
+@pytest.mark.parametrize("value", ["abc", "0", "150%", "original:fit", ""])
+def test_invalid_sizes_are_rejected(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        cli.parse_resize(value)
+
+
+def test_one_size_in_two_modes_is_an_error(capsys):
+    with pytest.raises(SystemExit):
+        cli.main(["in", "-o", "out", "-r", "64", "-r", "64:crop"])
+    assert "64" in capsys.readouterr().err
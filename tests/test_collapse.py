@@ -0,0 +1,38 @@
+from engine import ImageProcessor
+
+
+def graph_for(tmp_path, make_png, resolutions):
+    source = make_png(tmp_path / "a.png", 100, 100)
+    formats = ["WebP", "JPEG"]
+    return ImageProcessor().build_image_graph(
+        source,
+        tmp_path / "tmp",
+        "a",
+        resolutions,
+        formats,
+        {fmt: 80 for fmt in formats},
+        {fmt: False for fmt in formats},
+        False,
+        tmp_path / "out",
+    )
+
+
+def test_identical_geometries_resize_and_encode_once(tmp_path, make_png):
+    # 50% and 50 px are the same 50x50 pixels of a 100x100 input
+    graph = graph_for(
+        tmp_path,
+        make_png,
+        [
+            {"size": "50%", "mode": "fit"},
+            {"size": 50, "mode": "fit"},
+            {"size": 64, "mode": "fit"},
+        ],
+    )
+    tasks = {task.key: task for task in graph.tasks}
+    resizes = {key for key in tasks if key[0] == "resize"}
+    assert resizes == {("resize", "50%"), ("resize", 64)}
+    for fmt in ("WebP", "JPEG"):
+        link = tasks[("encode", 50, fmt)]
+        assert [dep.key for dep in link.deps] == [("encode", "50%", fmt)]
+        assert link.output.name == f"a_50.{'webp' if fmt == 'WebP' else 'jpg'}"
+        assert tasks[("encode", 64, fmt)].deps[0].key == ("resize", 64)
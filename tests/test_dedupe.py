@@ -0,0 +1,69 @@
+import engine
+from engine import BatchProcessor, TaskGraph
+
+RESOLUTIONS = [{"size": 64, "mode": "fit"}]
+
+
+def fake_graph(encoded):
+    """ImageProcessor.build_image_graph that writes stand-in outputs."""
+
+    def build(self, file_path, tmp_dir, base_name, resolutions, formats, *rest):
+        output_dir = rest[3]
+        plan = rest[4] if len(rest) > 4 else None
+        encoded.append(file_path.name)
+        graph = TaskGraph(file_path.name)
+        graph.file_path = file_path
+        graph.original_size = file_path.stat().st_size
+        for res in resolutions:
+            for fmt in formats:
+                size = res["size"]
+                if plan:
+                    out_path = plan[(size, fmt)]
+                else:
+                    out_path = output_dir / f"{base_name}_{size}.{fmt.lower()}"
+                task = graph.add(
+                    ("encode", size, fmt),
+                    lambda out_path=out_path: out_path.write_bytes(b"out") or 3,
+                )
+                task.output = out_path
+        return graph
+
+    return build
+
+
+def test_copies_follow_the_first_input(tmp_path, monkeypatch, make_png):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    encoded = []
+    monkeypatch.setattr(engine.ImageProcessor, "build_image_graph", fake_graph(encoded))
+    monkeypatch.setattr(
+        BatchProcessor, "required_tools", lambda self: [], raising=False
+    )
+    source = tmp_path / "in"
+    source.mkdir()
+    make_png(source / "a.png", 8, 8)
+    make_png(source / "b.png", 8, 8, shade=0x20)
+    for name in ("copy1.png", "copy2.png"):
+        (source / name).write_bytes((source / "a.png").read_bytes())
+    output = tmp_path / "out"
+
+    processor = BatchProcessor(
+        [source],
+        output,
+        RESOLUTIONS,
+        ["WebP"],
+        {"WebP": 80},
+        {"WebP": False},
+        False,
+        False,
+        2,
+        dedupe=True,
+    )
+    stats = processor.run()
+
+    assert not stats.errors
+    # One encode per distinct content; the copies got links instead
+    assert len(encoded) == 2 and "b.png" in encoded
+    assert stats.counters["duplicates"] == 2
+    assert stats.files_processed == 4
+    for stem in ("a", "b", "copy1", "copy2"):
+        assert (output / f"{stem}_64.webp").read_bytes() == b"out"
@@ -0,0 +1,64 @@
+from engine import TaskGraph, TaskScheduler
+
+
+def image_graph(log, fail=None):
+    """normalize -> two resizes -> two encodes each, logging what ran."""
+    graph = TaskGraph("a.png")
+
+    def stage(name, *inputs):
+        log.append(name)
+        if name == fail:
+            raise RuntimeError(f"{name} failed")
+        return name
+
+    normalize = graph.add("normalize", lambda: stage("normalize"))
+    for size in (64, 32):
+        resize = graph.add(
+            ("resize", size),
+            lambda png, size=size: stage(f"resize {size}", png),
+            deps=[normalize],
+        )
+        for fmt in ("WebP", "JPEG"):
+            graph.add(
+                ("encode", size, fmt),
+                lambda png, size=size, fmt=fmt: stage(f"{fmt} {size}", png),
+                deps=[resize],
+            )
+    return graph
+
+
+def run(*graphs):
+    with TaskScheduler(4) as scheduler:
+        futures = [scheduler.submit(graph) for graph in graphs]
+        return [future.result(timeout=10) for future in futures]
+
+
+def test_stages_run_after_their_dependencies():
+    log = []
+    (graph,) = run(image_graph(log))
+    assert len(log) == 7 and log[0] == "normalize"
+    for size in (64, 32):
+        resized = log.index(f"resize {size}")
+        assert log.index(f"WebP {size}") > resized
+        assert log.index(f"JPEG {size}") > resized
+    assert not any(task.failed for task in graph.tasks)
+
+
+def test_failure_skips_dependents_only():
+    log = []
+    (graph,) = run(image_graph(log, fail="resize 64"))
+    tasks = {task.key: task for task in graph.tasks}
+    assert isinstance(tasks[("resize", 64)].error, RuntimeError)
+    assert tasks[("encode", 64, "WebP")].skipped
+    assert tasks[("encode", 64, "JPEG")].skipped
+    assert "WebP 64" not in log and "JPEG 64" not in log
+    assert tasks[("encode", 32, "WebP")].result == "WebP 32"
+    assert tasks[("encode", 32, "JPEG")].result == "JPEG 32"
+
+
+def test_failed_root_still_resolves_the_graph():
+    log = []
+    graphs = run(image_graph(log, fail="normalize"), image_graph([]))
+    assert log == ["normalize"]
+    assert all(task.failed for task in graphs[0].tasks)
+    assert not any(task.failed for task in graphs[1].tasks)
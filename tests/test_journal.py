@@ -0,0 +1,41 @@
+from engine import JOURNAL_NAME, Journal
+
+SETTINGS = "settings-hash"
+
+
+def crash(journal):
+    """Stop a session the way a crash does, mid-way through a record."""
+    journal.close()
+    with open(journal.path, "a", encoding="utf-8") as f:
+        f.write('{"done":"torn')
+
+
+def session(output_dir, source, variants):
+    """One run that plans source, finishes `variants` and then crashes."""
+    journal = Journal(output_dir, SETTINGS, resume=True)
+    plan = {(64, "WebP"): output_dir / "a_64.webp", (32, "WebP"): None}
+    journal.plan(source, plan)
+    for variant in variants:
+        journal.done(source, variant, 10, 100)
+    crash(journal)
+
+
+def test_resume_after_two_crashes(tmp_path):
+    source = tmp_path / "a.png"
+    source.write_bytes(b"png")
+    session(tmp_path, source, [(64, "WebP")])
+    session(tmp_path, source, [(32, "WebP")])
+
+    journal = Journal(tmp_path, SETTINGS, resume=True)
+    journal.close()
+    key = Journal.key(source)
+    assert set(journal.units) == {(key, (64, "WebP")), (key, (32, "WebP"))}
+    # Both torn tails were cut off before the next session appended
+    assert not (tmp_path / JOURNAL_NAME).read_text(encoding="utf-8").count("torn")
+
+
+def test_context_manager_closes(tmp_path):
+    with Journal(tmp_path, SETTINGS) as journal:
+        journal.done(tmp_path / "a.png", (64, "WebP"), 10, 100)
+    assert journal.file.closed
+    assert '"done"' in (tmp_path / JOURNAL_NAME).read_text(encoding="utf-8")
@@ -0,0 +1,22 @@
+from engine import ResourceLanes
+
+
+def test_release_returns_tokens_taken_under_old_budget():
+    lanes = ResourceLanes(8, threads={"avifenc": 4})
+    weight = lanes.try_acquire("avifenc")
+    assert weight == 4
+    lanes.set_budget(2)
+    lanes.release("avifenc", weight)
+    assert lanes.in_use == 0
+    assert lanes.try_acquire("avifenc") == 2
+
+
+def test_head_without_a_lane_keeps_its_tokens():
+    lanes = ResourceLanes(2)
+    assert lanes.try_acquire("other") == 1
+    # An old head for a tool without a lane of its own, which is waiting
+    # on tokens, not on a lane
+    head = (0.0, "other", 1, None)
+    late = (0.0, "cheap", 1, None)
+    lanes.waiters.extend([head, late])
+    assert not lanes._may_go(late)
@@ -0,0 +1,20 @@
+import os
+
+import engine
+from engine import Manifest
+
+
+def test_unreadable_input_counts_as_changed(tmp_path, monkeypatch):
+    source = tmp_path / "a.png"
+    source.write_bytes(b"png")
+    manifest = Manifest(tmp_path, "settings", hash_inputs=True)
+    assert not manifest.is_current(source)
+    manifest.record(source, [])
+    os.utime(source, ns=(0, 0))
+
+    def unreadable(path):
+        raise PermissionError(13, "Permission denied", str(path))
+
+    monkeypatch.setattr(engine, "file_hash", unreadable)
+    assert not manifest.is_current(source)
+    assert Manifest.key(source) not in manifest.fresh
@@ -0,0 +1,62 @@
+from pathlib import Path
+
+import pytest
+
+from engine import OutputPlanner
+
+RESOLUTIONS = [{"size": 64, "mode": "fit"}]
+
+
+def test_ask_plans_inputs_without_conflicts(tmp_path):
+    (tmp_path / "taken_64.webp").write_bytes(b"old")
+    planner = OutputPlanner(tmp_path, RESOLUTIONS, ["WebP"], policy="ask")
+
+    assert not planner.in_conflict(Path("in/free.png"))
+    plan, renamed = planner.claim(Path("in/free.png"))
+    assert plan == {(64, "WebP"): tmp_path / "free_64.webp"} and not renamed
+
+    assert planner.in_conflict(Path("in/taken.png"))
+    with pytest.raises(ValueError):
+        planner.claim(Path("in/taken.png"))
+    planner.policy = "rename"
+    plan, renamed = planner.claim(Path("in/taken.png"))
+    assert plan == {(64, "WebP"): tmp_path / "taken-2_64.webp"} and renamed
+
+
+def plan_existing(tmp_path, policy):
+    """Plan in/taken.png in two formats where only its WebP output exists."""
+    (tmp_path / "taken_64.webp").write_bytes(b"old")
+    planner = OutputPlanner(tmp_path, RESOLUTIONS, ["WebP", "JPEG"], policy=policy)
+    return planner.claim(Path("in/taken.png"))
+
+
+def test_overwrite_plans_existing_outputs(tmp_path):
+    plan, renamed = plan_existing(tmp_path, "overwrite")
+    assert plan == {
+        (64, "WebP"): tmp_path / "taken_64.webp",
+        (64, "JPEG"): tmp_path / "taken_64.jpg",
+    }
+    assert not renamed
+
+
+def test_skip_drops_only_existing_outputs(tmp_path):
+    plan, renamed = plan_existing(tmp_path, "skip")
+    assert plan == {(64, "WebP"): None, (64, "JPEG"): tmp_path / "taken_64.jpg"}
+    assert not renamed
+
+
+def test_rename_moves_the_whole_input_to_a_free_stem(tmp_path):
+    plan, renamed = plan_existing(tmp_path, "rename")
+    assert plan == {
+        (64, "WebP"): tmp_path / "taken-2_64.webp",
+        (64, "JPEG"): tmp_path / "taken-2_64.jpg",
+    }
+    assert renamed
+
+
+def test_inputs_sharing_a_stem_never_share_outputs(tmp_path):
+    planner = OutputPlanner(tmp_path, RESOLUTIONS, ["WebP"])
+    first, _ = planner.claim(Path("a/photo.png"))
+    second, renamed = planner.claim(Path("b/photo.jpg"))
+    assert first == {(64, "WebP"): tmp_path / "photo_64.webp"}
+    assert second == {(64, "WebP"): tmp_path / "photo-2_64.webp"} and renamed
@@ -0,0 +1,58 @@
+from engine import ScratchSpace, TaskGraph
+
+
+def test_intermediate_is_freed_after_its_last_reader(tmp_path):
+    scratch = ScratchSpace(tmp_path / "scratch", quota=1 << 20)
+    normalized = scratch.image_dir(0) / "a.png"
+    normalized.write_bytes(b"x" * 100)
+    graph = TaskGraph("a.png")
+    graph.scratch = scratch
+    normalize = graph.add("normalize", lambda: normalized)
+    encodes = [
+        graph.add(("encode", 64, fmt), lambda png: png, deps=[normalize])
+        for fmt in ("WebP", "JPEG")
+    ]
+    for task in graph.tasks:
+        task.run()
+
+    assert graph.release(normalize) == []
+    assert scratch.used == 100
+    assert graph.release(encodes[0]) == []
+    # The encodes return the same path, but no stage reads it after them
+    assert graph.release(encodes[1]) == [normalized]
+    scratch.delete(normalized)
+    assert not normalized.exists()
+    assert (scratch.used, scratch.peak) == (0, 100)
+
+
+def test_files_outside_the_image_folders_are_not_tracked(tmp_path):
+    scratch = ScratchSpace(tmp_path / "scratch", quota=1 << 20)
+    source = tmp_path / "a.png"
+    source.write_bytes(b"x" * 100)
+    graph = TaskGraph("a.png")
+    graph.scratch = scratch
+    native = graph.add("native", lambda: source)
+    graph.add(("encode", 64, "WebP"), lambda png: png, deps=[native])
+    for task in graph.tasks:
+        task.run()
+    assert graph.release(native) == []
+    assert graph.release(graph.tasks[1]) == []
+    assert scratch.used == 0 and source.exists()
+
+
+def test_quota_counts_reservations(tmp_path):
+    scratch = ScratchSpace(parent=tmp_path, quota=100)
+    assert scratch.root.parent == tmp_path
+    assert scratch.fits(60)
+    scratch.reserve(60)
+    assert not scratch.fits(50)
+    scratch.unreserve(60)
+    assert scratch.fits(100)
+
+    leftover = scratch.image_dir(3) / "a_64.png"
+    leftover.write_bytes(b"x" * 10)
+    scratch.track(leftover)
+    scratch.drop(leftover.parent)
+    assert scratch.used == 0 and not leftover.parent.exists()
+    scratch.close()
+    assert not scratch.root.exists()
@@ -0,0 +1,9 @@
+from engine import FileStats, ResourceLanes, Speculator
+
+
+def test_observe_skips_calls_without_pixels():
+    speculator = Speculator(ResourceLanes(2), FileStats())
+    speculator.observe("cwebp", 0, 1.0)
+    speculator.observe("cwebp", None, 1.0)
+    speculator.observe("cwebp", 2_000_000, 1.0)
+    assert speculator.rates == {"cwebp": (0.5, 1)}
@@ -0,0 +1,57 @@
+import pytest
+
+from engine import RASTER_PIXEL_BYTES, ImageProcessor
+
+FORMATS = ["WebP"]
+
+
+def streamed_stages(tmp_path, monkeypatch, make_png, stream_limit, pipes=True):
+    """Build and run a 100x100 image's graph; the stages asked to stream."""
+    streamed = []
+
+    def normalize(self, input_path, tmp_dir, base_name, writable=False, stream=False):
+        streamed.append(("normalize", stream))
+        return input_path
+
+    def resize(self, path, tmp_dir, base_name, res, dims=None, raster="", stream=False):
+        streamed.append((res["size"], stream))
+        return path
+
+    monkeypatch.setattr(ImageProcessor, "pipes", lambda self, fmt: pipes)
+    monkeypatch.setattr(ImageProcessor, "normalize_to_png", normalize)
+    monkeypatch.setattr(ImageProcessor, "resize_variant", resize)
+    monkeypatch.setattr(ImageProcessor, "encode_logged", lambda self, *args: 0)
+    source = make_png(tmp_path / "a.png", 100, 100)
+    ImageProcessor(stream_limit=stream_limit).build_image_graph(
+        source,
+        tmp_path,
+        "a",
+        [{"size": 64, "mode": "fit"}],
+        FORMATS,
+        {"WebP": 80},
+        {"WebP": False},
+        False,
+        tmp_path,
+    ).run()
+    return streamed
+
+
+@pytest.mark.parametrize(
+    "stream_limit, expected",
+    [
+        (100 * 100 * RASTER_PIXEL_BYTES, True),
+        (100 * 100 * RASTER_PIXEL_BYTES - 1, False),
+        (0, False),
+    ],
+)
+def test_images_above_the_limit_fall_back_to_files(
+    tmp_path, monkeypatch, make_png, stream_limit, expected
+):
+    streamed = streamed_stages(tmp_path, monkeypatch, make_png, stream_limit)
+    assert streamed == [("normalize", expected), (64, expected)]
+
+
+def test_encoder_without_stdin_reads_a_file(tmp_path, monkeypatch, make_png):
+    streamed = streamed_stages(tmp_path, monkeypatch, make_png, 1 << 30, pipes=False)
+    # The resize still reads the normalized raster from stdin
+    assert streamed == [("normalize", True), (64, False)]